@@ -0,0 +1,941 @@
+"""Benchmarks for kicad_tools and kicad_schlib
+
+Generates synthetic boards and symbol libraries and times operations on
+them. Run as a script:
+
+    python kicad_bench.py [n_segments] [--symbols N] [--json out.json]
+                          [--baseline base.json] [--tolerance 0.25]
+
+Besides the readable lines it prints, every timing and peak memory figure
+is recorded by name in RESULTS. --json saves them, and --baseline compares
+them against an earlier saved run, listing everything that got slower or
+bigger by more than the tolerance and exiting with status 1 if anything
+did. Baselines only mean something on the same machine and sizes.
+"""
+
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import kicad_schlib
+import kicad_tools
+
+LAYERS = [(0, "F.Cu", "signal"), (1, "In1.Cu", "signal"),
+          (2, "In2.Cu", "signal"), (31, "B.Cu", "signal"),
+          (32, "B.Adhes", "user"), (33, "F.Adhes", "user"),
+          (36, "B.SilkS", "user"), (37, "F.SilkS", "user"),
+          (44, "Edge.Cuts", "user")]
+
+COPPER = [i[1] for i in LAYERS if i[2] == "signal"]
+
+# Track directions: the eight 45-degree headings
+DIRECTIONS = [(1, 0), (0.7071, 0.7071), (0, 1), (-0.7071, 0.7071),
+              (-1, 0), (-0.7071, -0.7071), (0, -1), (0.7071, -0.7071)]
+
+SMD_MODULE = """  (module Resistor_SMD:R_0603_1608Metric (layer F.Cu) (tedit 5B301BBD) (tstamp 5C0B1A2F)
+    (at %(x)g %(y)g %(rot)d)
+    (descr "Resistor SMD 0603 (1608 Metric)")
+    (attr smd)
+    (fp_text reference R%(n)d (at 0 -1.43 %(rot)d) (layer F.SilkS)
+      (effects (font (size 1 1) (thickness 0.15)))
+    )
+    (fp_text value 10k (at 0 1.43 %(rot)d) (layer F.Fab)
+      (effects (font (size 1 1) (thickness 0.15)))
+    )
+    (fp_line (start -0.8 0.4) (end -0.8 -0.4) (layer F.Fab) (width 0.1))
+    (fp_line (start 0.8 -0.4) (end 0.8 0.4) (layer F.Fab) (width 0.1))
+    (pad 1 smd roundrect (at -0.7875 0 %(rot)d) (size 0.875 0.95) (layers F.Cu F.Paste F.Mask) (roundrect_rratio 0.25)
+      (net %(net1)d %(name1)s))
+    (pad 2 smd roundrect (at 0.7875 0 %(rot)d) (size 0.875 0.95) (layers F.Cu F.Paste F.Mask) (roundrect_rratio 0.25)
+      (net %(net2)d %(name2)s))
+    (model ${KISYS3DMOD}/Resistor_SMD.3dshapes/R_0603_1608Metric.wrl
+      (at (xyz 0 0 0))
+      (scale (xyz 1 1 1))
+      (rotate (xyz 0 0 0))
+    )
+  )
+"""
+
+THT_MODULE = """  (module Connector_PinHeader_2.54mm:PinHeader_1x02_P2.54mm_Vertical (layer F.Cu) (tedit 59FED5CC) (tstamp 5C0B1A30)
+    (at %(x)g %(y)g %(rot)d)
+    (descr "Through hole straight pin header, 1x02, 2.54mm pitch")
+    (fp_text reference J%(n)d (at 0 -2.33 %(rot)d) (layer F.SilkS)
+      (effects (font (size 1 1) (thickness 0.15)))
+    )
+    (fp_text value Conn_01x02 (at 0 4.87 %(rot)d) (layer F.Fab)
+      (effects (font (size 1 1) (thickness 0.15)))
+    )
+    (fp_line (start -1.33 3.87) (end 1.33 3.87) (layer F.SilkS) (width 0.12))
+    (pad 1 thru_hole rect (at 0 0 %(rot)d) (size 1.7 1.7) (drill 1) (layers *.Cu *.Mask)
+      (net %(net1)d %(name1)s))
+    (pad 2 thru_hole oval (at 0 2.54 %(rot)d) (size 1.7 1.7) (drill 1) (layers *.Cu *.Mask)
+      (net %(net2)d %(name2)s))
+  )
+"""
+
+def net_name (i):
+    if i == 0:
+        return ""
+    elif i % 3:
+        return "/SIG%d" % i
+    else:
+        return "Net-(U%d-Pad2)" % i
+
+def quote (name):
+    if not name or any (c in name for c in ' ()"'):
+        return '"%s"' % name.replace ('"', '\\"')
+    return name
+
+def make_board (n_segments=10000, n_vias=None, n_nets=None, n_modules=None,
+                n_zones=None, zone_points=5000, pieces=1, seed=0, size=200.):
+    """Return the text of a synthetic board with roughly the given number of
+    segments.
+
+    Segments are laid down as meandering tracks of short pieces at 45 degree
+    headings, often running straight on for a few pieces in a row. Vias
+    default to a fifth of the segment count, sitting on track ends, with
+    about one in ten stacked on the previous one. Modules default to a
+    twentieth, half SMD resistors and half pin headers. Zones default to one
+    per two thousand segments, each a rectangle filled with a wobbly
+    zone_points-point polygon. With pieces > 1, each segment is cut into up
+    to that many collinear pieces, like an autorouter leaves them; the
+    segment count is then before cutting.
+    """
+    rnd = random.Random (seed)
+    if n_vias is None:
+        n_vias = n_segments // 5
+    if n_nets is None:
+        n_nets = max (2, n_segments // 50)
+    if n_modules is None:
+        n_modules = n_segments // 20
+    if n_zones is None:
+        n_zones = n_segments // 2000
+
+    def coord ():
+        return round (rnd.uniform (0, size), 4)
+
+    out = []
+    w = out.append
+    w ("(kicad_pcb (version 20171130) (host pcbnew 5.1.5)\n\n")
+    w ("  (general\n    (thickness 1.6)\n    (drawings 1)\n"
+       "    (tracks %d)\n    (zones %d)\n    (modules %d)\n    (nets %d)\n  )\n\n"
+       % (n_segments + n_vias, n_zones, n_modules, n_nets))
+    w ("  (page A4)\n  (layers\n")
+    for num, name, kind in LAYERS:
+        w ("    (%d %s %s)\n" % (num, name, kind))
+    w ("  )\n\n")
+    for i in range (n_nets):
+        w ("  (net %d %s)\n" % (i, quote (net_name (i))))
+    w ("\n")
+
+    for i in range (n_modules):
+        net1 = rnd.randrange (1, n_nets)
+        net2 = rnd.randrange (1, n_nets)
+        template = SMD_MODULE if i % 2 else THT_MODULE
+        w (template % dict (
+            x = coord (), y = coord (), rot = rnd.choice ((0, 90, 180, 270)),
+            n = i + 1, net1 = net1, name1 = quote (net_name (net1)),
+            net2 = net2, name2 = quote (net_name (net2))))
+
+    for i in range (n_zones):
+        net = rnd.randrange (1, n_nets)
+        layer = rnd.choice (COPPER)
+        x0, y0 = round (rnd.uniform (0, size / 2), 4), round (rnd.uniform (0, size / 2), 4)
+        x1, y1 = x0 + size / 4, y0 + size / 4
+        w ("  (zone (net %d) (net_name %s) (layer %s) (tstamp 5C0B1A31) (hatch edge 0.508)\n"
+           "    (connect_pads (clearance 0.3))\n    (min_thickness 0.254)\n"
+           "    (fill yes (arc_segments 32) (thermal_gap 0.508) (thermal_bridge_width 0.508))\n"
+           "    (polygon\n      (pts\n        (xy %g %g) (xy %g %g) (xy %g %g) (xy %g %g)\n"
+           "      )\n    )\n    (filled_polygon\n      (pts\n"
+           % (net, quote (net_name (net)), layer, x0, y0, x1, y0, x1, y1, x0, y1))
+        cx, cy, r = (x0 + x1) / 2, (y0 + y1) / 2, size / 10
+        points = []
+        for j in range (zone_points):
+            a = 2 * math.pi * j / zone_points
+            rj = r * (1 + 0.05 * rnd.random ())
+            points.append ("(xy %.4f %.4f)" % (cx + rj * math.cos (a),
+                                              cy + rj * math.sin (a)))
+        for j in range (0, zone_points, 4):
+            w ("        %s\n" % " ".join (points[j:j + 4]))
+        w ("      )\n    )\n  )\n")
+
+    w ("  (gr_text \"synthetic \\\"board\\\"\" (at 100 20) (layer F.SilkS)\n"
+       "    (effects (font (size 1.5 1.5) (thickness 0.3)))\n  )\n")
+
+    track_ends = []
+    n = 0
+    while n < n_segments:
+        x, y = coord (), coord ()
+        heading = rnd.randrange (8)
+        layer = rnd.choice (COPPER)
+        net = rnd.randrange (1, n_nets)
+        for i in range (min (rnd.randint (3, 30), n_segments - n)):
+            if rnd.random () < 0.4:
+                heading = (heading + rnd.choice ((-1, 1))) % 8
+            dx, dy = DIRECTIONS[heading]
+            step = rnd.uniform (0.5, 3)
+            x1 = min (max (round (x + dx * step, 4), 0), size)
+            y1 = min (max (round (y + dy * step, 4), 0), size)
+            k = rnd.randint (1, pieces)
+            points = [(round (x + (x1 - x) * j / k, 4),
+                       round (y + (y1 - y) * j / k, 4)) for j in range (k + 1)]
+            for (xa, ya), (xb, yb) in zip (points, points[1:]):
+                w ("  (segment (start %g %g) (end %g %g) (width 0.25) (layer %s) (net %d) (tstamp 5C0B1A2F))\n"
+                   % (xa, ya, xb, yb, layer, net))
+            x, y = x1, y1
+            n += 1
+        track_ends.append ((x, y, net))
+
+    last = None
+    for i in range (n_vias):
+        if last is not None and rnd.random () < 0.1:
+            pos = last
+        elif track_ends:
+            pos = track_ends[i % len (track_ends)]
+        else:
+            pos = (coord (), coord (), rnd.randrange (1, n_nets))
+        last = pos
+        w ("  (via (at %g %g) (size 0.8) (drill 0.4) (layers F.Cu B.Cu) (net %d))\n"
+           % pos)
+    w ("\n)\n")
+    return "".join (out)
+
+def make_lib (n_symbols=2000, n_pins=None, seed=0):
+    """Return the text of a synthetic schematic symbol library.
+
+    Symbols are a mix of small parts and big ICs; n_pins, if given, fixes the
+    pin count of every symbol instead. Each has the four standard fields and
+    sometimes a fifth, the odd alias, a footprint filter list and a body of
+    rectangles, polylines, circles, arcs and text.
+    """
+    rnd = random.Random (seed)
+    pin_types = "IOBTPUWwCEN"
+    styles = [None, None, None, "I", "C", "N", "IC"]
+
+    out = []
+    w = out.append
+    w ("EESchema-LIBRARY Version 2.3\n#encoding utf-8\n")
+    for i in range (n_symbols):
+        if n_pins is not None:
+            pins = n_pins
+        elif i % 10 == 0:
+            pins = rnd.randint (64, 256)
+        else:
+            pins = rnd.randint (2, 24)
+        name = "PART%d-%s" % (i, rnd.choice (("SOIC", "QFN", "TQFP", "DIP")))
+        ref = "U" if pins > 3 else rnd.choice ("RCLD")
+        half = (pins + 1) // 2 * 100
+        w ("#\n# %s\n#\n" % name)
+        w ("DEF %s %s 0 40 Y Y 1 F N\n" % (name, ref))
+        w ('F0 "%s" -300 %d 50 H V L CNN\n' % (ref, half + 50))
+        w ('F1 "%s" -300 %d 50 H V L CNN\n' % (name, -half - 50))
+        w ('F2 "Package_SO:SOIC-%d" 0 0 50 H I C CNN\n' % pins)
+        w ('F3 "" 0 0 50 H I C CNN\n')
+        if rnd.random () < 0.2:
+            w ('F4 "Manufacturer part %d" 0 0 50 H I C CNN\n' % i)
+        if rnd.random () < 0.1:
+            w ("ALIAS %s-A %s-B\n" % (name, name))
+        if rnd.random () < 0.7:
+            w ("$FPLIST\n SOIC*\n %s*\n$ENDFPLIST\n" % name.split ("-")[1])
+        w ("DRAW\n")
+        w ("S -300 %d 300 %d 0 1 10 f\n" % (half, -half))
+        for j in range (rnd.randint (0, 4)):
+            points = [rnd.randint (-300, 300) for k in range (2 * rnd.randint (2, 5))]
+            w ("P %d 0 1 0 %s N\n" % (len (points) // 2,
+                                       " ".join (str (k) for k in points)))
+        if rnd.random () < 0.3:
+            w ("C 0 0 50 0 1 10 N\n")
+        if rnd.random () < 0.2:
+            w ("A 0 0 100 0 900 0 1 10 N 100 0 0 100\n")
+        if rnd.random () < 0.2:
+            w ("T 0 0 %d 50 0 0 1 Label Normal 0 C C\n" % (half - 100))
+        for j in range (pins):
+            left = j < (pins + 1) // 2
+            y = half - 100 - 100 * (j if left else j - (pins + 1) // 2)
+            style = rnd.choice (styles)
+            w ("X %s %d %d %d 200 %s 50 50 1 1 %s%s\n" % (
+                "PIN%d" % (j + 1) if rnd.random () < 0.5 else "~",
+                j + 1, -500 if left else 500, y, "R" if left else "L",
+                rnd.choice (pin_types), "" if style is None else " " + style))
+        w ("ENDDRAW\nENDDEF\n")
+    w ("#\n#End Library\n")
+    return "".join (out)
+
+# Results of this run by name, as (value, unit). Everything recorded is a
+# time or a size, so lower is always better.
+RESULTS = {}
+
+def record (name, value, unit="s"):
+    RESULTS[name] = (value, unit)
+    return value
+
+def peak_memory (fn):
+    """Peak traced allocation, in bytes, while running fn()"""
+    import tracemalloc
+    tracemalloc.start ()
+    try:
+        fn ()
+        return tracemalloc.get_traced_memory ()[1]
+    finally:
+        tracemalloc.stop ()
+
+def held_memory (fn):
+    """Bytes still allocated by fn() while its result is kept"""
+    import gc
+    import tracemalloc
+    tracemalloc.start ()
+    try:
+        result = fn ()
+        gc.collect ()
+        size = tracemalloc.get_traced_memory ()[0]
+    finally:
+        tracemalloc.stop ()
+    del result
+    return size
+
+def save_results (filename, **meta):
+    meta.update (python=platform.python_version (),
+                 machine=platform.machine (), time=time.time ())
+    with open (filename, "w") as f:
+        json.dump (dict (meta=meta, results={
+            name: dict (value=value, unit=unit)
+            for name, (value, unit) in RESULTS.items ()}), f, indent=1,
+            sort_keys=True)
+
+def compare (baseline, tolerance=0.25):
+    """Compare RESULTS against a baseline saved by save_results. Returns a
+    list of (name, old, new, unit) for everything more than tolerance worse,
+    after printing the whole comparison.
+    """
+    with open (baseline) as f:
+        old = json.load (f)["results"]
+    worse = []
+    for name in sorted (RESULTS):
+        value, unit = RESULTS[name]
+        if name not in old:
+            print ("  %-40s %12s -> %12.6g %s (new)" % (name, "", value, unit))
+            continue
+        prev = old[name]["value"]
+        ratio = value / prev if prev else float ("inf") if value else 1.
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  WORSE"
+            worse.append ((name, prev, value, unit))
+        elif ratio < 1 / (1 + tolerance):
+            flag = "  better"
+        print ("  %-40s %12.6g -> %12.6g %s (%.2fx)%s" % (
+            name, prev, value, unit, ratio, flag))
+    for name in sorted (set (old) - set (RESULTS)):
+        print ("  %-40s missing from this run" % name)
+    return worse
+
+def timeit (fn, repeat=3):
+    """Best-of-n wall time for fn()"""
+    best = None
+    for i in range (repeat):
+        t0 = time.perf_counter ()
+        fn ()
+        t = time.perf_counter () - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+def bench_parse (text):
+    import sexpdata
+    t_old = timeit (lambda: sexpdata.loads (text), repeat=1)
+    t_new = record ("parse_sexp", timeit (lambda: kicad_tools.parse_sexp (text)))
+    record ("parse_sexp.peak", peak_memory (lambda: kicad_tools.parse_sexp (text)), "B")
+    print ("parse %.1f MB: sexpdata %.3f s, parse_sexp %.3f s (%.1fx)" % (
+        len (text) / 1e6, t_old, t_new, t_old / t_new))
+
+def bench_load (path):
+    for lazy in (False, True):
+        name = "KicadPCB.lazy" if lazy else "KicadPCB"
+        t_load = record (name, timeit (lambda: kicad_tools.KicadPCB (path, lazy=lazy)))
+        peak = record (name + ".peak", peak_memory (
+            lambda: kicad_tools.KicadPCB (path, lazy=lazy)), "B")
+        pcb = kicad_tools.KicadPCB (path, lazy=lazy)
+        t_write = record (name + ".write", timeit (lambda: pcb.write (path + ".out")))
+        print ("KicadPCB lazy=%s: load %.3f s (peak %.1f MB), write %.3f s" % (
+            lazy, t_load, peak / 1e6, t_write))
+    os.unlink (path + ".out")
+
+def bench_cache (path):
+    """Loading through a BoardCache, cold and warm, against no cache. Warm
+    loads are also compared with parsing the board outright, and eager
+    ones timed again with every child's tree fetched."""
+    import shutil
+    directory = tempfile.mkdtemp ()
+    try:
+        t_parse = None
+        for lazy in (False, True):
+            cache = kicad_tools.BoardCache (directory)
+            t_none = timeit (lambda: kicad_tools.KicadPCB (path, lazy=lazy))
+            if t_parse is None:
+                t_parse = t_none
+            t_cold = timeit (lambda: kicad_tools.KicadPCB (path, lazy=lazy,
+                                                           cache=cache),
+                             repeat=1)
+            t_warm = timeit (lambda: kicad_tools.KicadPCB (path, lazy=lazy,
+                                                           cache=cache))
+            record ("BoardCache.warm%s" % (".lazy" if lazy else ""), t_warm)
+            print ("KicadPCB lazy=%s cached: uncached %.3f s, cold %.3f s, "
+                   "warm %.3f s (%.1fx, %.1fx parse), %.1f MB on disk" % (
+                       lazy, t_none, t_cold, t_warm, t_none / t_warm,
+                       t_parse / t_warm, cache.size () / 1e6))
+            if not lazy:
+                def load_all ():
+                    pcb = kicad_tools.KicadPCB (path, cache=cache)
+                    for i in pcb.children:
+                        i._tree ()
+                t_all = timeit (load_all)
+                record ("BoardCache.warm.all", t_all)
+                print ("  warm with every tree fetched %.3f s (%.1fx)" % (
+                    t_all, t_parse / t_all))
+    finally:
+        shutil.rmtree (directory)
+
+def bench_zones (n_points=200000):
+    """Packed zones against zones as plain lists: parse, write and memory"""
+    import tracemalloc
+    text = make_board (0, n_vias=0, n_nets=2, n_modules=0, n_zones=1,
+                       zone_points=n_points)
+    start = text.index ("(zone (")
+    end = kicad_tools._find_sexp_end (text, start)
+    fmt = kicad_tools._AtomFormats ().__getitem__
+
+    t_lists = timeit (lambda: kicad_tools.parse_sexp (text, start, end))
+    t_packed = timeit (lambda: kicad_tools._parse_zone (text, start, end))
+    tracemalloc.start ()
+    lists = kicad_tools.parse_sexp (text, start, end)
+    m_lists = tracemalloc.get_traced_memory ()[0]
+    del lists
+    tracemalloc.stop ()
+    tracemalloc.start ()
+    packed = kicad_tools._parse_zone (text, start, end)
+    m_packed = tracemalloc.get_traced_memory ()[0]
+    tracemalloc.stop ()
+    lists = kicad_tools._unpack (packed)
+    w_lists = timeit (lambda: kicad_tools._flat (lists, fmt))
+    w_packed = timeit (lambda: kicad_tools._flat (packed, fmt))
+    zone = kicad_tools.ZoneSexp (None, packed)
+    t_area = timeit (zone.area)
+    t_contains = timeit (lambda: zone.contains (50, 50))
+    record ("zone.parse", t_packed)
+    record ("zone.write", w_packed)
+    record ("zone.size", m_packed, "B")
+    record ("ZoneSexp.area", t_area)
+    record ("ZoneSexp.contains", t_contains)
+    print ("zone, %d points: parse %.3f s -> %.3f s (%.1fx), write %.3f s -> "
+           "%.3f s (%.1fx), %.1f MB -> %.1f MB; area %.1f ms, contains %.1f ms"
+           % (n_points, t_lists, t_packed, t_lists / t_packed, w_lists,
+              w_packed, w_lists / w_packed, m_lists / 1e6, m_packed / 1e6,
+              t_area * 1e3, t_contains * 1e3))
+
+def bench_access (path):
+    """Property reads on every via and segment, against the plain get_from
+    scan they used to do"""
+    pcb = kicad_tools.KicadPCB (path)
+    vias = pcb.find_types (kicad_tools.ViaSexp)
+    segs = pcb.find_types (kicad_tools.SegmentSexp)
+    get_from = kicad_tools.get_from
+
+    def scan ():
+        for i in vias:
+            sexp = i.out ()
+            get_from (sexp, "at"), get_from (sexp, "size")[0]
+            get_from (sexp, "drill")[0], get_from (sexp, "net")[0]
+        for i in segs:
+            sexp = i.out ()
+            get_from (sexp, "start"), get_from (sexp, "end")
+            get_from (sexp, "width")[0], get_from (sexp, "layer")[0]
+            get_from (sexp, "net")[0]
+
+    def props ():
+        for i in vias:
+            i.pos, i.size, i.drill, i.net
+        for i in segs:
+            i.start, i.end, i.width, i.layer, i.net
+
+    n = 4 * len (vias) + 5 * len (segs)
+    t_scan = timeit (scan)
+    t_props = record ("properties", timeit (props) / n) * n
+    print ("field access: get_from %.0f ns, properties %.0f ns (%.1fx)" % (
+        t_scan / n * 1e9, t_props / n * 1e9, t_scan / t_props))
+
+def bench_spatial (path, n_queries=10000):
+    pcb = kicad_tools.KicadPCB (path)
+    t0 = time.perf_counter ()
+    index = pcb.spatial_index ()
+    t_build = time.perf_counter () - t0
+    rnd = random.Random (1)
+    points = [(rnd.uniform (0, 200), rnd.uniform (0, 200))
+              for i in range (n_queries)]
+    t_radius = timeit (lambda: [index.in_radius (x, y, 0.5) for x, y in points])
+    t_rect = timeit (lambda: [index.in_rect (x, y, x + 2, y + 2)
+                              for x, y in points])
+    t_near = timeit (lambda: [index.nearest (x, y) for x, y in points])
+    record ("spatial_index", t_build)
+    record ("SpatialIndex.in_radius", t_radius / n_queries)
+    record ("SpatialIndex.in_rect", t_rect / n_queries)
+    record ("SpatialIndex.nearest", t_near / n_queries)
+    print ("spatial index: build %.3f s (%d items, %.2f mm cells); per query: "
+           "radius %.1f us, rect %.1f us, nearest %.1f us" % (
+               t_build, len (index._entries), index.cell,
+               t_radius / n_queries * 1e6, t_rect / n_queries * 1e6,
+               t_near / n_queries * 1e6))
+
+def bench_pads (path, n_queries=1000):
+    """Pad queries through ModuleSexp and the board's indexes, against
+    walking every module's pads"""
+    pcb = kicad_tools.KicadPCB (path)
+    modules = pcb.find_types (kicad_tools.ModuleSexp)
+    vias = pcb.find_types (kicad_tools.ViaSexp)[:n_queries]
+    nets = [pcb.nets[i] for i in sorted (pcb.nets)][1:n_queries + 1]
+
+    def walk ():
+        for net in nets:
+            [p for m in modules for p in kicad_tools.module_pads (m)
+             if p.net == net]
+    t_walk = timeit (walk, repeat=1) / len (nets)
+    t_build = timeit (lambda: pcb.find_pads_on_net (nets[0]), repeat=1)
+    t_net = timeit (lambda: [pcb.find_pads_on_net (i) for i in nets]) / len (nets)
+    pcb.spatial_index ()
+    t_under = timeit (lambda: [pcb.find_pads_under (i) for i in vias]) / len (vias)
+    record ("find_pads_on_net.first", t_build)
+    record ("find_pads_on_net", t_net)
+    record ("find_pads_under", t_under)
+    print ("pads on net: walking modules %.0f us, indexed %.1f us (first %.3f s); "
+           "pads under via %.0f us" % (t_walk * 1e6, t_net * 1e6, t_build,
+                                       t_under * 1e6))
+
+def bench_connectivity (path, n_edits=100):
+    """Connectivity: first full pass over every net, then re-asking after
+    single deletes"""
+    pcb = kicad_tools.KicadPCB (path)
+    pcb.spatial_index ()
+    conn = pcb.connectivity ()
+    t_build = timeit (conn.split_nets, repeat=1)
+    n_dangling = len (conn.dangling ())
+    segments = pcb.find_types (kicad_tools.SegmentSexp)[:n_edits]
+
+    def edits ():
+        for seg in segments:
+            pcb.delete (seg)
+            conn.islands (seg.get_value ("net"))
+    t_edit = timeit (edits, repeat=1) / len (segments)
+    record ("Connectivity.split_nets", t_build)
+    record ("Connectivity.delete_and_islands", t_edit)
+    print ("connectivity: all nets %.3f s (%d dangling ends), "
+           "delete and re-ask %.2f ms" % (t_build, n_dangling, t_edit * 1e3))
+
+def bench_columns (path):
+    """Whole-board via and track edits through TrackArrays"""
+    import numpy
+    pcb = kicad_tools.KicadPCB (path)
+    t0 = time.perf_counter ()
+    arrays = pcb.export_tracks ()
+    t1 = time.perf_counter ()
+    power = numpy.isin (arrays.via_net, arrays.net_ids (["/SIG1", "/SIG2"]))
+    min_size = arrays.via_drill + 2 * 0.15
+    arrays.via_size[power] = numpy.maximum (arrays.via_size, min_size)[power]
+    arrays.seg_width[arrays.seg_layer == arrays.layer_code ("In1.Cu")] = 0.3
+    t2 = time.perf_counter ()
+    n = pcb.import_tracks (arrays)
+    t3 = time.perf_counter ()
+    record ("export_tracks", t1 - t0)
+    record ("import_tracks", t3 - t2)
+    print ("track arrays: export %.3f s, edit %.2f ms, import %.3f s (%d items)"
+           % (t1 - t0, (t2 - t1) * 1e3, t3 - t2, n))
+
+def bench_queries (path):
+    """The plain KicadPCB lookups and edits"""
+    pcb = kicad_tools.KicadPCB (path)
+    segs = pcb.find_types (kicad_tools.SegmentSexp)
+    nets = [pcb.nets[i] for i in sorted (pcb.nets)][1:101]
+
+    def each (fn, n=100):
+        return timeit (lambda: [fn () for i in range (n)]) / n
+
+    times = [
+        ("find_types", each (lambda: pcb.find_types (kicad_tools.SegmentSexp))),
+        ("view_types", each (lambda: pcb.view_types (kicad_tools.SegmentSexp))),
+        ("find_keyword", each (lambda: pcb.find_keyword ("via"))),
+        ("find_on_net", timeit (
+            lambda: [pcb.find_on_net (i) for i in nets]) / len (nets)),
+        ("copper_layers", each (lambda: pcb.copper_layers)),
+    ]
+    doomed = segs[::10]
+    t0 = time.perf_counter ()
+    pcb.delete_many (doomed)
+    t1 = time.perf_counter ()
+    pcb.extend (doomed)
+    t2 = time.perf_counter ()
+    times += [("delete_many", t1 - t0), ("extend", t2 - t1)]
+    for name, t in times:
+        record (name, t)
+    print ("queries, %d segments: %s" % (len (segs), ", ".join (
+        "%s %.1f us" % (name, t * 1e6) for name, t in times)))
+
+def bench_lib (n_symbols):
+    """kicad_schlib.readfile and writefile on a synthetic library"""
+    import io
+    import shutil
+    text = make_lib (n_symbols)
+    symbols = kicad_schlib.readfile (io.StringIO (text))
+    n_pins = text.count ("\nX ")
+
+    def write ():
+        f = io.StringIO ()
+        kicad_schlib.writefile (f, symbols)
+        return f
+
+    t_read = record ("schlib.readfile",
+                     timeit (lambda: kicad_schlib.readfile (io.StringIO (text))))
+    t_lazy = record ("schlib.readfile.lazy", timeit (
+        lambda: kicad_schlib.readfile (io.StringIO (text), lazy=True)))
+    peak = record ("schlib.readfile.peak", peak_memory (
+        lambda: kicad_schlib.readfile (io.StringIO (text))), "B")
+    size = record ("schlib.size", held_memory (
+        lambda: kicad_schlib.readfile (io.StringIO (text))), "B")
+    # A handful of edits, then everything
+    for i in symbols[::len (symbols) // 10 or 1]:
+        i.footprintField.text = "Package_SO:SOIC-8"
+    t_edited = record ("schlib.writefile.edited", timeit (write))
+    for i in symbols:
+        i.touch ()
+    t_write = record ("schlib.writefile", timeit (write))
+
+    fd, path = tempfile.mkstemp (suffix=".lib")
+    try:
+        with os.fdopen (fd, "w") as f:
+            f.write (text)
+        t_copy = timeit (lambda: shutil.copyfile (path, path + ".copy"))
+        os.unlink (path + ".copy")
+    finally:
+        os.unlink (path)
+    n_lines = text.count ("\n")
+    print ("symbol library, %d symbols, %d pins, %.1f MB: readfile %.3f s "
+           "(%.0f klines/s, peak %.1f MB, holding %.1f MB), lazy %.3f s "
+           "(%.0f klines/s), writefile %.3f s, with ten edits %.3f s, "
+           "file copy %.3f s" % (
+               n_symbols, n_pins, len (text) / 1e6, t_read,
+               n_lines / t_read / 1e3, peak / 1e6, size / 1e6, t_lazy,
+               n_lines / t_lazy / 1e3, t_write, t_edited, t_copy))
+
+    import shlex
+    fields = [i for i in text.split ("\n") if i.startswith ("F")]
+    t_shlex = timeit (lambda: [shlex.split (i) for i in fields])
+    t_split = timeit (lambda: [kicad_schlib._split_field (i) for i in fields])
+    print ("field lines, %d: shlex %.1f us, _split_field %.1f us (%.1fx)" % (
+        len (fields), t_shlex / len (fields) * 1e6,
+        t_split / len (fields) * 1e6, t_shlex / t_split))
+
+def bench_index (n_symbols):
+    """LibraryIndex: scanning a library, loading the saved index, and
+    pulling one symbol out, against reading the whole thing"""
+    import io
+    import shutil
+    directory = tempfile.mkdtemp ()
+    try:
+        path = os.path.join (directory, "bench.lib")
+        with open (path, "w") as f:
+            f.write (make_lib (n_symbols))
+
+        def read ():
+            with open (path) as f:
+                return kicad_schlib.readfile (f)
+        t_read = timeit (read, repeat=1)
+
+        def scan ():
+            kicad_schlib.LibraryIndex (path, persist=False).close ()
+        t_scan = record ("LibraryIndex.scan", timeit (scan))
+        kicad_schlib.LibraryIndex (path).close ()
+
+        def lookup ():
+            with kicad_schlib.LibraryIndex (path) as lib:
+                return lib[name]
+        name = "PART%d-" % (n_symbols // 2)
+        with kicad_schlib.LibraryIndex (path) as lib:
+            name = [i for i in lib if i.startswith (name)][0]
+        t_lookup = record ("LibraryIndex.lookup", timeit (lookup))
+    finally:
+        shutil.rmtree (directory)
+    print ("library index, %d symbols: readfile %.3f s, scan %.3f s, "
+           "open saved index and get one symbol %.2f ms" % (
+               n_symbols, t_read, t_scan, t_lookup * 1e3))
+
+def bench_catalog (n_symbols, n_libraries=8):
+    """load_libraries over a directory of libraries, against reading them
+    one after the other"""
+    import shutil
+    directory = tempfile.mkdtemp ()
+    try:
+        paths = []
+        for i in range (n_libraries):
+            path = os.path.join (directory, "lib%d.lib" % i)
+            with open (path, "w") as f:
+                f.write (make_lib (n_symbols // n_libraries, seed=i))
+            paths.append (path)
+
+        def serial ():
+            for i in paths:
+                with open (i) as f:
+                    kicad_schlib.readfile (f)
+        t_serial = timeit (serial, repeat=1)
+        n = os.cpu_count () or 1
+        t_pool = record ("load_libraries", timeit (
+            lambda: kicad_schlib.load_libraries (directory, processes=n),
+            repeat=1))
+        catalog = kicad_schlib.load_libraries (directory, processes=n)
+        t_get = timeit (lambda: [catalog[i] for i in catalog], repeat=1)
+    finally:
+        shutil.rmtree (directory)
+    print ("load_libraries, %d libraries: readfile one by one %.3f s, "
+           "%d processes %.3f s (%.1fx); parsing every symbol on access %.3f s"
+           % (n_libraries, t_serial, n, t_pool, t_serial / t_pool, t_get))
+
+def bench_database (n_symbols, n_libraries=8):
+    """SymbolDatabase: building it, refreshing with nothing changed and with
+    one library changed, and the query helpers"""
+    import shutil
+    directory = tempfile.mkdtemp ()
+    try:
+        for i in range (n_libraries):
+            with open (os.path.join (directory, "lib%d.lib" % i), "w") as f:
+                f.write (make_lib (n_symbols // n_libraries, seed=i))
+        db = kicad_schlib.SymbolDatabase (os.path.join (directory, "symbols.db"))
+        t_build = record ("SymbolDatabase.build", timeit (
+            lambda: db.refresh (directory), repeat=1))
+        t_noop = record ("SymbolDatabase.refresh", timeit (
+            lambda: db.refresh (directory)))
+        with open (os.path.join (directory, "lib0.lib"), "w") as f:
+            f.write (make_lib (n_symbols // n_libraries, seed=n_libraries))
+        t_one = timeit (lambda: db.refresh (directory), repeat=1)
+        times = [
+            ("with_fp_filter", timeit (lambda: db.with_fp_filter ("SOIC*"))),
+            ("with_pins", timeit (lambda: db.with_pins (100))),
+            ("with_empty_field", timeit (lambda: db.with_empty_field (4))),
+            ("find", timeit (lambda: db.find ("PART3-DIP"))),
+        ]
+        db.close ()
+    finally:
+        shutil.rmtree (directory)
+    for name, t in times:
+        record ("SymbolDatabase." + name, t)
+    print ("symbol database, %d symbols: build %.3f s, refresh unchanged "
+           "%.1f ms, one library changed %.3f s; %s" % (
+               n_symbols, t_build, t_noop * 1e3, t_one, ", ".join (
+                   "%s %.1f ms" % (name, t * 1e3) for name, t in times)))
+
+def bench_variants (n_variants=500, n_pins=200):
+    """Connector-family style variants through KicadSchSymbol.derive,
+    against copy.deepcopy"""
+    import copy
+    import io
+    base = kicad_schlib.readfile (io.StringIO (make_lib (1, n_pins=n_pins)))[0]
+
+    def variants (make):
+        out = []
+        for i in range (n_variants):
+            v = make (base)
+            v.name = "%s-V%d" % (base.name, i)
+            v.footprintField.text = "Connector:Variant_%d" % i
+            out.append (v)
+        return out
+
+    t_copy = timeit (lambda: variants (copy.deepcopy), repeat=1)
+    t_derive = record ("derive", timeit (
+        lambda: variants (kicad_schlib.KicadSchSymbol.derive)))
+    m_copy = held_memory (lambda: variants (copy.deepcopy))
+    m_derive = record ("derive.size", held_memory (
+        lambda: variants (kicad_schlib.KicadSchSymbol.derive)), "B")
+    print ("%d variants of a %d-pin symbol: deepcopy %.3f s, %.1f MB; "
+           "derive %.3f s, %.1f MB" % (n_variants, n_pins, t_copy,
+                                        m_copy / 1e6, t_derive, m_derive / 1e6))
+
+def bench_merge (n_segments, pieces=4):
+    """merge_collinear_segments on a board of tracks cut into pieces"""
+    fd, path = tempfile.mkstemp (suffix=".kicad_pcb")
+    try:
+        with os.fdopen (fd, "w") as f:
+            f.write (make_board (n_segments, pieces=pieces))
+        pcb = kicad_tools.KicadPCB (path)
+    finally:
+        os.unlink (path)
+    n = len (pcb.view_types (kicad_tools.SegmentSexp))
+    t0 = time.perf_counter ()
+    n_chains, n_removed = kicad_tools.merge_collinear_segments (pcb)
+    t = record ("merge_collinear_segments", time.perf_counter () - t0)
+    print ("merge_collinear_segments, %d segments: %d chains, %d removed, "
+           "%.3f s, %.2f us/segment" % (n, n_chains, n_removed, t, t / n * 1e6))
+
+def bench_cleanup (sizes):
+    """remove_stacked_vias against board size; the time per via should stay
+    flat if it scales linearly"""
+    for n in sizes:
+        fd, path = tempfile.mkstemp (suffix=".kicad_pcb")
+        try:
+            with os.fdopen (fd, "w") as f:
+                f.write (make_board (n, n_vias=n))
+            pcb = kicad_tools.KicadPCB (path, lazy=True)
+        finally:
+            os.unlink (path)
+        t0 = time.perf_counter ()
+        n_stacks, n_vias = kicad_tools.remove_stacked_vias (pcb)
+        pcb.children
+        t = record ("remove_stacked_vias.%d" % n, time.perf_counter () - t0)
+        print ("remove_stacked_vias, %d vias (%d removed): %.3f s, %.2f us/via"
+               % (n, n_vias, t, t / n * 1e6))
+
+def bench_write (path):
+    """KicadPCB.write against dumping each child through sexpdata, which is
+    what write did before; pass a larger n_segments for a 100 MB board"""
+    import sexpdata
+    pcb = kicad_tools.KicadPCB (path)
+    size = os.path.getsize (path) / 1e6
+    fd, out = tempfile.mkstemp (suffix=".kicad_pcb")
+    os.close (fd)
+
+    def old ():
+        with open (out, "w") as f:
+            f.write ("(kicad_pcb ")
+            for i in pcb.children:
+                sexpdata.dump (i.out (), f)
+                f.write ("\n")
+            f.write (")")
+
+    try:
+        t_old = timeit (old, repeat=1)
+        t_flat = timeit (lambda: pcb.write (out, reformat=True))
+        t_indent = timeit (lambda: pcb.write (out, indent=True, reformat=True))
+        t_pass = timeit (lambda: pcb.write (out))
+        record ("write.reformat", t_flat)
+        record ("write.indent", t_indent)
+    finally:
+        os.unlink (out)
+    print ("write %.1f MB: sexpdata %.3f s, reformat %.3f s (%.1fx), "
+           "indented %.3f s, passthrough %.3f s" % (
+               size, t_old, t_flat, t_old / t_flat, t_indent, t_pass))
+
+def bench_stream (path):
+    """Peak memory of a width fix through BoardStream against KicadPCB"""
+    import tracemalloc
+
+    def fix (item):
+        if isinstance (item, kicad_tools.SegmentSexp) and item.width == 0.25:
+            item.width = 0.3
+        return item
+
+    fd, out = tempfile.mkstemp (suffix=".kicad_pcb")
+    os.close (fd)
+    try:
+        tracemalloc.start ()
+        pcb = kicad_tools.KicadPCB (path, lazy=True)
+        for i in pcb.children:
+            fix (i)
+        pcb.write (out)
+        del pcb
+        board_peak = tracemalloc.get_traced_memory ()[1]
+        tracemalloc.stop ()
+
+        tracemalloc.start ()
+        kicad_tools.BoardStream (path).write (out, [fix])
+        stream_peak = tracemalloc.get_traced_memory ()[1]
+        tracemalloc.stop ()
+
+        t_board = timeit (lambda: kicad_tools.KicadPCB (path).write (out),
+                          repeat=1)
+        t_stream = timeit (lambda: kicad_tools.BoardStream (path).write (out),
+                           repeat=1)
+        record ("BoardStream.write", t_stream)
+        record ("BoardStream.write.peak", stream_peak, "B")
+    finally:
+        os.unlink (out)
+    print ("stream: peak memory KicadPCB %.1f MB, BoardStream %.1f MB; "
+           "load+write %.3f s, streamed %.3f s" % (
+               board_peak / 1e6, stream_peak / 1e6, t_board, t_stream))
+
+def bench_batch (path, n_boards=8):
+    """run_batch over copies of one board, serially and on a process pool"""
+    import shutil
+    directory = tempfile.mkdtemp ()
+    try:
+        boards = []
+        for i in range (n_boards):
+            board = os.path.join (directory, "board%d.kicad_pcb" % i)
+            shutil.copy (path, board)
+            boards.append ((board, board + ".out"))
+        passes = [kicad_tools.remove_stacked_vias]
+        t_serial = timeit (
+            lambda: kicad_tools.run_batch (boards, passes, processes=1),
+            repeat=1)
+        n = os.cpu_count () or 1
+        t_pool = timeit (
+            lambda: kicad_tools.run_batch (boards, passes, processes=n),
+            repeat=1)
+        record ("run_batch", t_pool)
+    finally:
+        shutil.rmtree (directory)
+    print ("run_batch, %d boards: serial %.3f s, %d processes %.3f s (%.1fx)"
+           % (n_boards, t_serial, n, t_pool, t_serial / t_pool))
+
+def main ():
+    import argparse
+    parser = argparse.ArgumentParser (description="Benchmark kicad_tools and kicad_schlib")
+    parser.add_argument ("n_segments", type=int, nargs="?", default=20000)
+    parser.add_argument ("--symbols", type=int, default=2000,
+                         help="symbols in the synthetic library")
+    parser.add_argument ("--json", help="save the results here")
+    parser.add_argument ("--baseline", help="compare against these results")
+    parser.add_argument ("--tolerance", type=float, default=0.25,
+                         help="fraction worse than baseline that is allowed")
+    args = parser.parse_args ()
+
+    n = args.n_segments
+    text = make_board (n)
+    bench_parse (text)
+    bench_zones ()
+
+    fd, path = tempfile.mkstemp (suffix=".kicad_pcb")
+    try:
+        with os.fdopen (fd, "w") as f:
+            f.write (text)
+        bench_load (path)
+        bench_cache (path)
+        bench_access (path)
+        bench_spatial (path)
+        bench_pads (path)
+        bench_connectivity (path)
+        bench_queries (path)
+        bench_columns (path)
+        bench_write (path)
+        bench_stream (path)
+        bench_batch (path)
+    finally:
+        os.unlink (path)
+
+    bench_cleanup ([n // 4, n // 2, n])
+    bench_merge (n)
+    bench_lib (args.symbols)
+    bench_index (args.symbols)
+    bench_catalog (args.symbols)
+    bench_database (args.symbols)
+    bench_variants ()
+
+    if args.json:
+        save_results (args.json, n_segments=n, symbols=args.symbols)
+    if args.baseline:
+        print ("against %s:" % args.baseline)
+        worse = compare (args.baseline, args.tolerance)
+        if worse:
+            print ("%d results worse than baseline" % len (worse))
+            sys.exit (1)
+
+if __name__ == '__main__':
+    main ()
@@ -4,8 +4,29 @@ This can load a KiCad schematic library so that it can be manipulated as a
 set of objects and re-exported.
 """
 
+import array
+import collections.abc
+import concurrent.futures
+import contextlib
+import copy
+import fnmatch
+import gc
+import hashlib
+import io
+import mmap
+import numbers
+import operator
+import os
 import re
 import shlex
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import traceback
+
+import kicad_stats
 
 FILL_FG = 1
 FILL_BG = -1
@@ -44,104 +65,422 @@ PIN_LOWOUT = "V"
 PIN_FALLING = "F"
 PIN_NONLOGIC = "NX"
 
-def readfile (f):
-    """Read in a file, returning a list of symbol objects."""
+def readfile (f, lazy=False):
+    """Read in a file, returning a list of symbol objects.
+
+    With lazy=True, each symbol's graphics and pins are only located, not
+    parsed; they're parsed the first time they're needed. Errors in them
+    only show up then, too.
+    """
+    stats = kicad_stats.active
+    if stats is not None:
+        return _readfile_counted (f, stats, lazy)
     objects = []
-    while True:
-        obj = KicadSchSymbol.createFromLibFile (f)
-        if obj is None:
-            break
-        objects.append (obj)
+    with _gc_paused ():
+        while True:
+            obj = KicadSchSymbol.createFromLibFile (f, lazy=lazy)
+            if obj is None:
+                break
+            objects.append (obj)
     return objects
 
+@contextlib.contextmanager
+def _gc_paused ():
+    """A library is a few hundred thousand little objects, none of which
+    refer back to each other; without this the cyclic GC keeps stopping to
+    look through all of them."""
+    was_enabled = gc.isenabled ()
+    gc.disable ()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable ()
+
 def writefile (f, objects):
     """Write a list of objects out to a file."""
-    f.write ("EESchema-LIBRARY Version 2.3\n")
-    f.write ("#encoding utf-8\n")
-    for i in objects:
-        i.writeOut (f)
-    f.write ("#\n")
-    f.write ("#End Library\n")
+    stats = kicad_stats.active
+    if stats is not None:
+        f = _CountedWriter (f)
+    with kicad_stats.phase ("schlib.writefile"):
+        out = ["EESchema-LIBRARY Version 2.3\n#encoding utf-8\n"]
+        for i in objects:
+            text = getattr (i, "_text", None)
+            if text is None:
+                # Anything else that knows how to write itself
+                buf = io.StringIO ()
+                i.writeOut (buf)
+                out.append (buf.getvalue ())
+            else:
+                out.append (text ())
+            # Write in big lumps rather than many little writes
+            if len (out) >= 1024:
+                f.write ("".join (out))
+                del out[:]
+        out.append ("#\n#End Library\n")
+        f.write ("".join (out))
+    if stats is not None:
+        stats.written (getattr (f.f, "name", "<stream>"), f.n)
+        stats.count ("schlib.symbols_written", len (objects))
+
+# With kicad_stats collecting, readfile goes through here instead. Each record
+# constructor is timed under its class name ("schlib.Pin" etc, with the
+# number of calls being the number of records), so readfile's time less those
+# is what went on reading and dispatching lines. Characters are counted as
+# bytes read; they're the same thing for the ASCII KiCad writes.
+
+def _readfile_counted (f, stats, lazy):
+    records = dict ((k, _timed_record (v, stats)) for k, v in _RECORDS.items ())
+    name = getattr (f, "name", "<stream>")
+    lines = _counted_lines (f, stats, name)
+    objects = []
+    with stats.phase ("schlib.readfile"), _gc_paused ():
+        while True:
+            obj = KicadSchSymbol.createFromLibFile (lines, records, lazy)
+            if obj is None:
+                break
+            objects.append (obj)
+    stats.count ("schlib.symbols", len (objects))
+    return objects
+
+def _counted_lines (f, stats, name):
+    n = 0
+    try:
+        for line in f:
+            n += len (line)
+            yield line
+    finally:
+        stats.read (name, n)
+
+def _timed_record (cls, stats):
+    name = "schlib." + cls.__name__
+    def make (line):
+        t0 = time.perf_counter ()
+        obj = cls (line)
+        stats.add_time (name, time.perf_counter () - t0)
+        return obj
+    return make
+
+class _CountedWriter (object):
+    def __init__ (self, f):
+        self.f = f
+        self.n = 0
 
+    def write (self, s):
+        self.n += len (s)
+        return self.f.write (s)
+
+
+def _part (name):
+    """A symbol attribute. Whatever it holds can be changed in place once
+    it's been handed out, so the first time it is, the symbol takes a
+    snapshot of how it serializes, to tell later whether anything really
+    changed. If it's shared with a variant, it gets copied first. Setting
+    it marks the symbol modified."""
+    key = "_" + name
+    def get (self):
+        part = self._own (name)
+        if name not in self._exposed:
+            self._exposed = self._exposed | {name}
+        if self._source is not None:
+            pristine = self._pristine
+            if pristine is None:
+                pristine = self._pristine = {}
+            if name not in pristine:
+                pristine[name] = _snapshot (part)
+        return part
+    def set (self, v):
+        self._drop_source ()
+        self._shared.discard (name)
+        self._exposed = self._exposed | {name}
+        self.__dict__[key] = v
+    return property (get, set)
+
+def _snapshot (part):
+    """How a part serializes, to compare with later"""
+    if part is None:
+        return None
+    if isinstance (part, list):
+        return tuple (i if isinstance (i, str) else i._line () for i in part)
+    return part._line ()
+
+_PARTS = ("definition", "referenceField", "valueField", "footprintField",
+          "otherFields", "footprintFilters", "aliases", "graphics", "pins")
 
 class KicadSchSymbol (object):
     """This represents a full schematic symbol. It contains a set of elements
     which can be manipulated.
 
     There is nothing else in a library file, so a file is just a list of these.
+
+    A symbol read from a file remembers its text, and is written back out as
+    that text until it's modified. Getting at any of its parts (definition,
+    the fields, pins...) doesn't count by itself, but from then on those
+    parts are serialized on every write (and every look at modified) to see
+    whether they changed; only a symbol whose parts all still serialize as
+    they did is passed through.
     """
 
+    definition = _part ("definition")
+    referenceField = _part ("referenceField")
+    valueField = _part ("valueField")
+    footprintField = _part ("footprintField")
+    otherFields = _part ("otherFields")
+    footprintFilters = _part ("footprintFilters")
+    aliases = _part ("aliases")
+    graphics = _part ("graphics")
+    pins = _part ("pins")
+
     def __init__ (self):
-        self.definition = None
-        self.referenceField = None
-        self.valueField = None
-        self.footprintField = None
-        self.otherFields = []
+        self._definition = None
+        self._referenceField = None
+        self._valueField = None
+        self._footprintField = None
+        self._otherFields = []
+
+        self._footprintFilters = []
+        self._aliases = []
+        self._graphics = []
+        self._pins = []
+
+        # The DEF ... ENDDEF text this was read from; None once modified
+        self._source = None
+        # {part: _snapshot ()} of each part handed out while there's a
+        # source to compare against
+        self._pristine = None
+        # {tag: line} for lines of the source that have been rewritten;
+        # see _patch_source ()
+        self._line_edits = None
+        # (start, end) of the DRAW section in the source, while graphics
+        # and pins are still only text there; see readfile ()
+        self._draw = None
+        # Parts that may be shared with other symbols, and parts that have
+        # been handed out and may be held on to; see derive()
+        self._shared = set ()
+        self._exposed = frozenset ()
+
+    @property
+    def modified (self):
+        return self._source is None or self._changed_body () is not None
+
+    def _changed_body (self):
+        """_body (), if it's no longer what the source holds; else None"""
+        if self._source is not None:
+            if not self._pristine:
+                return None
+            parts = self.__dict__
+            if all (_snapshot (parts["_" + k]) == v
+                    for k, v in self._pristine.items ()):
+                return None
+            self._drop_source ()
+        return self._body ()
 
-        self.footprintFilters = []
-        self.aliases = []
-        self.graphics = []
-        self.pins = []
+    def touch (self):
+        """Mark the symbol modified, so it gets re-serialized on write"""
+        self._drop_source ()
+
+    def _drop_source (self):
+        self._decode ()
+        self._source = self._pristine = None
+
+    def _decode (self):
+        """Parse the graphics and pins, if they were left as text"""
+        draw = self._draw
+        if draw is None:
+            return
+        graphics = []
+        pins = []
+        table = _draw_table (graphics.append, pins.append, _RECORDS)
+        for line in self._source[draw[0]:draw[1]].split ("\n"):
+            if "#" in line:
+                line = line.partition ("#")[0]
+            line = line.strip ()
+            if not line:
+                continue
+            tag, sep, rest = line.partition (" ")
+            target = table.get (tag) if sep else None
+            if target is None:
+                raise ValueError ("cannot interpret line: " + line)
+            add, make = target
+            add (make (line))
+        self._draw = None
+        self._graphics = graphics
+        self._pins = pins
+        # Fresh, so nothing else has them
+        self._shared.difference_update (("graphics", "pins"))
+
+    def _own (self, name):
+        """A part of this symbol, first copied if it's shared"""
+        if self._draw is not None:
+            self._decode ()
+        key = "_" + name
+        if name in self._shared:
+            self.__dict__[key] = copy.deepcopy (self.__dict__[key])
+            self._shared.discard (name)
+        return self.__dict__[key]
+
+    def derive (self, name=None):
+        """Return a variant of this symbol. The two share all their parts
+        (pins, graphics, fields...) until one of them gets at a part, at
+        which point it gets a copy of its own, even if it only meant to
+        read it; so nothing done to one ever shows up in the other, but a
+        variant that only changes its name and footprint costs next to
+        nothing. name, if given, is set on the variant. Renaming keeps the
+        source text, so an untouched variant is still written through.
+
+        Parts of this symbol that were handed out before derive () may
+        still be held on to (refs = sym.pins), and changed through that;
+        those the variant copies right away instead of sharing them.
+        """
+        variant = KicadSchSymbol.__new__ (KicadSchSymbol)
+        variant.__dict__.update (self.__dict__)
+        if self._pristine is not None:
+            variant._pristine = dict (self._pristine)
+        for i in self._exposed:
+            variant.__dict__["_" + i] = copy.deepcopy (self.__dict__["_" + i])
+        shared = set (_PARTS) - self._exposed
+        self._shared |= shared
+        variant._shared = shared
+        variant._exposed = frozenset ()
+        if name is not None:
+            variant.name = name
+        return variant
+
+    def _patch_source (self, records):
+        """Rewrite the lines of the given parts, {tag: part name}, in the
+        source text, so that a change to just those doesn't cost the
+        passthrough. The source itself may be shared with variants, so the
+        new lines are kept aside and put in on write."""
+        if self._source is None:
+            return
+        parts = self.__dict__
+        edits = dict (self._line_edits or ())
+        for tag, name in records.items ():
+            edits[tag] = parts["_" + name]._line ()
+        self._line_edits = edits
+        pristine = self._pristine
+        if pristine is not None:
+            # The source now says what they say
+            for name in records.values ():
+                if name in pristine:
+                    pristine[name] = _snapshot (parts["_" + name])
+
+    def _text (self):
+        """The symbol as it goes in a file"""
+        header = "#\n# %s\n#\n" % self._definition.name
+        body = self._changed_body ()
+        if body is not None:
+            return header + body
+        source = self._source
+        if self._line_edits:
+            source = _replace_lines (source, self._line_edits)
+            if source is None:
+                return header + self._body ()
+        if not source.endswith ("\n"):
+            source += "\n"
+        return header + source
+
+    def _body (self):
+        """The symbol serialized from its parts, DEF to ENDDEF"""
+        self._decode ()
+        out = [self._definition._line (), self._referenceField._line (),
+               self._valueField._line (), self._footprintField._line ()]
+        out.extend (i._line () for i in self._otherFields)
+        if self._aliases:
+            out.append ("ALIAS %s\n" % " ".join (self._aliases))
+        if self._footprintFilters:
+            out.append ("$FPLIST\n %s\n$ENDFPLIST\n"
+                        % " ".join (self._footprintFilters))
+        out.append ("DRAW\n")
+        out.extend (i._line () for i in self._graphics)
+        out.extend (i._line () for i in self._pins)
+        out.append ("ENDDRAW\nENDDEF\n")
+        return "".join (out)
 
     def writeOut (self, f):
         """Write the symbol into a file"""
-        f.write ("#\n")
-        f.write ("# %s\n" % self.definition.name)
-        f.write ("#\n")
-        self.definition.writeOut (f)
-        self.referenceField.writeOut (f)
-        self.valueField.writeOut (f)
-        self.footprintField.writeOut (f)
-        for i in self.otherFields:
-            i.writeOut (f)
-        if self.aliases:
-            f.write ("ALIAS ")
-            f.write (" ".join (self.aliases))
-            f.write ("\n")
-        if self.footprintFilters:
-            f.write ("$FPLIST\n ")
-            f.write (" ".join (self.footprintFilters))
-            f.write ("\n$ENDFPLIST\n")
-        f.write ("DRAW\n")
-        for i in self.graphics:
-            i.writeOut (f)
-        for i in self.pins:
-            i.writeOut (f)
-        f.write ("ENDDRAW\n")
-        f.write ("ENDDEF\n")
+        f.write (self._text ())
 
     @classmethod
-    def createFromLibFile (cls, f):
+    def createFromLibFile (cls, f, records=None, lazy=False):
         """Create a KicadSchSymbol from a library file. Creates just one;
         returns None at EOF.
+
+        records maps line types to what builds them, in place of the record
+        classes; see _RECORDS. lazy is as for readfile ().
         """
+        if records is None:
+            records = _RECORDS
         newobj = cls ()
+        draw = _draw_table (newobj._graphics.append, newobj._pins.append,
+                            records)
+        field = records["F"]
 
         state = "root"
+        source = None
 
-        for line in f:
-            line = line.partition ("#")[0].strip ()
+        for raw in f:
+            if source is not None:
+                source.append (raw)
+            if state == "skip" and "END" not in raw:
+                continue
+            line = raw
+            if "#" in line:
+                line = line.partition ("#")[0]
+            line = line.strip ()
             if not line:
                 continue
-            if state == "root":
-                if line.startswith ("DEF "):
-                    newobj.definition = Definition (line)
-                elif line.startswith ("F0 "):
-                    newobj.referenceField = Field (line)
-                elif line.startswith ("F1 "):
-                    newobj.valueField = Field (line)
-                elif line.startswith ("F2 "):
-                    newobj.footprintField = Field (line)
-                elif re.match (r"F\d+ ", line):
-                    newobj.otherFields.append (Field (line))
-                elif line.startswith ("ALIAS "):
-                    newobj.aliases.extend (line.split ()[1:])
-                elif line == "$FPLIST":
-                    state = "fplist"
-                elif line == "DRAW":
-                    state = "draw"
+            tag, sep, rest = line.partition (" ")
+            if state == "draw":
+                target = draw.get (tag) if sep else None
+                if target is not None:
+                    add, make = target
+                    add (make (line))
+                elif line == "ENDDRAW":
+                    state = "root"
+                else:
+                    raise ValueError ("cannot interpret line: " + line)
+
+            elif state == "skip":
+                if line == "ENDDRAW":
+                    newobj._draw = (start, sum (map (len, source[:-1])))
+                    state = "root"
                 elif line == "ENDDEF":
-                    return newobj
+                    # Same as an eager read; the symbol can't end in DRAW
+                    raise ValueError ("cannot interpret line: " + line)
+
+            elif state == "root":
+                if not sep:
+                    if line == "$FPLIST":
+                        state = "fplist"
+                    elif line == "DRAW":
+                        if lazy and source is not None:
+                            state = "skip"
+                            start = sum (map (len, source))
+                        else:
+                            state = "draw"
+                    elif line == "ENDDEF":
+                        if source is not None:
+                            newobj._source = "".join (source)
+                        return newobj
+                    elif line.startswith ("EESchema-LIBRARY"):
+                        continue
+                    else:
+                        raise ValueError ("cannot interpret line: " + line)
+                elif tag == "DEF":
+                    newobj._definition = records["DEF"] (line)
+                    if source is None:
+                        source = [raw]
+                elif tag == "F0":
+                    newobj._referenceField = field (line)
+                elif tag == "F1":
+                    newobj._valueField = field (line)
+                elif tag == "F2":
+                    newobj._footprintField = field (line)
+                elif tag[:1] == "F" and tag[1:].isdecimal ():
+                    newobj._otherFields.append (field (line))
+                elif tag == "ALIAS":
+                    newobj._aliases.extend (rest.split ())
                 elif line.startswith ("EESchema-LIBRARY"):
                     continue
                 else:
@@ -151,273 +490,1013 @@ class KicadSchSymbol (object):
                 if line == "$ENDFPLIST":
                     state = "root"
                 else:
-                    newobj.footprintFilters.extend (i.strip () for i in line.split ())
-
-            elif state == "draw":
-                if line.startswith ("A "):
-                    newobj.graphics.append (Arc (line))
-                elif line.startswith ("C "):
-                    newobj.graphics.append (Circle (line))
-                elif line.startswith ("P "):
-                    newobj.graphics.append (Polyline (line))
-                elif line.startswith ("S "):
-                    newobj.graphics.append (Rectangle (line))
-                elif line.startswith ("T "):
-                    newobj.graphics.append (Text (line))
-                elif line.startswith ("X "):
-                    newobj.pins.append (Pin (line))
-                elif line == "ENDDRAW":
-                    state = "root"
-                else:
-                    raise ValueError ("cannot interpret line: " + line)
+                    newobj._footprintFilters.extend (line.split ())
 
     # KiCad has some horrid data duplication that means a few things must be
     # edited in multiple places. Use these properties whenever you can to fix
     # that.
     @property
     def name (self):
-        return self.definition.name
+        return self._definition.name
     @name.setter
     def name (self, v):
-        self.definition.name = v
-        self.valueField.text = v
+        self._own ("definition").name = v
+        self._own ("valueField").text = v
+        self._patch_source ({"DEF": "definition", "F1": "valueField"})
 
     @property
     def reference (self):
-        return self.definition.reference
+        return self._definition.reference
     @reference.setter
     def reference (self, v):
-        self.definition.reference = v
-        self.referenceField.text = v
+        self._own ("definition").reference = v
+        self._own ("referenceField").text = v
+        self._patch_source ({"DEF": "definition", "F0": "referenceField"})
+
+def _replace_lines (text, lines):
+    """text with the line starting with each tag in lines replaced by the
+    line given; None if one of them isn't there"""
+    out = text.splitlines (True)
+    left = dict (lines)
+    for n, line in enumerate (out):
+        tag = line.split (None, 1)[:1]
+        if tag and tag[0] in left:
+            out[n] = left.pop (tag[0])
+    if left:
+        return None
+    return "".join (out)
+
 
+# Field lines are the only ones with quoted strings in them. shlex gets them
+# right but it goes a character at a time; the usual plain field line is
+# matched whole here instead, and anything with escapes, single quotes or
+# otherwise odd quoting still goes to shlex so it comes out the same.
+_FIELD_RE = re.compile (r'(F\d+)\s+"([^"\\]*)"((?:\s+[^\s"\'\\]+)*)'
+                        r'(?:\s+"([^"\\]*)")?\s*\Z')
+
+def _split_field (line):
+    m = _FIELD_RE.match (line)
+    if m is None or "'" in line or "\\" in line:
+        return shlex.split (line)
+    num, text, rest, name = m.groups ()
+    parts = [num, text]
+    parts.extend (rest.split ())
+    if name is not None:
+        parts.append (name)
+    return parts
+
+class _IntTable (dict):
+    """Maps number text to its int. Libraries use the same few coordinates
+    and sizes over and over, and looking them up beats int() by a mile."""
+    def __missing__ (self, key):
+        if len (self) > 65536:
+            self.clear ()
+        value = self[key] = int (key)
+        return value
+
+_ints = _IntTable ()
 
 class Definition (object):
+    __slots__ = ("name", "reference", "text_offset", "draw_numbers", "draw_names",
+                 "unit_count", "units_locked", "is_power")
+
     def __init__ (self, line):
         line = line.split ()
+        ints = _ints
         self.name = line[1]
-        self.reference = line[2]
-        self.text_offset = int (line[4])
+        self.reference = sys.intern (line[2])
+        self.text_offset = ints[line[4]]
         self.draw_numbers = bool (line[5] == "Y")
         self.draw_names = bool (line[6] == "Y")
-        self.unit_count = int (line[7])
+        self.unit_count = ints[line[7]]
         self.units_locked = bool (line[8] == "L")
         self.is_power = bool (line[9] == "P")
 
+    def _line (self):
+        return "DEF %s %s 0 %s %s %s %s %s %s\n" % (
+            self.name, self.reference, self.text_offset,
+            ("Y" if self.draw_numbers else "N"),
+            ("Y" if self.draw_names else "N"),
+            self.unit_count,
+            ("L" if self.units_locked else "F"),
+            ("P" if self.is_power else "N"))
+
     def writeOut (self, f):
-        line = "DEF {name} {ref} 0 {toff} {dnums} {dnames} {units} {locked} {power}\n"
-        f.write (line.format (
-            name = self.name,
-            ref = self.reference,
-            toff = self.text_offset,
-            dnums = ("Y" if self.draw_numbers else "N"),
-            dnames = ("Y" if self.draw_names else "N"),
-            units = self.unit_count,
-            locked = ("L" if self.units_locked else "F"),
-            power = ("P" if self.is_power else "N")))
+        f.write (self._line ())
 
 class Field (object):
+    __slots__ = ("num", "text", "posx", "posy", "size", "vertical", "visible",
+                 "horiz_just", "vert_just")
+
     def __init__ (self, line):
-        line = shlex.split (line)
+        line = _split_field (line)
+        ints = _ints
         self.num = int (line[0][1:])
         self.text = line[1]
-        self.posx = int (line[2])
-        self.posy = int (line[3])
-        self.size = int (line[4])
+        self.posx = ints[line[2]]
+        self.posy = ints[line[3]]
+        self.size = ints[line[4]]
         self.vertical = bool (line[5] == "V")
         self.visible = bool (line[6] == "V")
-        self.horiz_just = line[7] # L R or C
-        self.vert_just = line[8] # L R or C
+        self.horiz_just = sys.intern (line[7]) # L R or C
+        self.vert_just = sys.intern (line[8]) # L R or C
+
+    def _line (self):
+        return "F%s \"%s\" %s %s %s %s %s %s %s\n" % (
+            self.num, self.text, self.posx, self.posy, self.size,
+            ("V" if self.vertical else "H"),
+            ("V" if self.visible else "I"),
+            self.horiz_just, self.vert_just)
 
     def writeOut (self, f):
-        line = "F{num} \"{text}\" {posx} {posy} {size} {orient} {visible} {hjust} {vjust}\n"
-        f.write (line.format (
-            num = self.num,
-            text = self.text,
-            posx = self.posx,
-            posy = self.posy,
-            size = self.size,
-            orient = ("V" if self.vertical else "H"),
-            visible = ("V" if self.visible else "I"),
-            hjust = self.horiz_just,
-            vjust = self.vert_just))
+        f.write (self._line ())
 
 class Arc (object):
+    __slots__ = ("posx", "posy", "radius", "start_angle", "end_angle", "unit",
+                 "convert", "thickness", "fill", "startx", "starty", "endx",
+                 "endy")
+
     def __init__ (self, line):
         line = line.split ()
-        self.posx = int(line[1])
-        self.posy = int(line[2])
-        self.radius = int(line[3])
-        self.start_angle = int(line[4])
-        self.end_angle = int(line[5])
-        self.unit = int(line[6])
-        self.convert = int(line[7])
-        self.thickness = int(line[8])
+        ints = _ints
+        self.posx = ints[line[1]]
+        self.posy = ints[line[2]]
+        self.radius = ints[line[3]]
+        self.start_angle = ints[line[4]]
+        self.end_angle = ints[line[5]]
+        self.unit = ints[line[6]]
+        self.convert = ints[line[7]]
+        self.thickness = ints[line[8]]
         self.fill = KICAD_TO_FILL[line[9]]
-        self.startx = int(line[10])
-        self.starty = int(line[11])
-        self.endx = int(line[12])
-        self.endy = int(line[13])
+        self.startx = ints[line[10]]
+        self.starty = ints[line[11]]
+        self.endx = ints[line[12]]
+        self.endy = ints[line[13]]
+
+    def _line (self):
+        return "A %s %s %s %s %s %s %s %s %s %s %s %s %s\n" % (
+            self.posx, self.posy, self.radius, self.start_angle,
+            self.end_angle, self.unit, self.convert, self.thickness,
+            FILL_TO_KICAD[self.fill], self.startx, self.starty, self.endx,
+            self.endy)
 
     def writeOut (self, f):
-        line = "A {posx} {posy} {radius} {sangle} {eangle} {unit} {conv} {thick} {fill} {sx} {sy} {ex} {ey}\n"
-        f.write (line.format (
-            posx = self.posx,
-            posy = self.posy,
-            radius = self.radius,
-            sangle = self.start_angle,
-            eangle = self.end_angle,
-            unit = self.unit,
-            conv = self.convert,
-            thick = self.thickness,
-            fill = FILL_TO_KICAD[self.fill],
-            sx = self.startx,
-            sy = self.starty,
-            ex = self.endx,
-            ey = self.endy))
+        f.write (self._line ())
 
 class Circle (object):
+    __slots__ = ("posx", "posy", "radius", "unit", "convert", "thickness", "fill")
+
     def __init__ (self, line):
         line = line.split ()
-        self.posx = int (line[1])
-        self.posy = int (line[2])
-        self.radius = int (line[3])
-        self.unit = int (line[4])
-        self.convert = int (line[5])
-        self.thickness = int (line[6])
+        ints = _ints
+        self.posx = ints[line[1]]
+        self.posy = ints[line[2]]
+        self.radius = ints[line[3]]
+        self.unit = ints[line[4]]
+        self.convert = ints[line[5]]
+        self.thickness = ints[line[6]]
         self.fill = KICAD_TO_FILL[line[7]]
 
+    def _line (self):
+        return "C %s %s %s %s %s %s %s\n" % (
+            self.posx, self.posy, self.radius, self.unit, self.convert,
+            self.thickness, FILL_TO_KICAD[self.fill])
+
     def writeOut (self, f):
-        line = "C {posx} {posy} {radius} {unit} {convert} {thickness} {fill}\n"
-        f.write (line.format (
-            posx = self.posx,
-            posy = self.posy,
-            radius = self.radius,
-            unit = self.unit,
-            convert = self.convert,
-            thickness = self.thickness,
-            fill = FILL_TO_KICAD[self.fill]))
+        f.write (self._line ())
+
+def _coord (v):
+    """A point coordinate as the whole number of mils the file holds"""
+    try:
+        return operator.index (v)
+    except TypeError:
+        pass
+    if isinstance (v, numbers.Real):
+        return int (round (v))
+    raise TypeError ("point coordinates must be numbers, not %s"
+                     % type (v).__name__)
+
+class PointArray (collections.abc.MutableSequence):
+    """A list of (x, y) points, kept packed in an array rather than as a
+    tuple per point. Indexing gives tuples, and it takes any pairs.
+    Coordinates are whole mils, like in the file; floats are rounded."""
+    __slots__ = ("coords",)
+
+    def __init__ (self, points=()):
+        self.coords = array.array ("q")
+        for x, y in points:
+            self.coords.append (_coord (x))
+            self.coords.append (_coord (y))
+
+    def __len__ (self):
+        return len (self.coords) // 2
+
+    def _index (self, i):
+        n = len (self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError ("point index out of range")
+        return 2 * i
+
+    def __getitem__ (self, i):
+        if isinstance (i, slice):
+            return [self[j] for j in range (*i.indices (len (self)))]
+        i = self._index (i)
+        return (self.coords[i], self.coords[i + 1])
+
+    def __setitem__ (self, i, v):
+        if isinstance (i, slice):
+            points = list (self)
+            points[i] = v
+            self.coords = PointArray (points).coords
+        else:
+            x, y = v
+            i = self._index (i)
+            self.coords[i:i + 2] = array.array ("q", (_coord (x), _coord (y)))
+
+    def __delitem__ (self, i):
+        if isinstance (i, slice):
+            points = list (self)
+            del points[i]
+            self.coords = PointArray (points).coords
+        else:
+            i = self._index (i)
+            del self.coords[i:i + 2]
+
+    def __iter__ (self):
+        coords = self.coords
+        return zip (coords[::2], coords[1::2])
+
+    def insert (self, i, v):
+        x, y = v
+        n = len (self)
+        i = min (max (i + n if i < 0 else i, 0), n)
+        self.coords[2 * i:2 * i] = array.array ("q", (_coord (x), _coord (y)))
+
+    def __eq__ (self, other):
+        if isinstance (other, PointArray):
+            return self.coords == other.coords
+        return list (self) == list (other)
+
+    __hash__ = None
+
+    def __repr__ (self):
+        return "PointArray (%r)" % list (self)
 
 class Polyline (object):
+    __slots__ = ("unit", "convert", "thickness", "fill", "_points")
+
     def __init__ (self, line):
         line = line.split ()
-        self.unit = int (line[2])
-        self.convert = int (line[3])
-        self.thickness = int(line[4])
+        ints = _ints
+        self.unit = ints[line[2]]
+        self.convert = ints[line[3]]
+        self.thickness = ints[line[4]]
         self.fill = KICAD_TO_FILL[line[-1]]
-        
-        points = [int(i) for i in line[5:-1]]
+
+        points = line[5:-1]
         # Pairwise (x y) (x y)
-        self.points = list (zip (points[::2], points[1::2]))
+        self._points = PointArray.__new__ (PointArray)
+        self._points.coords = array.array (
+            "q", [ints[i] for i in points[:len (points) & ~1]])
+
+    @property
+    def points (self):
+        return self._points
+    @points.setter
+    def points (self, v):
+        self._points = PointArray (v)
+
+    def _line (self):
+        return "P %s %s %s %s %s %s\n" % (
+            len (self.points), self.unit, self.convert, self.thickness,
+            " ".join (" %d %d" % i for i in self.points),
+            FILL_TO_KICAD[self.fill])
 
     def writeOut (self, f):
-        line = "P {npoints} {unit} {convert} {thickness} {points} {fill}\n"
-        f.write (line.format (
-            npoints = len (self.points),
-            unit = self.unit,
-            convert = self.convert,
-            thickness = self.thickness,
-            fill = FILL_TO_KICAD[self.fill],
-            points = " ".join(" %d %d" % i for i in self.points)))
+        f.write (self._line ())
 
 class Rectangle (object):
+    __slots__ = ("startx", "starty", "endx", "endy", "unit", "convert",
+                 "thickness", "fill")
+
     def __init__ (self, line):
         line = line.split ()
-        self.startx = int (line[1])
-        self.starty = int (line[2])
-        self.endx = int (line[3])
-        self.endy = int (line[4])
-        self.unit = int (line[5])
-        self.convert = int (line[6])
-        self.thickness = int (line[7])
+        ints = _ints
+        self.startx = ints[line[1]]
+        self.starty = ints[line[2]]
+        self.endx = ints[line[3]]
+        self.endy = ints[line[4]]
+        self.unit = ints[line[5]]
+        self.convert = ints[line[6]]
+        self.thickness = ints[line[7]]
         self.fill = KICAD_TO_FILL[line[8]]
 
+    def _line (self):
+        return "S %s %s %s %s %s %s %s %s\n" % (
+            self.startx, self.starty, self.endx, self.endy, self.unit,
+            self.convert, self.thickness, FILL_TO_KICAD[self.fill])
+
     def writeOut (self, f):
-        line = "S {startx} {starty} {endx} {endy} {unit} {convert} {thickness} {fill}\n"
-
-        f.write (line.format (
-            startx = self.startx,
-            starty = self.starty,
-            endx = self.endx,
-            endy = self.endy,
-            unit = self.unit,
-            convert = self.convert,
-            thickness = self.thickness,
-            fill = self.fill))
+        f.write (self._line ())
 
 class Text (object):
+    __slots__ = ("vertical", "posx", "posy", "size", "unit", "convert", "text",
+                 "italic", "bold", "horiz_just", "vert_just")
+
     def __init__ (self, line):
         line = line.split ()
-        self.vertical = bool (int (line[1]) != 0)
-        self.posx = int (line[2])
-        self.posy = int (line[3])
-        self.size = int (line[4])
+        ints = _ints
+        self.vertical = bool (ints[line[1]] != 0)
+        self.posx = ints[line[2]]
+        self.posy = ints[line[3]]
+        self.size = ints[line[4]]
         # line[5] is text_type. fuckin documentation doesn't even explain this
-        self.unit = int (line[6])
-        self.convert = int (line[7])
+        self.unit = ints[line[6]]
+        self.convert = ints[line[7]]
         self.text = line[8].replace ("~", " ")
         self.italic = bool (line[9] == "Italic")
-        self.bold = bool (int (line[10]))
+        self.bold = bool (ints[line[10]])
         self.horiz_just = line[11]
         self.vert_just = line[12]
 
+    def _line (self):
+        return "T %s %s %s %s 0 %s %s %s  %s %s %s %s\n" % (
+            (900 if self.vertical else 0), self.posx, self.posy, self.size,
+            self.unit, self.convert, self.text.replace (" ", "~"),
+            ("Italic" if self.italic else "Normal"),
+            (1 if self.bold else 0),
+            self.horiz_just, self.vert_just)
+
     def writeOut (self, f):
-        line = "T {vert} {posx} {posy} {size} 0 {unit} {conv} {text}  {italic} {bold} {hjust} {vjust}\n"
-
-        f.write (line.format (
-            vert = (900 if self.vertical else 0),
-            posx = self.posx,
-            posy = self.posy,
-            size = self.size,
-            unit = self.unit,
-            conv = self.convert,
-            text = self.text.replace (" ", "~"),
-            italic = ("Italic" if self.italic else "Normal"),
-            bold = (1 if self.bold else 0),
-            hjust = self.horiz_just,
-            vjust = self.vert_just))
+        f.write (self._line ())
 
 
 class Pin (object):
+    __slots__ = ("name", "num", "posx", "posy", "length", "direction", "name_size",
+                 "num_size", "unit", "convert", "elec_type", "style")
+
     def __init__ (self, line):
         line = line.split ()
-        self.name = line[1]
-        self.num = line[2]
-        self.posx = int (line[3])
-        self.posy = int (line[4])
-        self.length = int (line[5])
-        self.direction = line[6]
-        self.name_size = int (line[7])
-        self.num_size = int (line[8])
-        self.unit = int (line[9])
-        self.convert = int (line[10])
-        self.elec_type = line[11]
+        ints = _ints
+        # Pin names, numbers and types repeat endlessly; share them
+        intern = sys.intern
+        self.name = intern (line[1])
+        self.num = intern (line[2])
+        self.posx = ints[line[3]]
+        self.posy = ints[line[4]]
+        self.length = ints[line[5]]
+        self.direction = intern (line[6])
+        self.name_size = ints[line[7]]
+        self.num_size = ints[line[8]]
+        self.unit = ints[line[9]]
+        self.convert = ints[line[10]]
+        self.elec_type = intern (line[11])
         if len (line) > 12:
-            self.style = line[12]
+            self.style = intern (line[12])
         else:
             self.style = None
 
+    def _line (self):
+        return "X %s %s %s %s %s %s %s %s %s %s %s%s\n" % (
+            self.name, self.num, self.posx, self.posy, self.length,
+            self.direction, self.name_size, self.num_size, self.unit,
+            self.convert, self.elec_type,
+            ("" if self.style is None else (" " + self.style)))
+
     def writeOut (self, f):
-        line = "X {name} {num} {posx} {posy} {length} {direction} {name_size} {num_size} {unit} {convert} {elec_type}{style}\n"
-
-        f.write (line.format (
-            name = self.name,
-            num = self.num,
-            posx = self.posx,
-            posy = self.posy,
-            length = self.length,
-            direction = self.direction,
-            name_size = self.name_size,
-            num_size = self.num_size,
-            unit = self.unit,
-            convert = self.convert,
-            elec_type = self.elec_type,
-            style = ("" if self.style is None else (" " + self.style))))
+        f.write (self._line ())
+
+def _draw_table (graphics, pins, records):
+    """Where each kind of line inside DRAW goes, by its first word: (add,
+    make) for adding make (line) to the graphics or pins"""
+    return {"A": (graphics, records["A"]), "C": (graphics, records["C"]),
+            "P": (graphics, records["P"]), "S": (graphics, records["S"]),
+            "T": (graphics, records["T"]), "X": (pins, records["X"])}
+
+# What createFromLibFile builds each kind of line into
+_RECORDS = {"DEF": Definition, "F": Field, "A": Arc, "C": Circle,
+            "P": Polyline, "S": Rectangle, "T": Text, "X": Pin}
+
+
+# A saved index is a header, then one entry per name (aliases included) sorted
+# by name, then the names. Entries are fixed size, so a lookup is a binary
+# search straight through the mapped file and opening it costs the same
+# whatever the size of the library.
+_INDEX_MAGIC = b"KiSchIdx"
+_INDEX_VERSION = 1
+# magic, version, library size, library mtime, number of entries
+_INDEX_HEADER = struct.Struct ("<8sIQqQ")
+# start, end, name offset, name length, is an alias
+_INDEX_ENTRY = struct.Struct ("<QQIHH")
+
+_INDEX_LINE_RE = re.compile (
+    rb"^[ \t]*(DEF|ALIAS|ENDDEF)(?![^ \t\r\n])(?:[ \t]+([^\r\n]*))?", re.M)
+
+class LibraryIndex (object):
+    """Random access to the symbols in a library without reading it all.
+
+    The file is memory-mapped and only scanned for where each DEF ... ENDDEF
+    block is; a symbol is parsed the first time it's asked for, by its name
+    or any of its aliases:
+
+        lib = LibraryIndex ("big.lib")
+        r = lib["R"]
+
+    The offsets are saved to index_file (the library's name plus ".idx" by
+    default) so that next time the scan is skipped too, and opening it and
+    looking names up take the same time however big the library is. The
+    saved index is used as long as the library's size and modification
+    time still match; pass persist=False to neither read nor write it. If a
+    name is defined twice, the first one wins, like a lookup in readfile's
+    list would.
+    """
+
+    def __init__ (self, filename, index_file=None, persist=True):
+        self.filename = filename
+        if index_file is None:
+            index_file = filename + ".idx"
+        self.index_file = index_file
+        # Parsed symbols by where they start
+        self._symbols = {}
+        # Either the scan results, or the saved index mapped in
+        self._spans = self._aliases = None
+        self._index = self._index_file = None
+
+        self._file = open (filename, "rb")
+        try:
+            st = os.fstat (self._file.fileno ())
+            self._map = _map_file (self._file)
+            stamp = (st.st_size, st.st_mtime_ns)
+            if persist:
+                self._open_index (stamp)
+            if self._index is None:
+                self._spans, self._aliases = self._scan ()
+                if persist:
+                    self._save_index (stamp)
+        except BaseException:
+            self.close ()
+            raise
+
+    def _scan (self):
+        """Find the blocks. Returns ({name: (start, end)}, {alias: name})"""
+        spans = {}
+        aliases = {}
+        name = start = None
+        for m in _INDEX_LINE_RE.finditer (self._map):
+            kind = m.group (1)
+            if kind == b"DEF":
+                rest = (m.group (2) or b"").split ()
+                name = rest[0].decode ("utf-8") if rest else ""
+                start = m.start ()
+                names = [name]
+            elif start is None:
+                continue
+            elif kind == b"ALIAS":
+                names.extend (i.decode ("utf-8")
+                              for i in (m.group (2) or b"").split ())
+            else:
+                end = self._map.find (b"\n", m.end ())
+                end = len (self._map) if end < 0 else end + 1
+                if name not in spans:
+                    spans[name] = (start, end)
+                for i in names[1:]:
+                    aliases.setdefault (i, name)
+                name = start = None
+        # A symbol of the same name wins over an alias, as in the saved index
+        for i in [i for i in aliases if i in spans]:
+            del aliases[i]
+        return spans, aliases
+
+    def _open_index (self, stamp):
+        try:
+            f = open (self.index_file, "rb")
+        except FileNotFoundError:
+            return
+        index = _map_file (f)
+        if len (index) >= _INDEX_HEADER.size:
+            magic, version, size, mtime, count = _INDEX_HEADER.unpack_from (index)
+            if (magic == _INDEX_MAGIC and version == _INDEX_VERSION
+                    and (size, mtime) == stamp and len (index) >=
+                    _INDEX_HEADER.size + count * _INDEX_ENTRY.size):
+                self._index = index
+                self._index_file = f
+                self._count = count
+                return
+        # Stale, or from some other version; it'll be rebuilt
+        if isinstance (index, mmap.mmap):
+            index.close ()
+        f.close ()
+
+    def _save_index (self, stamp):
+        entries = [(name.encode ("utf-8"), span, 0)
+                   for name, span in self._spans.items ()]
+        entries.extend ((alias.encode ("utf-8"), self._spans[name], 1)
+                        for alias, name in self._aliases.items ()
+                        if alias not in self._spans)
+        entries.sort ()
+        out = [_INDEX_HEADER.pack (_INDEX_MAGIC, _INDEX_VERSION, stamp[0],
+                                   stamp[1], len (entries))]
+        offset = 0
+        for name, (start, end), alias in entries:
+            out.append (_INDEX_ENTRY.pack (start, end, offset, len (name),
+                                           alias))
+            offset += len (name)
+        out.extend (i[0] for i in entries)
+
+        directory = os.path.dirname (os.path.abspath (self.index_file))
+        try:
+            fd, tmp = tempfile.mkstemp (dir=directory, suffix=".tmp")
+        except OSError:
+            # Read-only directory: just go without
+            return
+        try:
+            with os.fdopen (fd, "wb") as f:
+                f.write (b"".join (out))
+            os.replace (tmp, self.index_file)
+        except BaseException:
+            os.unlink (tmp)
+            raise
+
+    def _entry (self, i):
+        """The saved index's i'th (name, start, end, is_alias)"""
+        start, end, offset, length, alias = _INDEX_ENTRY.unpack_from (
+            self._index, _INDEX_HEADER.size + i * _INDEX_ENTRY.size)
+        offset += _INDEX_HEADER.size + self._count * _INDEX_ENTRY.size
+        return self._index[offset:offset + length], start, end, alias
+
+    def _find (self, name):
+        """(start, end) of the symbol name is or is an alias of, or None"""
+        if self._spans is not None:
+            span = self._spans.get (name)
+            if span is None and name in self._aliases:
+                span = self._spans[self._aliases[name]]
+            return span
+        key = name.encode ("utf-8")
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry (mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count:
+            entry_name, start, end, alias = self._entry (lo)
+            if entry_name == key:
+                return start, end
+        return None
+
+    def _entries (self):
+        for i in range (self._count):
+            name, start, end, alias = self._entry (i)
+            yield name.decode ("utf-8"), (start, end), alias
+
+    def close (self):
+        for i in (getattr (self, "_map", None), self._index):
+            if isinstance (i, mmap.mmap):
+                i.close ()
+        for i in (self._file, self._index_file):
+            if i is not None:
+                i.close ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close ()
+
+    def names (self):
+        """The symbols' own names, in no particular order"""
+        if self._spans is not None:
+            return list (self._spans)
+        return [name for name, span, alias in self._entries () if not alias]
+
+    @property
+    def aliases (self):
+        """{alias: name of the symbol it's an alias of}"""
+        if self._aliases is not None:
+            return dict (self._aliases)
+        entries = list (self._entries ())
+        names = dict ((span, name) for name, span, alias in entries
+                      if not alias)
+        return dict ((name, names[span]) for name, span, alias in entries
+                     if alias)
+
+    def __contains__ (self, name):
+        return self._find (name) is not None
+
+    def __len__ (self):
+        if self._spans is not None:
+            return len (self._spans)
+        return len (self.names ())
+
+    def __iter__ (self):
+        return iter (self.names ())
+
+    def _span (self, name):
+        span = self._find (name)
+        if span is None:
+            raise KeyError (name)
+        return span
+
+    def text (self, name):
+        """The DEF ... ENDDEF text of a symbol, as it is in the file"""
+        start, end = self._span (name)
+        return self._map[start:end].decode ("utf-8")
+
+    def __getitem__ (self, name):
+        start, end = self._span (name)
+        symbol = self._symbols.get (start)
+        if symbol is None:
+            symbol = KicadSchSymbol.createFromLibFile (io.StringIO (
+                self._map[start:end].decode ("utf-8"), newline=None))
+            if symbol is None:
+                raise ValueError ("symbol %s has no ENDDEF" % name)
+            self._symbols[start] = symbol
+        return symbol
+
+    def get (self, name, default=None):
+        if name not in self:
+            return default
+        return self[name]
+
+def _map_file (f):
+    """Map an open file read-only; empty files can't be mapped, but then
+    there's nothing to map"""
+    if os.fstat (f.fileno ()).st_size == 0:
+        return b""
+    return mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ)
+
+
+# Loading a tree of libraries one after the other spends the whole time on
+# one core. load_libraries parses them on a process pool instead. Shipping
+# parsed symbols back costs as much as parsing them again, though, so the
+# workers only send each symbol's name, aliases and source text; the catalog
+# parses a symbol from that the first time it's asked for.
+
+class SymbolCatalog (collections.abc.Mapping):
+    """Symbols from many libraries: name -> (library filename, symbol).
+
+    Looking a name up also finds aliases, giving the symbol they're an alias
+    of. If a name is defined in more than one library, as a symbol or an
+    alias, the first library loaded wins, and duplicates lists every library
+    defining it, in order. The other aliases of a symbol that lost its name
+    become aliases of the one that kept it.
+    errors holds the traceback for each library that couldn't be read.
+    """
+
+    def __init__ (self):
+        self.libraries = []
+        self.duplicates = {}
+        self.errors = {}
+        # name -> [library, source, symbol or None]
+        self._entries = {}
+        self._aliases = {}
+
+    def _add (self, library, symbols):
+        self.libraries.append (library)
+        entries = self._entries
+        for name, aliases, source, symbol in symbols:
+            for i in [name] + aliases:
+                owner = (entries[i][0] if i in entries
+                         else entries[self._aliases[i]][0]
+                         if i in self._aliases else None)
+                if owner is not None:
+                    libs = self.duplicates.setdefault (i, [owner])
+                    if library not in libs:
+                        libs.append (library)
+            # Names and aliases share one namespace; whichever library
+            # claimed a name first keeps it. A symbol that lost its name
+            # still brings any aliases nobody has yet, pointing at the
+            # symbol that did get the name.
+            if name in entries or name in self._aliases:
+                name = self.resolve (name)
+            else:
+                entries[name] = [library, source, symbol]
+            for i in aliases:
+                if i not in entries:
+                    self._aliases.setdefault (i, name)
+
+    def resolve (self, name):
+        """The name of the symbol that name is, or is an alias of; KeyError
+        if there's none"""
+        if name in self._entries:
+            return name
+        return self._aliases[name]
+
+    def library (self, name):
+        """Which library a symbol (or alias) comes from, without parsing it"""
+        return self._entries[self.resolve (name)][0]
+
+    @property
+    def aliases (self):
+        """{alias: name of the symbol it's an alias of}"""
+        return dict (self._aliases)
+
+    def __getitem__ (self, name):
+        entry = self._entries[self.resolve (name)]
+        if entry[2] is None:
+            entry[2] = KicadSchSymbol.createFromLibFile (
+                io.StringIO (entry[1], newline=None))
+            entry[1] = None
+        return entry[0], entry[2]
+
+    def __contains__ (self, name):
+        return name in self._entries or name in self._aliases
+
+    def __iter__ (self):
+        return iter (self._entries)
+
+    def __len__ (self):
+        return len (self._entries)
+
+def _find_libraries (paths, pattern):
+    found = []
+    for path in paths:
+        if not os.path.isdir (path):
+            found.append (path)
+            continue
+        for directory, dirs, files in os.walk (path):
+            dirs.sort ()
+            found.extend (os.path.join (directory, i) for i in sorted (files)
+                          if fnmatch.fnmatch (i, pattern))
+    return found
+
+def _load_library (filename):
+    """Parse a library; returns (filename, [(name, aliases, source, symbol)],
+    error). symbol is only sent when there's no source to parse again."""
+    try:
+        with open (filename, encoding="utf-8") as f:
+            symbols = readfile (f, lazy=True)
+    except Exception:
+        return filename, [], traceback.format_exc ()
+    out = []
+    for i in symbols:
+        source = i._source
+        out.append ((i.name, i._aliases, source,
+                     i if source is None else None))
+    return filename, out, None
+
+def load_libraries (paths, processes=None, pattern="*.lib"):
+    """Load every library in a list of files and directory trees into one
+    SymbolCatalog. Directories are searched for files matching pattern, in
+    sorted order, which is the order duplicates are decided in.
+
+    Each library is read in a process of its own out of a pool of
+    `processes` (default: one per core); with processes=1 everything runs
+    here instead. A library that fails doesn't stop the others; see the
+    catalog's errors.
+    """
+    if isinstance (paths, str):
+        paths = [paths]
+    libraries = _find_libraries (paths, pattern)
+
+    if processes is None:
+        processes = os.cpu_count () or 1
+    processes = min (processes, len (libraries))
+    if processes <= 1:
+        results = [_load_library (i) for i in libraries]
+    else:
+        chunksize = max (1, len (libraries) // (processes * 4))
+        with concurrent.futures.ProcessPoolExecutor (processes) as pool:
+            results = list (pool.map (_load_library, libraries,
+                                      chunksize=chunksize))
+
+    catalog = SymbolCatalog ()
+    with _gc_paused ():
+        for filename, symbols, error in results:
+            if error is not None:
+                catalog.errors[filename] = error
+            else:
+                catalog._add (filename, symbols)
+    return catalog
+
+
+# A catalog of every symbol in a set of libraries, kept in SQLite so that
+# questions about all of them don't mean reading all of them again. Each
+# library is only re-read when its content changes.
+
+_DB_VERSION = 1
+
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS libraries (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, size INTEGER,
+    mtime INTEGER, hash TEXT);
+CREATE TABLE IF NOT EXISTS symbols (
+    id INTEGER PRIMARY KEY,
+    library INTEGER NOT NULL REFERENCES libraries (id) ON DELETE CASCADE,
+    name TEXT NOT NULL, reference TEXT, unit_count INTEGER,
+    is_power INTEGER, pin_count INTEGER);
+CREATE TABLE IF NOT EXISTS fields (
+    symbol INTEGER NOT NULL REFERENCES symbols (id) ON DELETE CASCADE,
+    num INTEGER, text TEXT);
+CREATE TABLE IF NOT EXISTS aliases (
+    symbol INTEGER NOT NULL REFERENCES symbols (id) ON DELETE CASCADE,
+    alias TEXT);
+CREATE TABLE IF NOT EXISTS fp_filters (
+    symbol INTEGER NOT NULL REFERENCES symbols (id) ON DELETE CASCADE,
+    filter TEXT);
+CREATE TABLE IF NOT EXISTS pins (
+    symbol INTEGER NOT NULL REFERENCES symbols (id) ON DELETE CASCADE,
+    name TEXT, num TEXT, elec_type TEXT, direction TEXT, unit INTEGER,
+    convert INTEGER, posx INTEGER, posy INTEGER);
+CREATE INDEX IF NOT EXISTS symbols_library ON symbols (library);
+CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name);
+CREATE INDEX IF NOT EXISTS symbols_pin_count ON symbols (pin_count);
+CREATE INDEX IF NOT EXISTS fields_symbol ON fields (symbol, num);
+CREATE INDEX IF NOT EXISTS aliases_alias ON aliases (alias);
+CREATE INDEX IF NOT EXISTS aliases_symbol ON aliases (symbol);
+CREATE INDEX IF NOT EXISTS fp_filters_filter ON fp_filters (filter);
+CREATE INDEX IF NOT EXISTS fp_filters_symbol ON fp_filters (symbol);
+CREATE INDEX IF NOT EXISTS pins_symbol ON pins (symbol);
+"""
+
+class SymbolDatabase (object):
+    """A persistent catalog of symbols, their fields, aliases, footprint
+    filters and pins, in an SQLite file:
+
+        db = SymbolDatabase ("symbols.db")
+        db.refresh (["/usr/share/kicad/library"])
+        db.with_fp_filter ("SOIC*")
+
+    refresh() only re-reads libraries whose content has changed since last
+    time. The query helpers return (library, symbol name) pairs; query()
+    runs anything else against the tables (see _DB_SCHEMA).
+    """
+
+    def __init__ (self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect (filename)
+        self.db.execute ("PRAGMA foreign_keys = ON")
+        version = self.db.execute ("PRAGMA user_version").fetchone ()[0]
+        if version not in (0, _DB_VERSION):
+            raise ValueError ("%s is a symbol database of unknown version %d"
+                              % (filename, version))
+        with self.db:
+            self.db.executescript (_DB_SCHEMA)
+            self.db.execute ("PRAGMA user_version = %d" % _DB_VERSION)
+
+    def close (self):
+        self.db.close ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close ()
+
+    def refresh (self, paths, pattern="*.lib", processes=None):
+        """Bring the catalog up to date with the libraries in a list of
+        files and directory trees (found as by load_libraries). Libraries
+        whose content hash changed, or that are new, are re-read, on a pool
+        of `processes` like load_libraries; ones no longer there are
+        dropped.
+
+        Returns (libraries re-read, libraries dropped). Libraries that fail
+        to read raise ValueError after everything else is stored.
+        """
+        if isinstance (paths, str):
+            paths = [paths]
+        libraries = [os.path.abspath (i)
+                     for i in _find_libraries (paths, pattern)]
+        known = dict ((path, (lib_id, size, mtime, digest))
+                      for lib_id, path, size, mtime, digest in self.db.execute (
+                          "SELECT id, path, size, mtime, hash FROM libraries"))
+
+        stale = []
+        for path in libraries:
+            st = os.stat (path)
+            entry = known.get (path)
+            if entry is not None and entry[1:3] == (st.st_size, st.st_mtime_ns):
+                continue
+            digest = _file_hash (path)
+            if entry is not None and entry[3] == digest:
+                # Touched but not changed; just remember the new stamp
+                with self.db:
+                    self.db.execute (
+                        "UPDATE libraries SET size = ?, mtime = ? WHERE id = ?",
+                        (st.st_size, st.st_mtime_ns, entry[0]))
+                continue
+            stale.append ((path, st.st_size, st.st_mtime_ns, digest))
+
+        if processes is None:
+            processes = os.cpu_count () or 1
+        processes = min (processes, len (stale))
+        jobs = [i[0] for i in stale]
+        if processes <= 1:
+            results = [_library_rows (i) for i in jobs]
+        else:
+            with concurrent.futures.ProcessPoolExecutor (processes) as pool:
+                results = list (pool.map (_library_rows, jobs))
+
+        errors = []
+        gone = set (known) - set (libraries)
+        with self.db:
+            for path in gone:
+                self.db.execute ("DELETE FROM libraries WHERE id = ?",
+                                 (known[path][0],))
+            for (path, size, mtime, digest), (rows, error) in zip (stale, results):
+                if error is not None:
+                    errors.append ("%s:\n%s" % (path, error))
+                    continue
+                if path in known:
+                    self.db.execute ("DELETE FROM libraries WHERE id = ?",
+                                     (known[path][0],))
+                self._store (path, size, mtime, digest, rows)
+        if errors:
+            raise ValueError ("could not read %d libraries:\n%s" % (
+                len (errors), "\n".join (errors)))
+        return len (stale), len (gone)
+
+    def _store (self, path, size, mtime, digest, rows):
+        db = self.db
+        lib_id = db.execute (
+            "INSERT INTO libraries (path, size, mtime, hash) VALUES (?, ?, ?, ?)",
+            (path, size, mtime, digest)).lastrowid
+        for symbol, fields, aliases, filters, pins in rows:
+            symbol_id = db.execute (
+                "INSERT INTO symbols (library, name, reference, unit_count, "
+                "is_power, pin_count) VALUES (?, ?, ?, ?, ?, ?)",
+                (lib_id,) + symbol).lastrowid
+            db.executemany ("INSERT INTO fields VALUES (?, ?, ?)",
+                            [(symbol_id,) + i for i in fields])
+            db.executemany ("INSERT INTO aliases VALUES (?, ?)",
+                            [(symbol_id, i) for i in aliases])
+            db.executemany ("INSERT INTO fp_filters VALUES (?, ?)",
+                            [(symbol_id, i) for i in filters])
+            db.executemany ("INSERT INTO pins VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(symbol_id,) + i for i in pins])
+
+    def query (self, sql, *args):
+        """Run some SQL against the catalog, returning all the rows"""
+        return self.db.execute (sql, args).fetchall ()
+
+    def find (self, name):
+        """Every (library, symbol name) that name is, or is an alias of"""
+        return self.query (
+            "SELECT l.path, s.name FROM symbols s JOIN libraries l "
+            "ON s.library = l.id WHERE s.name = ? UNION "
+            "SELECT l.path, s.name FROM aliases a JOIN symbols s "
+            "ON a.symbol = s.id JOIN libraries l ON s.library = l.id "
+            "WHERE a.alias = ? ORDER BY 1, 2", name, name)
+
+    def with_fp_filter (self, fp_filter):
+        """Symbols with the given footprint filter"""
+        return self.query (
+            "SELECT DISTINCT l.path, s.name FROM fp_filters f "
+            "JOIN symbols s ON f.symbol = s.id JOIN libraries l "
+            "ON s.library = l.id WHERE f.filter = ? ORDER BY 1, 2", fp_filter)
+
+    def with_pins (self, more_than):
+        """Symbols with more than the given number of pins"""
+        return self.query (
+            "SELECT l.path, s.name FROM symbols s JOIN libraries l "
+            "ON s.library = l.id WHERE s.pin_count > ? ORDER BY 1, 2",
+            more_than)
+
+    def with_empty_field (self, num):
+        """Symbols whose field num (2 is the footprint) is empty or missing"""
+        return self.query (
+            "SELECT l.path, s.name FROM symbols s JOIN libraries l "
+            "ON s.library = l.id WHERE NOT EXISTS (SELECT 1 FROM fields f "
+            "WHERE f.symbol = s.id AND f.num = ? AND f.text != '') "
+            "ORDER BY 1, 2", num)
+
+def _file_hash (path):
+    h = hashlib.sha256 ()
+    with open (path, "rb") as f:
+        for block in iter (lambda: f.read (1 << 20), b""):
+            h.update (block)
+    return h.hexdigest ()
+
+def _library_rows (filename):
+    """Read a library into rows for SymbolDatabase. Returns (rows, error),
+    rows being (symbol, fields, aliases, footprint filters, pins) for each
+    symbol, all plain tuples so they're cheap to send between processes."""
+    try:
+        with open (filename, encoding="utf-8") as f:
+            symbols = readfile (f)
+    except Exception:
+        return None, traceback.format_exc ()
+    rows = []
+    for i in symbols:
+        d = i._definition
+        fields = [i._referenceField, i._valueField, i._footprintField]
+        fields.extend (i._otherFields)
+        rows.append ((
+            (d.name, d.reference, d.unit_count, d.is_power, len (i._pins)),
+            [(f.num, f.text) for f in fields if f is not None],
+            list (i._aliases),
+            list (i._footprintFilters),
+            [(p.name, p.num, p.elec_type, p.direction, p.unit, p.convert,
+              p.posx, p.posy) for p in i._pins]))
+    return rows, None
 
 
 def script1():
     # open conn-100mil.lib.old and split the CONN-100MIL-M-* into shrouded and
     # unshrouded versions
-    import copy
     with open ("conn-100mil.lib.old") as f:
         symbs = readfile (f)
 
@@ -428,8 +1507,7 @@ def script1():
             i.footprintField.text = "conn-100mil:" + i.footprintFilters[0]
             i.footprintField.visible = False
 
-            shrouded = copy.deepcopy (i)
-            shrouded.name = shrouded.name + "-SHROUD"
+            shrouded = i.derive (i.name + "-SHROUD")
             shrouded.footprintFilters[0] += "-SHROUD"
             shrouded.footprintField.text = "conn-100mil:" + shrouded.footprintFilters[0]
             newsymbs.append (shrouded)
@@ -0,0 +1,117 @@
+"""Instrumentation for kicad_tools and kicad_schlib
+
+Collects where the time goes while loading, processing and writing boards and
+libraries:
+
+    import kicad_stats
+    with kicad_stats.collect () as stats:
+        pcb = kicad_tools.KicadPCB ("board.kicad_pcb")
+        kicad_tools.remove_stacked_vias (pcb)
+        pcb.write ("board.kicad_pcb")
+    print (stats)
+
+stats.report () gives the same thing as a dict. Phases are timed and counted
+by name ("pcb.read", "pcb.parse", "schlib.Pin", ...), items are counted by
+type, and bytes going in and out of files are totalled. To watch a run as it
+goes, pass collect() a hook; it's called as hook (event, name, value) with
+event one of "phase" (value in seconds), "count", "read" or "written".
+
+When nothing is collecting, `active` is None and the instrumented code
+checks that once per file or operation, never per item, so leaving the
+calls in costs nothing.
+"""
+
+import contextlib
+import time
+
+# The Stats currently collecting, if any
+active = None
+
+class Stats (object):
+    def __init__ (self, hook=None):
+        self.hook = hook
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    @contextlib.contextmanager
+    def phase (self, name):
+        t0 = time.perf_counter ()
+        try:
+            yield
+        finally:
+            t = time.perf_counter () - t0
+            self.add_time (name, t)
+            if self.hook is not None:
+                self.hook ("phase", name, t)
+
+    def add_time (self, name, seconds, calls=1):
+        """Add to a phase's time without telling the hook; for things timed
+        so often the hook would drown in them"""
+        self.times[name] = self.times.get (name, 0.) + seconds
+        self.calls[name] = self.calls.get (name, 0) + calls
+
+    def count (self, name, n=1):
+        self.counts[name] = self.counts.get (name, 0) + n
+        if self.hook is not None:
+            self.hook ("count", name, n)
+
+    def read (self, name, n):
+        self.bytes_read += n
+        if self.hook is not None:
+            self.hook ("read", name, n)
+
+    def written (self, name, n):
+        self.bytes_written += n
+        if self.hook is not None:
+            self.hook ("written", name, n)
+
+    def report (self):
+        return dict (times=dict (self.times), calls=dict (self.calls),
+                     counts=dict (self.counts), bytes_read=self.bytes_read,
+                     bytes_written=self.bytes_written)
+
+    def merge (self, report):
+        """Add in a report from somewhere else, like a worker process"""
+        for name, t in report["times"].items ():
+            self.add_time (name, t, report["calls"][name])
+        for name, n in report["counts"].items ():
+            self.counts[name] = self.counts.get (name, 0) + n
+        self.bytes_read += report["bytes_read"]
+        self.bytes_written += report["bytes_written"]
+
+    def __str__ (self):
+        lines = ["%-36s %10s %10s" % ("phase", "seconds", "calls")]
+        for name in sorted (self.times):
+            lines.append ("%-36s %10.4f %10d" % (
+                name, self.times[name], self.calls[name]))
+        if self.counts:
+            lines.append ("%-36s %10s" % ("count", ""))
+            for name in sorted (self.counts):
+                lines.append ("%-36s %10d" % (name, self.counts[name]))
+        lines.append ("bytes read %d, written %d" % (
+            self.bytes_read, self.bytes_written))
+        return "\n".join (lines)
+
+@contextlib.contextmanager
+def collect (hook=None):
+    """Collect stats for everything done inside the with block"""
+    global active
+    stats = Stats (hook)
+    previous = active
+    active = stats
+    try:
+        yield stats
+    finally:
+        active = previous
+
+_NOTHING = contextlib.nullcontext ()
+
+def phase (name):
+    """Time a phase if anything is collecting. Only for once-per-operation
+    places; per-item code should check `active` itself."""
+    if active is None:
+        return _NOTHING
+    return active.phase (name)
@@ -1,10 +1,22 @@
+import array
+import concurrent.futures
+import contextlib
+import gc
+import hashlib
+import math
+import operator
+import os
+import pickle
+import re
 import sexpdata
+import shutil
+import tempfile
+import time
+import traceback
 
-S = sexpdata.Symbol
+import kicad_stats
 
-# Why the hell does B.Adhes get coded as B\.Adhes? What sexp format escapes
-# that?
-sexpdata.Symbol._lisp_quoted_specials.remove (('.', r'\.'))
+S = sexpdata.Symbol
 
 def symbtostr (s):
     if isinstance (s, S):
@@ -12,12 +24,284 @@ def symbtostr (s):
     else:
         return str (s)
 
+###############################################################################
+# S-expression reader/writer for the kicad_pcb dialect.
+#
+# sexpdata is a general Lisp reader and it's slow: it walks the file a
+# character at a time and builds a fresh Symbol for every token. KiCad's files
+# are much simpler than Lisp - parens, bare atoms, double-quoted strings with
+# backslash escapes - so we tokenize with one regex and share atoms between
+# all their occurrences. The output is the same shape sexpdata produces (lists
+# of Symbol, str, int and float) so get_from/sub_in don't care.
+
+# Paren-free lists like (at 1 2) are matched whole and split in one go, which
+# cuts the number of trips around the Python loop by a factor of three or so.
+_SEXP_TOKEN_RE = re.compile (r'\([^()"]*\)|[()]|"(?:[^"\\]|\\.)*"|[^\s()"]+|"')
+_SEXP_NUMBER_RE = re.compile (r'[-+]?(?:\d+\.?\d*|\.\d+)\Z')
+_SEXP_ESCAPE_RE = re.compile (r'\\(.)', re.S)
+_SEXP_ESCAPES = {"n": "\n", "r": "\r", "t": "\t"}
+
+def _unescape (match):
+    c = match.group (1)
+    return _SEXP_ESCAPES.get (c, c)
+
+@contextlib.contextmanager
+def _gc_paused ():
+    """Building millions of lists sets the cyclic GC off over and over, and
+    each time it ends up scanning the whole half-built tree. Nothing we build
+    can form a cycle, so keep it out of the way."""
+    was_enabled = gc.isenabled ()
+    gc.disable ()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable ()
+
+class _AtomTable (dict):
+    """Maps token text to its decoded value, decoding on first sight. Tokens
+    repeat endlessly in a board (layer names, widths, net numbers) so each
+    distinct one is only ever converted and stored once."""
+    def __missing__ (self, tok):
+        if tok[0] == '"':
+            if len (tok) == 1:
+                raise ValueError ("unterminated string in s-expression")
+            value = tok[1:-1]
+            if "\\" in value:
+                value = _SEXP_ESCAPE_RE.sub (_unescape, value)
+        elif _SEXP_NUMBER_RE.match (tok):
+            value = float (tok) if "." in tok else int (tok)
+        else:
+            value = S(tok)
+        self[tok] = value
+        return value
+
+def parse_sexp (text, start=0, end=None, atoms=None):
+    """Parse the first s-expression in text[start:end] into nested lists.
+
+    atoms can be an _AtomTable shared between several calls on the same file.
+    """
+    root = _parse_sexps (text, start, end, atoms)
+    if not root:
+        raise ValueError ("no s-expression found")
+    return root[0]
+
+def _parse_sexps (text, start=0, end=None, atoms=None):
+    """Parse all the s-expressions in text[start:end] into a list"""
+    if end is None:
+        end = len (text)
+    if atoms is None:
+        atoms = _AtomTable ()
+    decode = atoms.__getitem__
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    cur = root = []
+
+    with _gc_paused ():
+        for tok in _SEXP_TOKEN_RE.findall (text, start, end):
+            if tok[0] == "(":
+                if tok == "(":
+                    new = []
+                    cur.append (new)
+                    push (cur)
+                    cur = new
+                else:
+                    cur.append (list (map (decode, tok[1:-1].split ())))
+            elif tok == ")":
+                if not stack:
+                    raise ValueError ("unbalanced ) in s-expression")
+                cur = pop ()
+            else:
+                cur.append (decode (tok))
+
+    if stack:
+        raise ValueError ("unbalanced ( in s-expression")
+    return root
+
+def load_sexp (f):
+    """Parse the s-expression in an open file"""
+    return parse_sexp (f.read ())
+
+_SEXP_QUOTES = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r"}
+_SEXP_QUOTE_RE = re.compile (r'[\\"\n\r]')
+
+def _quote (s):
+    return '"' + _SEXP_QUOTE_RE.sub (lambda m: _SEXP_QUOTES[m.group ()], s) + '"'
+
+def format_number (v):
+    """Format a number the way KiCad does (Double2Str): ten significant
+    digits and no trailing zeros, except that tiny values get ten decimal
+    places instead so they don't end up in exponent form."""
+    if not isinstance (v, float):
+        return str (v)
+    elif v == 0:
+        return "0"
+    elif abs (v) <= 0.0001:
+        return ("%.10f" % v).rstrip ("0").rstrip (".")
+    else:
+        return "%.10g" % v
+
+class _AtomFormats (dict):
+    """Maps atoms to their text, formatting each distinct one once. Symbols
+    are written as-is, since they came from bare atoms and need no escaping;
+    strings are quoted."""
+    def __missing__ (self, atom):
+        if isinstance (atom, S):
+            text = symbtostr (atom)
+        elif isinstance (atom, str):
+            text = _quote (atom)
+        else:
+            text = format_number (atom)
+        self[atom] = text
+        return text
+
+def _flat (node, fmt):
+    try:
+        # Paren-free lists are by far the most common, and this does them
+        # without a trip around the interpreter per atom.
+        return "(" + " ".join (map (fmt, node)) + ")"
+    except TypeError:
+        # unhashable: there's a list (or PointList) in there
+        return "(" + " ".join ([_flat (i, fmt) if type (i) is list
+                                else i._text (fmt) if type (i) is PointList
+                                else fmt (i)
+                                for i in node]) + ")"
+
+# KiCad's own files keep lines under about this long
+_SEXP_LINE = 99
+
+def _pretty (node, fmt, depth):
+    flat = _flat (node, fmt)
+    if len (flat) + 2 * depth <= _SEXP_LINE or \
+            not any (type (i) in _NESTED_TYPES for i in node):
+        return flat
+
+    # Atoms up to the first list stay on the opening line, then every child
+    # list gets a line of its own and the closing paren lines up underneath
+    # the opening one, like KiCad lays out modules.
+    indent = "\n" + "  " * (depth + 1)
+    parts = ["("]
+    line = []
+    for i, item in enumerate (node):
+        if type (item) in _NESTED_TYPES:
+            break
+        line.append (fmt (item))
+    else:
+        i = len (node)
+    parts.append (" ".join (line))
+    for item in node[i:]:
+        if type (item) is list:
+            parts.append (indent)
+            parts.append (_pretty (item, fmt, depth + 1))
+        elif type (item) is PointList:
+            parts.append (indent)
+            parts.append (item._text (fmt, depth + 1))
+        else:
+            parts.append (" ")
+            parts.append (fmt (item))
+    parts.append ("\n" + "  " * depth + ")")
+    return "".join (parts)
+
+def sexp_to_str (sexp, indent=False, depth=0, atoms=None):
+    """Serialize a tree of lists back to text. With indent, long lists are
+    broken over several lines like KiCad does, depth levels in.
+
+    atoms can be an _AtomFormats shared between calls.
+    """
+    fmt = (atoms if atoms is not None else _AtomFormats ()).__getitem__
+    if not isinstance (sexp, list):
+        return fmt (sexp)
+    elif indent:
+        return _pretty (sexp, fmt, depth)
+    else:
+        return _flat (sexp, fmt)
+
+def dump_sexp (sexp, f, indent=False):
+    """Write a tree of lists to an open file"""
+    f.write (sexp_to_str (sexp, indent))
+
+# Matches one whole top-level child of the board, capturing the whitespace in
+# front of it, its span and its keyword. Regexes can't count parens, so this
+# spells out nesting a fixed number of levels deep; anything deeper falls
+# back to _find_sexp_end. The loops are unrolled (normal* (special normal*)*)
+# so that there's only ever one way to match, otherwise a near miss would
+# backtrack forever.
+_SEXP_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_SEXP_NESTED_RE = r'\([^()"]*(?:' + _SEXP_STRING + r'[^()"]*)*\)'
+for _i in range (6):
+    _SEXP_NESTED_RE = r'\([^()"]*(?:(?:%s|%s)[^()"]*)*\)' % (
+        _SEXP_STRING, _SEXP_NESTED_RE)
+del _i
+_SEXP_CHILD_RE = re.compile (
+    r'(\s*)(\(\s*([^\s()"]*)[^()"]*(?:(?:%s|%s)[^()"]*)*\))' % (
+        _SEXP_STRING, _SEXP_NESTED_RE), re.S)
+_SEXP_HEAD_RE = re.compile (r'\s*\(\s*[^\s()"]*')
+_SEXP_TAIL_RE = re.compile (r'\s*\)')
+_SEXP_KEYWORD_RE = re.compile (r'(\s*)\(\s*([^\s()"]*)')
+
+def _find_sexp_end (text, start):
+    """Return the index just past the s-expression starting at start, by
+    counting parens the slow way"""
+    depth = 0
+    for m in _SEXP_TOKEN_RE.finditer (text, start):
+        tok = m.group ()
+        if tok == "(":
+            depth += 1
+        elif tok == ")":
+            depth -= 1
+        elif tok == '"':
+            raise ValueError ("unterminated string in s-expression")
+        if depth == 0:
+            return m.end ()
+    raise ValueError ("unbalanced ( in s-expression")
+
+def scan_children (text):
+    """Locate the children of the top-level s-expression in text without
+    parsing them.
+
+    Returns (header, children, trailer), where header is the text up to the
+    first child, trailer the text after the last one, and children a list of
+    (leading whitespace, start, end, keyword).
+    """
+    m = _SEXP_HEAD_RE.match (text)
+    if m is None:
+        raise ValueError ("no s-expression found")
+    header_end = pos = m.end ()
+    children = []
+    prefixes = {}
+    match = _SEXP_CHILD_RE.match
+    while True:
+        m = match (text, pos)
+        if m is not None:
+            prefix = m.group (1)
+            start, pos = m.span (2)
+            keyword = m.group (3)
+        else:
+            m = _SEXP_KEYWORD_RE.match (text, pos)
+            if m is None:
+                break
+            prefix = m.group (1)
+            start = m.end (1)
+            keyword = m.group (2)
+            pos = _find_sexp_end (text, start)
+        # Nearly every child has the same indentation; don't keep thousands
+        # of copies of it.
+        prefix = prefixes.setdefault (prefix, prefix)
+        children.append ((prefix, start, pos, keyword))
+
+    m = _SEXP_TAIL_RE.match (text, pos)
+    if m is None:
+        raise ValueError ("unbalanced ( in s-expression")
+    header = text[:header_end]
+    return header, children, text[pos:]
+
 # Sexp manipulators
 def get_from (sexp, kind):
     """From (blah (blah blah) (blah blah) (kind thingiwant)), return cdr
     Returns None otherwise"""
     for i in sexp[1:]:
-        if symbtostr (i[0]) == kind:
+        if isinstance (i, list) and i and symbtostr (i[0]) == kind:
             return i[1:]
     return None
 
@@ -25,134 +309,735 @@ def sub_in (sexp, kind, cdr):
     """Replace (kind . cdr) in (blah (blah blah) (kind . othercdr)), or add it
     if it's not there to begin with."""
     for i in range (1, len (sexp)):
-        if symbtostr (sexp[i][0]) == kind:
+        node = sexp[i]
+        if isinstance (node, list) and node and symbtostr (node[0]) == kind:
             sexp[i] = [S(kind)] + cdr
             break
     else:
         sexp.append ([S(kind)] + cdr)
 
-class KicadPCB (object):
+class NetTable (dict):
+    """The board's nets: a dict of net id -> name, which also knows each
+    name's id (.ids) and, once asked, which items are on each net.
 
-    def __init__ (self, filename):
-        with open (filename) as f:
-            sexptree = sexpdata.load (f)
+    Membership is worked out from the board the first time members() is
+    called, and kept up to date from then on as items are added, deleted or
+    re-netted. Module pads are indexed the same way, separately, by pads().
+    """
+
+    # Item types that carry a (net n) of their own
+    member_types = ()
 
-        self.nets = {}
+    def __init__ (self, pcb):
+        dict.__init__ (self)
+        self.pcb = pcb
+        self.ids = {}
+        self._members = None
+        self._pads = None
 
-        # Decode all the objects into classes
-        self.children = []
-        for i in sexptree[1:]:
-            item_id = i[0]
+    def __setitem__ (self, net_id, name):
+        if net_id in self:
+            del self[net_id]
+        dict.__setitem__ (self, net_id, name)
+        self.ids[name] = net_id
 
-            if item_id == S("net"):
-                child = NetSexp(self, i)
-                self.children.append (child)
-                self.nets[child.net_id] = child.net_name
+    def __delitem__ (self, net_id):
+        name = self[net_id]
+        dict.__delitem__ (self, net_id)
+        if self.ids.get (name) == net_id:
+            del self.ids[name]
+
+    def id_of (self, name):
+        """Return the id of the named net, or raise ValueError"""
+        try:
+            return self.ids[name]
+        except KeyError:
+            raise ValueError ("Tried to set nonexisting net")
+
+    def _member_index (self):
+        if self._members is None:
+            members = {}
+            for kind in self.member_types:
+                for item in self.pcb.view_types (kind):
+                    net_id = item.get_value ("net")
+                    members.setdefault (net_id, {})[item] = None
+            self._members = members
+        return self._members
 
-            elif item_id == S("gr_text"):
-                child = TextSexp (self, i)
-                self.children.append (child)
+    def members (self, net):
+        """Return all items on the given net, by name or id"""
+        if not isinstance (net, int):
+            net = self.id_of (net)
+        return list (self._member_index ().get (net, ()))
 
-            elif item_id == S("via"):
-                child = ViaSexp (self, i)
-                self.children.append (child)
+    def _pad_index (self):
+        if self._pads is None:
+            pads = {}
+            for module in self.pcb.find_types (ModuleSexp):
+                for pad in module.pads:
+                    pads.setdefault (pad.net_id, {})[pad] = None
+            self._pads = pads
+        return self._pads
 
-            elif item_id == S("segment"):
-                child = SegmentSexp (self, i)
-                self.children.append (child)
+    def pads (self, net):
+        """Return all module pads on the given net, by name or id"""
+        if not isinstance (net, int):
+            net = self.id_of (net)
+        return list (self._pad_index ().get (net, ()))
 
+    def _item_added (self, item):
+        if isinstance (item, NetSexp):
+            self[item.net_id] = item.net_name
+        elif isinstance (item, ModuleSexp):
+            if self._pads is not None:
+                for pad in item.pads:
+                    self._pads.setdefault (pad.net_id, {})[pad] = None
+        elif self._members is not None and isinstance (item, self.member_types):
+            net_id = item.get_value ("net")
+            self._members.setdefault (net_id, {})[item] = None
+
+    def _item_removed (self, item):
+        if isinstance (item, NetSexp):
+            if self.get (item.net_id) == item.net_name:
+                del self[item.net_id]
+        elif isinstance (item, ModuleSexp):
+            if self._pads is not None:
+                for pad in item.pads:
+                    self._pads.get (pad.net_id, {}).pop (pad, None)
+        elif self._members is not None and isinstance (item, self.member_types):
+            self._members.get (item.get_value ("net"), {}).pop (item, None)
+
+    def _item_changed (self, item, kind, old):
+        if kind is None:
+            # No telling what its net is now; start over when next asked
+            if isinstance (item, ModuleSexp):
+                self._pads = None
+            elif isinstance (item, self.member_types):
+                self._members = None
+            return
+        if kind != "net" or self._members is None:
+            return
+        if not isinstance (item, self.member_types):
+            return
+        on_old = self._members.get (old[1] if old is not None else None, {})
+        if item not in on_old:
+            # Not on the board
+            return
+        del on_old[item]
+        self._members.setdefault (item.get_value ("net"), {})[item] = None
+
+def _parse_children (text, spans, atoms):
+    """Parse all the children of a board. Parsing them in one go is quicker
+    than one at a time, so runs of them are, except for the types that
+    parse themselves."""
+    trees = []
+    run = None
+    for prefix, start, end, keyword in spans:
+        parse = _CHILD_TYPES.get (keyword, GenericSexp)._parse
+        if parse is parse_sexp:
+            if run is None:
+                run = start
+            run_end = end
+            continue
+        if run is not None:
+            trees.extend (_parse_sexps (text, run, run_end, atoms))
+            run = None
+        trees.append (parse (text, start, end, atoms))
+    if run is not None:
+        trees.extend (_parse_sexps (text, run, run_end, atoms))
+    assert len (trees) == len (spans)
+    return trees
+
+def _reindexing (method):
+    def edit (self, *args, **kwargs):
+        pcb = self.pcb
+        # Sweep out tombstones first, so they don't come back to life
+        pcb.children
+        old = list (self)
+        try:
+            return method (self, *args, **kwargs)
+        finally:
+            pcb._reindex (old)
+    edit.__name__ = method.__name__
+    return edit
+
+class _ChildList (list):
+    """A board's children. Editing the list directly keeps the board's
+    indexes in step with it: appending goes through KicadPCB.add, and
+    anything else re-indexes the whole board, so prefer add and delete for
+    lots of little edits."""
+    __slots__ = ("pcb",)
+
+    def __init__ (self, pcb, items=()):
+        list.__init__ (self, items)
+        self.pcb = pcb
+
+    def append (self, item):
+        self.pcb.add (item)
+
+    def extend (self, items):
+        self.pcb.extend (items)
+
+    def __iadd__ (self, items):
+        self.pcb.extend (items)
+        return self
+
+    insert = _reindexing (list.insert)
+    remove = _reindexing (list.remove)
+    pop = _reindexing (list.pop)
+    clear = _reindexing (list.clear)
+    sort = _reindexing (list.sort)
+    reverse = _reindexing (list.reverse)
+    __setitem__ = _reindexing (list.__setitem__)
+    __delitem__ = _reindexing (list.__delitem__)
+    __imul__ = _reindexing (list.__imul__)
+
+    def __reduce_ex__ (self, protocol):
+        # Copies (and pickles) are plain lists, tied to no board
+        return list, (list (self),)
+
+class KicadPCB (object):
+
+    def __init__ (self, filename, lazy=False, cache=None):
+        """Load a board.
+
+        With lazy=True, children are only located, not parsed; each one is
+        parsed the first time it's looked at. Either way, children that
+        aren't modified are written back out exactly as they were read.
+
+        cache is an optional BoardCache to keep the parse results in between
+        runs. A board that comes out of the cache gets its children's trees
+        from it a batch at a time, as they're looked at.
+        """
+        stats = kicad_stats.active
+        phase = kicad_stats.phase
+        self._filename = filename
+        self._source = None
+        self._stat = None
+        self._atoms = _AtomTable ()
+
+        # start of child -> batch of trees the cache has for it, and start
+        # -> tree for batches that have been unpickled but not handed out
+        self._cached = {}
+        self._unpickled = {}
+
+        cached = None
+        if cache is not None and cache.key == "mtime":
+            # Keyed by the file's stat, so a hit doesn't read the board at
+            # all until something needs its text
+            self._stat = os.stat (filename)
+            with phase ("pcb.cache_load"):
+                cached = cache.load (filename, None, lazy, self._stat)
+        if cached is None:
+            self._stat = None
+            text = self._text
+            if cache is not None and cache.key == "hash":
+                with phase ("pcb.cache_load"):
+                    cached = cache.load (filename, text, lazy)
+        if cached is not None:
+            header, spans, trailer, batches = cached
+            trees = None
+            for batch in batches or ():
+                self._cached.update (dict.fromkeys (batch[0], batch))
+        else:
+            with phase ("pcb.scan"):
+                header, spans, trailer = scan_children (text)
+            if lazy:
+                trees = None
             else:
-                child = GenericSexp(self, i)
-                self.children.append (child)
+                with phase ("pcb.parse"):
+                    trees = _parse_children (text, spans, self._atoms)
+            if cache is not None:
+                with phase ("pcb.cache_store"):
+                    cache.store (filename, text, lazy, header, spans, trailer,
+                                 trees, self._stat)
+        if trees is None:
+            trees = [None] * len (spans)
+
+        self._header = header
+        self._trailer = trailer
+
+        self.nets = NetTable (self)
+
+        # Decode all the objects into classes, and index them by class and
+        # keyword. The index dicts map item -> None; they're used as ordered
+        # sets.
+        self._children = _ChildList (self)
+        self._dead = set ()
+        self._by_type = {}
+        self._by_keyword = {}
+        self._spatial = None
+        self._connectivity = None
+        self._copper_layers = None
+        append = list.append
+        with phase ("pcb.decode"), _gc_paused ():
+            for (prefix, start, end, keyword), tree in zip (spans, trees):
+                cls = _CHILD_TYPES.get (keyword)
+                if cls is None:
+                    cls = GenericSexp
+                    child = GenericSexp (self, tree, (start, end), name=keyword)
+                else:
+                    child = cls (self, tree, (start, end))
+                child._prefix = prefix
+                append (self._children, child)
+
+                by_type = self._by_type.get (cls)
+                if by_type is None:
+                    by_type = self._by_type[cls] = {}
+                by_type[child] = None
+                by_keyword = self._by_keyword.get (keyword)
+                if by_keyword is None:
+                    by_keyword = self._by_keyword[keyword] = {}
+                by_keyword[child] = None
+
+                if cls is NetSexp:
+                    self.nets[child.net_id] = child.net_name
+        if stats is not None:
+            for keyword, items in self._by_keyword.items ():
+                stats.count ("pcb.%s" % keyword, len (items))
+
+    @property
+    def _text (self):
+        if self._source is None:
+            stats = kicad_stats.active
+            with kicad_stats.phase ("pcb.read"), \
+                    open (self._filename, encoding="utf-8") as f:
+                st = os.fstat (f.fileno ())
+                # The cache's spans are only good for the file it was
+                # keyed on
+                if self._stat is not None and \
+                        (st.st_size, st.st_mtime_ns) != \
+                        (self._stat.st_size, self._stat.st_mtime_ns):
+                    raise ValueError ("%s has changed since it was loaded"
+                                      % self._filename)
+                self._source = f.read ()
+                self._stat = st
+                if stats is not None:
+                    stats.read (self._filename, st.st_size)
+        return self._source
+
+    @property
+    def children (self):
+        # Deleted items are only tombstoned; sweep them out in one go the
+        # next time anybody looks.
+        if self._dead:
+            dead = self._dead
+            list.__setitem__ (self._children, slice (None),
+                              [i for i in self._children if i not in dead])
+            dead.clear ()
+        return self._children
+    @children.setter
+    def children (self, v):
+        v = list (v)
+        list.clear (self._children)
+        self._dead = set ()
+        self._by_type = {}
+        self._by_keyword = {}
+        self._spatial = None
+        self._connectivity = None
+        self._copper_layers = None
+        self.nets._members = None
+        self.nets._pads = None
+        self.extend (v)
+
+    def _reindex (self, old):
+        """children was edited in place and used to be old; catch
+        everything up with what's in it now"""
+        new = self._children
+        before = set (old)
+        after = set (new)
+        for item in old:
+            if item not in after:
+                self._removed (item)
+        for item in new:
+            if item not in before:
+                self._added (item)
+        # Keep the indexes in board order
+        by_type = {}
+        by_keyword = {}
+        for item in new:
+            by_type.setdefault (type (item), {})[item] = None
+            by_keyword.setdefault (item.keyword, {})[item] = None
+        self._by_type = by_type
+        self._by_keyword = by_keyword
+
+    def _parse_span (self, span, parse=parse_sexp):
+        start, end = span
+        if start in self._cached or start in self._unpickled:
+            return self._cached_tree (start)
+        stats = kicad_stats.active
+        if stats is None:
+            return parse (self._text, start, end, self._atoms)
+        t0 = time.perf_counter ()
+        tree = parse (self._text, start, end, self._atoms)
+        stats.add_time ("pcb.lazy_parse", time.perf_counter () - t0)
+        return tree
+
+    def _cached_tree (self, start):
+        """The tree a BoardCache had for the child at start. They come in
+        batches of children with the same keyword, and the whole batch is
+        unpickled the first time any of them is asked for."""
+        tree = self._unpickled.pop (start, None)
+        if tree is not None:
+            return tree
+        starts, data = self._cached[start]
+        stats = kicad_stats.active
+        t0 = time.perf_counter ()
+        with _gc_paused ():
+            trees = pickle.loads (data)
+        if stats is not None:
+            stats.add_time ("pcb.cache_trees", time.perf_counter () - t0)
+        for i in starts:
+            del self._cached[i]
+        self._unpickled.update (zip (starts, trees))
+        return self._unpickled.pop (start)
 
     def out (self):
         return [S("kicad_pcb")] + [i.out() for i in self.children]
     
-    def write (self, filename):
+    def write (self, filename, indent=False, reformat=False):
+        """Write the board out. Children that haven't been modified are
+        copied through as they were read, unless reformat is set. The rest
+        are serialized, laid out over several lines like KiCad does if
+        indent is set."""
         # "Maximum line length exceeded", fuck you!!
         # What bleeding moron thought sexps should be read line-by-line?!
-        with open (filename, 'w') as f:
-            f.write ("(kicad_pcb\n")
+        text = self._text
+        atoms = _AtomFormats ()
+        fmt = atoms.__getitem__
+        out = [self._header]
+        stats = kicad_stats.active
+        with kicad_stats.phase ("pcb.write"), \
+                open (filename, 'w', encoding="utf-8") as f, _gc_paused ():
             for i in self.children:
-                sexpdata.dump (i.out (), f)
-                f.write ("\n")
-            f.write (")\n")
+                out.append (i._prefix)
+                # Items moved over from another board have spans into that
+                # board's text, not ours
+                if i._span is not None and i.pcb is self and not reformat:
+                    start, end = i._span
+                    out.append (text[start:end])
+                elif indent:
+                    out.append (_pretty (i._tree (), fmt, 1))
+                else:
+                    out.append (_flat (i._tree (), fmt))
+                # Write in big lumps rather than many little writes
+                if len (out) >= 4096:
+                    f.write ("".join (out))
+                    del out[:]
+            out.append (self._trailer)
+            f.write ("".join (out))
+        if stats is not None:
+            stats.written (filename, os.path.getsize (filename))
+            stats.count ("pcb.write.serialized", sum (
+                1 for i in self.children
+                if i._span is None or i.pcb is not self or reformat))
+
 
+    def view_types (self, kind):
+        """Return a live view of all children of exactly the given type, in
+        order, without copying. Don't add or delete while iterating over it;
+        use find_types for that."""
+        return self._by_type.get (kind, {}).keys ()
+
+    def view_keyword (self, keyword):
+        """Return a live view of all children with the given keyword (e.g.
+        "module", "zone", "gr_line"), like view_types"""
+        return self._by_keyword.get (keyword, {}).keys ()
 
     def find_types (self, kind):
         """Return all children of the given type"""
-        return [i for i in self.children if isinstance (i, kind)]
+        types = [i for i in self._by_type if issubclass (i, kind)]
+        if not types:
+            return []
+        elif len (types) == 1:
+            return list (self._by_type[types[0]])
+        else:
+            # Several subclasses; keep them in board order
+            return [i for i in self.children if isinstance (i, kind)]
+
+    def find_keyword (self, keyword):
+        """Return all children with the given keyword"""
+        return list (self.view_keyword (keyword))
+
+    def find_on_net (self, net, kind=None):
+        """Return all items on the given net (by name or id), optionally
+        only those of the given type"""
+        items = self.nets.members (net)
+        if kind is not None:
+            items = [i for i in items if isinstance (i, kind)]
+        return items
+
+    def find_pads_on_net (self, net):
+        """Return all module pads on the given net, by name or id"""
+        return self.nets.pads (net)
+
+    def find_pads_under (self, via):
+        """Return the pads whose copper a via touches, on any copper layer
+        they share"""
+        x, y = via.pos[:2]
+        r = via.size / 2.
+        found = []
+        layers = [i for i in self.copper_layers if via.on_layer (i)]
+        for pad in self.spatial_index ().in_radius (x, y, r, kind=PadSexp):
+            if pad.distance (x, y) <= r and \
+                    any (pad.on_layer (i) for i in layers):
+                found.append (pad)
+        return found
+
+    def add (self, item):
+        """Add an item to the end of children"""
+        if item in self._dead:
+            # Sweep out its tombstone first, or it'll take this with it
+            self.children
+        list.append (self._children, item)
+        self._added (item)
+
+    def extend (self, items):
+        """Add a batch of items to the end of children"""
+        for item in items:
+            self.add (item)
 
     def delete (self, item):
         """Delete the item from children"""
-        indices = []
-        for i, elem in enumerate (self.children):
-            if elem is item:
-                indices.append (i)
-        for i in indices[::-1]:
-            del self.children[i]
+        if item not in self._dead:
+            self._dead.add (item)
+            self._removed (item)
 
+    def delete_many (self, items):
+        """Delete all the given items from children. However many there
+        are, children only gets swept once."""
+        for item in items:
+            self.delete (item)
 
-class GenericSexp (object):
-    def __init__ (self, pcb, sexp):
-        self.sexp = sexp
-        self.name = sexp[0].value ()
+    @property
+    def copper_layers (self):
+        """Names of the copper layers, from top to bottom"""
+        if self._copper_layers is None:
+            self._copper_layers = []
+            for i in self.view_keyword ("layers"):
+                self._copper_layers = _copper_layer_names (i.out ())
+        return self._copper_layers
 
-    def out (self):
-        return self.sexp
+    def spatial_index (self):
+        """Return the board's SpatialIndex of vias, segments and pads. It's
+        built on first use and kept up to date after that."""
+        if self._spatial is None:
+            with kicad_stats.phase ("pcb.spatial_index"):
+                self._spatial = SpatialIndex (self)
+        return self._spatial
 
-class NetSexp (object):
-    # Immutable!
-    def __init__ (self, pcb, sexp):
-        self.sexp = sexp
-        self.net_id = sexp[1]
-        self.net_name = symbtostr (sexp[2])
+    def connectivity (self):
+        """Return the board's Connectivity, which finds copper islands,
+        dangling tracks and split nets. Like the spatial index, it's built
+        on first use and kept up to date after that."""
+        if self._connectivity is None:
+            self._connectivity = Connectivity (self)
+        return self._connectivity
+
+    def export_tracks (self):
+        """Return a TrackArrays of all vias and segments. Requires NumPy."""
+        with kicad_stats.phase ("pcb.export_tracks"):
+            return TrackArrays (self)
+
+    def import_tracks (self, arrays):
+        """Write edits made to a TrackArrays back into the board. Only the
+        rows that changed are touched. Returns the number of items changed.
+        """
+        with kicad_stats.phase ("pcb.import_tracks"):
+            return arrays._write_back (self)
+
+    # Bookkeeping. Everything that indexes the board hears about items coming
+    # and going and their fields changing through these.
+    def _added (self, item):
+        self._by_type.setdefault (type (item), {})[item] = None
+        self._by_keyword.setdefault (item.keyword, {})[item] = None
+        self.nets._item_added (item)
+        if self._spatial is not None:
+            self._spatial._item_added (item)
+        if self._connectivity is not None:
+            self._connectivity._item_added (item)
+
+    def _removed (self, item):
+        self._by_type.get (type (item), {}).pop (item, None)
+        self._by_keyword.get (item.keyword, {}).pop (item, None)
+        self.nets._item_removed (item)
+        if self._spatial is not None:
+            self._spatial._item_removed (item)
+        if self._connectivity is not None:
+            self._connectivity._item_removed (item)
+
+    def _changed (self, item, kind, old):
+        """item's (kind ...) was replaced; old is the previous node or None.
+        kind None means its whole tree was handed out or replaced, so
+        anything about it may change."""
+        self.nets._item_changed (item, kind, old)
+        if self._spatial is not None:
+            self._spatial._item_changed (item, kind, old)
+        if self._connectivity is not None:
+            self._connectivity._item_changed (item, kind, old)
+
+
+class SexpItem (object):
+    """Base class for the children of a board.
+
+    An item read from a file remembers where its text was. In a lazily loaded
+    board that's all it has until something looks inside, at which point the
+    text gets parsed. Items that haven't been modified are written back out
+    as that original text.
+    """
+
+    # The item's (keyword ...)
+    keyword = None
+
+    # Whitespace written before the item; loaded items keep their own
+    _prefix = "\n  "
+
+    # keyword -> index in the tree of the first (keyword ...) child, built
+    # the first time it's needed
+    _keys = None
+
+    # Parses the item's text; classes that store parts of themselves
+    # specially have their own
+    _parse = staticmethod (parse_sexp)
+
+    def __init__ (self, pcb, sexp, span=None):
+        self.pcb = pcb
+        self._sexp = sexp
+        self._span = span
+
+    def _tree (self):
+        """Return the parsed tree without marking the item modified"""
+        if self._sexp is None:
+            self._sexp = self.pcb._parse_span (self._span, self._parse)
+        return self._sexp
+
+    def _touch (self):
+        """Mark the item modified, so it gets re-serialized on write"""
+        self._tree ()
+        self._span = None
+
+    def _index (self):
+        keys = self._keys
+        if keys is None:
+            keys = {}
+            tree = self._tree ()
+            # Backwards, so the first of any repeated keyword wins
+            for i in range (len (tree) - 1, 0, -1):
+                item = tree[i]
+                if type (item) is list and item:
+                    head = item[0]
+                    keys[head.value () if type (head) is S
+                         else symbtostr (head)] = i
+            self._keys = keys
+        return keys
+
+    def get_from (self, kind):
+        """Like get_from (self.sexp, kind), but without the linear search or
+        marking the item modified"""
+        i = self._index ().get (kind)
+        if i is None:
+            return None
+        return self._sexp[i][1:]
+
+    def get_value (self, kind):
+        """Return the first value of (kind value ...), or None"""
+        i = self._index ().get (kind)
+        if i is None:
+            return None
+        return self._sexp[i][1]
+
+    def sub_in (self, kind, cdr):
+        """Like sub_in (self.sexp, kind, cdr), but keeping the index and
+        telling the board about the change"""
+        self._touch ()
+        keys = self._index ()
+        i = keys.get (kind)
+        if i is None:
+            old = None
+            keys[kind] = len (self._sexp)
+            self._sexp.append ([S(kind)] + cdr)
+        else:
+            old = self._sexp[i]
+            self._sexp[i] = old[:1] + cdr
+        self.pcb._changed (self, kind, old)
+
+    @property
+    def sexp (self):
+        # Whoever asks for the raw tree may well change it, so it can't be
+        # passed through verbatim anymore, and neither the item's index nor
+        # the board's can be trusted. The board looks at the item again the
+        # next time it needs to; edits made through a tree held on to after
+        # that aren't seen, so ask for sexp again for each round of edits.
+        self._touch ()
+        self._keys = None
+        self.pcb._changed (self, None, None)
+        return self._sexp
+    @sexp.setter
+    def sexp (self, v):
+        self.pcb._changed (self, None, None)
+        self._sexp = v
+        self._span = None
+        self._keys = None
 
     def out (self):
-        return self.sexp
+        return self._tree ()
 
-class TextSexp (object):
-    def __init__ (self, pcb, sexp):
-        self.sexp = sexp
+class GenericSexp (SexpItem):
+    def __init__ (self, pcb, sexp, span=None, name=None):
+        SexpItem.__init__ (self, pcb, sexp, span)
+        if name:
+            self.name = name
+        else:
+            self.name = symbtostr (self._tree ()[0])
+
+    @property
+    def keyword (self):
+        return self.name
+
+class NetSexp (SexpItem):
+    keyword = "net"
+
+    # Immutable!
+    def __init__ (self, pcb, sexp, span=None):
+        SexpItem.__init__ (self, pcb, sexp, span)
+        tree = self._tree ()
+        self.net_id = tree[1]
+        self.net_name = symbtostr (tree[2])
+
+class TextSexp (SexpItem):
+    keyword = "gr_text"
 
     @property
     def text (self):
-        return self.sexp[1]
+        return self._tree ()[1]
     @text.setter
     def text (self, v):
-        self.sexp[1] = v
+        self._touch ()
+        self._sexp[1] = v
 
-    def out (self):
-        return self.sexp
-
-class ViaSexp (object):
-    def __init__ (self, pcb, sexp):
-        self.sexp = sexp
-        self.pcb = pcb
-
-    def out (self):
-        return self.sexp
+class ViaSexp (SexpItem):
+    keyword = "via"
 
     @property
     def pos (self):
-        return get_from (self.sexp, "at")
+        return self.get_from ("at")
     @pos.setter
     def pos (self, v):
-        sub_in (self.sexp, "at", v)
+        self.sub_in ("at", v)
 
     @property
     def size (self):
-        return get_from (self.sexp, "size")[0]
+        return self.get_value ("size")
     @size.setter
     def size (self, v):
-        sub_in (self.sexp, "size", [v])
+        self.sub_in ("size", [v])
 
     @property
     def drill (self):
-        return get_from (self.sexp, "drill")[0]
+        return self.get_value ("drill")
     @drill.setter
     def drill (self, v):
-        sub_in (self.sexp, "drill", [v])
+        self.sub_in ("drill", [v])
 
     @property
     def annulus (self):
@@ -163,75 +1048,1782 @@ class ViaSexp (object):
 
     @property
     def net (self):
-        return self.pcb.nets[get_from (self.sexp, "net")[0]]
+        return self.pcb.nets[self.get_value ("net")]
     @net.setter
     def net (self, v):
-        for net_id in self.pcb.nets:
-            net_value = self.pcb.nets[net_id]
-            if net_value == v:
-                sub_in (self.sexp, "net", [net_id])
-                break
-        else:
-            raise ValueError ("Tried to set nonexisting net")
+        self.sub_in ("net", [self.pcb.nets.id_of (v)])
 
-class SegmentSexp (object):
-    def __init__ (self, pcb, sexp):
-        self.sexp = sexp
-        self.pcb = pcb
+    @property
+    def layers (self):
+        return self.get_from ("layers")
+    @layers.setter
+    def layers (self, v):
+        self.sub_in ("layers", v)
 
-    def out (self):
-        return self.sexp
+    def on_layer (self, layer):
+        """Whether the via has copper on the given layer, i.e. whether the
+        layer is within the span of its (layers a b)"""
+        span = [symbtostr (i) for i in self.layers]
+        copper = self.pcb.copper_layers
+        try:
+            ends = [copper.index (i) for i in span]
+            return min (ends) <= copper.index (layer) <= max (ends)
+        except ValueError:
+            return layer in span
+
+class SegmentSexp (SexpItem):
+    keyword = "segment"
 
     @property
     def start (self):
-        return get_from (self.sexp, "start")
+        return self.get_from ("start")
     @start.setter
     def start (self, v):
-        sub_in (self.sexp, "start", v)
+        self.sub_in ("start", v)
 
     @property
     def end (self):
-        return get_from (self.sexp, "end")
+        return self.get_from ("end")
     @end.setter
     def end (self, v):
-        sub_in (self.sexp, "end", v)
+        self.sub_in ("end", v)
 
     @property
     def width (self):
-        return get_from (self.sexp, "width")[0]
+        return self.get_value ("width")
     @width.setter
     def width (self, v):
-        sub_in (self.sexp, "width", [v])
+        self.sub_in ("width", [v])
 
     @property
     def layer (self):
-        return get_from (self.sexp, "layer")[0]
+        return self.get_value ("layer")
     @layer.setter
     def layer (self, v):
-        sub_in (self.sexp, "layer", [v])
+        self.sub_in ("layer", [v])
+
+    @property
+    def net (self):
+        return self.pcb.nets[self.get_value ("net")]
+    @net.setter
+    def net (self, v):
+        self.sub_in ("net", [self.pcb.nets.id_of (v)])
+
+    def on_layer (self, layer):
+        return symbtostr (self.layer) == layer
+
+###############################################################################
+# Zones
+#
+# Nearly all of a zone is its outline and fill polygons, thousands of
+# (xy x y) points each. As lists that's a list, a Symbol and two floats per
+# point, so zones keep their (pts ...) as one packed array apiece instead.
+# The text of each (pts ...) is split straight into the array without going
+# through the tokenizer, and written straight back out of it.
+
+class PointList (object):
+    """A (pts (xy x y) ...) node, held as a packed array of x, y pairs"""
+    __slots__ = ("coords",)
+
+    # Lists aren't hashable either; this keeps _flat from trying to use it as
+    # an atom
+    __hash__ = None
+
+    def __init__ (self, coords=()):
+        self.coords = array.array ("d", coords)
+
+    @classmethod
+    def from_text (cls, text):
+        """Parse the (xy x y) ... inside a (pts ...)"""
+        return cls (map (float,
+                         text.replace ("(xy", " ").replace (")", " ").split ()))
+
+    @classmethod
+    def from_sexp (cls, node):
+        """Pack a (pts (xy x y) ...) list. Anything but xy is skipped."""
+        coords = []
+        for i in node[1:]:
+            if type (i) is list and len (i) >= 3 and symbtostr (i[0]) == "xy":
+                coords.append (i[1])
+                coords.append (i[2])
+        return cls (coords)
+
+    def __len__ (self):
+        return len (self.coords) // 2
+
+    def __iter__ (self):
+        it = iter (self.coords)
+        return zip (it, it)
+
+    def __eq__ (self, other):
+        return type (other) is PointList and self.coords == other.coords
+
+    def out (self):
+        """Return the (pts ...) as lists"""
+        xy = S("xy")
+        return [S("pts")] + [[xy, x, y] for x, y in self]
+
+    def _text (self, fmt, depth=None):
+        """Serialize the same as _flat (or _pretty, given a depth) would
+        serialize out ()"""
+        coords = self.coords
+        n = len (coords) // 2
+        if not n:
+            return "(pts)"
+        # Format every number in one go. That's format_number's answer
+        # except for tiny numbers and negative zero, which are rare enough
+        # to just go the slow way when they turn up.
+        text = ("%.10g " * len (coords)) % tuple (coords)
+        if "e" in text or " -0 " in " " + text:
+            numbers = tuple (map (fmt, coords))
+        else:
+            numbers = tuple (text.split ())
+        flat = "(pts " + ("(xy %s %s) " * n % numbers)[:-1] + ")"
+        if depth is None or len (flat) + 2 * depth <= _SEXP_LINE:
+            return flat
+        indent = "\n" + "  " * (depth + 1)
+        return ("(pts" + (indent + "(xy %s %s)") * n % numbers +
+                "\n" + "  " * depth + ")")
+
+    def bbox (self):
+        """Return (x0, y0, x1, y1), or None if there are no points"""
+        if not self.coords:
+            return None
+        xs = self.coords[0::2]
+        ys = self.coords[1::2]
+        return min (xs), min (ys), max (xs), max (ys)
+
+    def area (self):
+        """Area enclosed, by the shoelace formula"""
+        xs = self.coords[0::2]
+        ys = self.coords[1::2]
+        if len (xs) < 3:
+            return 0.
+        xs1 = xs[1:] + xs[:1]
+        ys1 = ys[1:] + ys[:1]
+        return abs (sum (map (operator.mul, xs, ys1)) -
+                    sum (map (operator.mul, xs1, ys))) / 2
+
+    def contains (self, x, y):
+        """Whether (x, y) is inside, by the even-odd rule. KiCad fills are
+        fractured into simple outlines, so that's also right for them."""
+        bbox = self.bbox ()
+        if bbox is None or not (bbox[0] <= x <= bbox[2] and
+                                bbox[1] <= y <= bbox[3]):
+            return False
+        xs = self.coords[0::2]
+        ys = self.coords[1::2]
+        inside = False
+        x0, y0 = xs[-1], ys[-1]
+        for x1, y1 in zip (xs, ys):
+            if (y1 > y) != (y0 > y) and \
+                    x < (x0 - x1) * (y - y1) / (y0 - y1) + x1:
+                inside = not inside
+            x0, y0 = x1, y1
+        return inside
+
+# Nodes _pretty gives lines of their own
+_NESTED_TYPES = (list, PointList)
+
+# A (pts ...) holding nothing but (xy x y). Anything else in there (KiCad 7's
+# arcs) and it's left to the general parser.
+_PTS = S("pts")
+_ZONE_PTS_RE = re.compile (r'\(\s*pts((?:\s*\(xy\s[^()"]*\))*)\s*\)')
+
+def _parse_zone (text, start=0, end=None, atoms=None):
+    """Parse a zone like parse_sexp, but with each (pts ...) packed into a
+    PointList"""
+    if end is None:
+        end = len (text)
+    pieces = []
+    points = []
+    pos = start
+    for m in _ZONE_PTS_RE.finditer (text, start, end):
+        pieces.append (text[pos:m.start ()])
+        pieces.append ("(pts)")
+        points.append (PointList.from_text (m.group (1)))
+        pos = m.end ()
+    if not points:
+        return parse_sexp (text, start, end, atoms)
+    pieces.append (text[pos:end])
+    tree = parse_sexp ("".join (pieces), atoms=atoms)
+
+    # Put the points back in place of the empty (pts), which come in the
+    # same order
+    found = []
+    _find_empty_pts (tree, found)
+    if len (found) != len (points):
+        # Something that looked like (pts ...) was really in a string
+        return parse_sexp (text, start, end, atoms)
+    for (node, i), pts in zip (found, points):
+        node[i] = pts
+    return tree
+
+def _find_empty_pts (node, found):
+    for i, item in enumerate (node):
+        if type (item) is list:
+            if len (item) == 1 and item[0] == _PTS:
+                found.append ((node, i))
+            else:
+                _find_empty_pts (item, found)
+
+def _unpack (node):
+    """Copy of a tree with PointLists turned back into lists"""
+    return [_unpack (i) if type (i) is list
+            else i.out () if type (i) is PointList
+            else i
+            for i in node]
+
+class ZoneSexp (GenericSexp):
+    """A copper zone. Its outline (polygon) and fills (filled_polygon) are
+    kept as PointLists; out () still gives plain lists, and so does sexp,
+    after which the zone stays unpacked.
+
+    Zones used to be GenericSexps, and still are one, name and all."""
+    keyword = "zone"
+
+    _parse = staticmethod (_parse_zone)
+
+    __init__ = SexpItem.__init__
+
+    @property
+    def name (self):
+        return self.keyword
+
+    def out (self):
+        return _unpack (self._tree ())
+
+    def _get_sexp (self):
+        self._touch ()
+        self._sexp = _unpack (self._sexp)
+        self._keys = None
+        self.pcb._changed (self, None, None)
+        return self._sexp
+    sexp = property (_get_sexp, SexpItem.sexp.fset)
 
     @property
     def net (self):
-        return self.pcb.nets[get_from (self.sexp, "net")[0]]
+        return self.pcb.nets[self.get_value ("net")]
     @net.setter
     def net (self, v):
-        for net_id in self.pcb.nets:
-            net_value = self.pcb.nets[net_id]
-            if net_value == v:
-                sub_in (self.sexp, "net", [net_id])
+        self.sub_in ("net", [self.pcb.nets.id_of (v)])
+        self.sub_in ("net_name", [v])
+
+    @property
+    def layers (self):
+        """Names of the layers the zone is on"""
+        layers = self.get_from ("layers")
+        if layers is None:
+            layers = self.get_from ("layer") or []
+        return [symbtostr (i) for i in layers]
+
+    def _polygons (self, keyword, layer):
+        found = []
+        for node in self._tree ()[1:]:
+            if type (node) is not list or not node or \
+                    symbtostr (node[0]) != keyword:
+                continue
+            if layer is not None:
+                own = get_from (node, "layer")
+                if own is not None:
+                    if symbtostr (own[0]) != layer:
+                        continue
+                elif layer not in self.layers:
+                    continue
+            for i in node[1:]:
+                if type (i) is PointList:
+                    found.append (i)
+                elif type (i) is list and i and symbtostr (i[0]) == "pts":
+                    found.append (PointList.from_sexp (i))
+        return found
+
+    def outlines (self):
+        """The outline polygons, as PointLists"""
+        return self._polygons ("polygon", None)
+
+    def fills (self, layer=None):
+        """The filled polygons, as PointLists, optionally only those on one
+        layer"""
+        return self._polygons ("filled_polygon", layer)
+
+    def area (self, filled=True, layer=None):
+        """Area of the fill (or of the outline, if not filled)"""
+        if filled:
+            polys = self.fills (layer)
+        else:
+            polys = self.outlines ()
+        return sum (i.area () for i in polys)
+
+    def bbox (self, filled=False):
+        """Bounding box (x0, y0, x1, y1) of the outline (or of the fill), or
+        None"""
+        boxes = [i.bbox () for i in
+                 (self.fills () if filled else self.outlines ())]
+        boxes = [i for i in boxes if i is not None]
+        if not boxes:
+            return None
+        return (min (i[0] for i in boxes), min (i[1] for i in boxes),
+                max (i[2] for i in boxes), max (i[3] for i in boxes))
+
+    def contains (self, x, y, filled=True, layer=None):
+        """Whether (x, y) is in the fill (or inside the outline, if not
+        filled)"""
+        polys = self.fills (layer) if filled else self.outlines ()
+        return any (i.contains (x, y) for i in polys)
+
+###############################################################################
+
+class PadSexp (object):
+    """A pad in a module. Pads aren't children of the board, so this is just
+    a read-only view onto the (pad ...) node inside the module's tree."""
+
+    def __init__ (self, module, sexp):
+        self.module = module
+        self.sexp = sexp
+        self._pos = None
+
+    @property
+    def number (self):
+        return symbtostr (self.sexp[1])
+
+    @property
+    def shape (self):
+        """rect, circle, oval, roundrect, trapezoid or custom"""
+        return symbtostr (self.sexp[3])
+
+    @property
+    def pos (self):
+        """Absolute [x, y] of the pad centre on the board"""
+        if self._pos is None:
+            mx, my = self.module.get_from ("at")[:2]
+            mrot = self.module.get_from ("at")[2:]
+            x, y = get_from (self.sexp, "at")[:2]
+            if mrot and mrot[0]:
+                # KiCad's y axis points down, so positive angles go clockwise
+                # here to look anticlockwise on screen.
+                a = math.radians (mrot[0])
+                x, y = (x * math.cos (a) + y * math.sin (a),
+                        -x * math.sin (a) + y * math.cos (a))
+            self._pos = [mx + x, my + y]
+        return self._pos
+
+    @property
+    def rotation (self):
+        """Orientation on the board in degrees. KiCad 5 writes a pad's (at x y
+        angle) with the angle already absolute, so it's used as it is."""
+        at = get_from (self.sexp, "at")
+        return at[2] if len (at) > 2 else 0
+
+    @property
+    def size (self):
+        return get_from (self.sexp, "size")
+
+    @property
+    def layers (self):
+        return [symbtostr (i) for i in get_from (self.sexp, "layers")]
+
+    @property
+    def net (self):
+        net = get_from (self.sexp, "net")
+        if net is None or len (net) < 2:
+            return None
+        return symbtostr (net[1])
+
+    @property
+    def net_id (self):
+        net = get_from (self.sexp, "net")
+        if net is None:
+            return None
+        return net[0]
+
+    def distance (self, x, y):
+        """Distance from (x, y) to the pad's copper. Rounded and odd shapes
+        are taken as their bounding rectangle."""
+        px, py = self.pos
+        dx, dy = x - px, y - py
+        rot = self.rotation
+        if rot:
+            a = math.radians (rot)
+            dx, dy = (dx * math.cos (a) - dy * math.sin (a),
+                      dx * math.sin (a) + dy * math.cos (a))
+        w, h = self.size[:2]
+        shape = self.shape
+        if shape == "circle":
+            return max (math.hypot (dx, dy) - w / 2., 0.)
+        elif shape == "oval":
+            r = min (w, h) / 2.
+            return max (_point_segment_distance (
+                dx, dy, -w / 2. + r, -h / 2. + r, w / 2. - r, h / 2. - r) - r,
+                0.)
+        else:
+            return _point_rect_distance (dx, dy, -w / 2., -h / 2.,
+                                         w / 2., h / 2.)
+
+    def on_layer (self, layer):
+        layers = self.layers
+        if layer in layers:
+            return True
+        elif not layer.endswith (".Cu"):
+            return False
+        elif "*.Cu" in layers:
+            return True
+        else:
+            return "F&B.Cu" in layers and layer in ("F.Cu", "B.Cu")
+
+def _copper_layer_names (layers):
+    """Names of the copper layers in a (layers ...) node, top to bottom"""
+    found = []
+    for node in layers[1:]:
+        name = symbtostr (node[1])
+        if name.endswith (".Cu"):
+            found.append ((node[0], name))
+    return [name for num, name in sorted (found)]
+
+class ModuleSexp (GenericSexp):
+    """A footprint. Its pads are decoded the first time they're asked for and
+    kept, along with their board positions and indexes of them by number
+    and by net.
+
+    Modules used to be GenericSexps, and still are one: name is the keyword
+    ("module" or "footprint"), and the library footprint name is footprint.
+    """
+    keyword = "module"
+
+    _pads = None
+    _pads_by_number = None
+    _pads_by_net = None
+
+    __init__ = SexpItem.__init__
+
+    @property
+    def name (self):
+        return self.keyword
+
+    @property
+    def footprint (self):
+        """The library footprint name, e.g. Resistor_SMD:R_0603_1608Metric"""
+        return symbtostr (self._tree ()[1])
+
+    def _text_node (self, kind):
+        # KiCad 5 and 6 have (fp_text reference R1 ...); 7 has
+        # (property "Reference" "R1" ...)
+        prop = kind.capitalize ()
+        for node in self._tree ()[1:]:
+            if type (node) is not list or len (node) < 3:
+                continue
+            head = symbtostr (node[0])
+            if head == "fp_text" and symbtostr (node[1]) == kind or \
+                    head == "property" and symbtostr (node[1]) == prop:
+                return node
+        return None
+
+    def _get_text (self, kind):
+        node = self._text_node (kind)
+        return None if node is None else symbtostr (node[2])
+
+    def _set_text (self, kind, v):
+        self._touch ()
+        node = self._text_node (kind)
+        if node is None:
+            raise ValueError ("module has no %s" % kind)
+        node[2] = v
+
+    @property
+    def reference (self):
+        return self._get_text ("reference")
+    @reference.setter
+    def reference (self, v):
+        self._set_text ("reference", v)
+
+    @property
+    def value (self):
+        return self._get_text ("value")
+    @value.setter
+    def value (self, v):
+        self._set_text ("value", v)
+
+    @property
+    def layer (self):
+        return self.get_value ("layer")
+
+    @property
+    def pos (self):
+        return self.get_from ("at")[:2]
+    @pos.setter
+    def pos (self, v):
+        # Keep the rotation
+        self.sub_in ("at", list (v[:2]) + self.get_from ("at")[2:])
+
+    @property
+    def rotation (self):
+        at = self.get_from ("at")
+        return at[2] if len (at) > 2 else 0
+
+    def sub_in (self, kind, cdr):
+        if kind == "at" and self._pads is not None:
+            # The pads move with us
+            for pad in self._pads:
+                pad._pos = None
+        SexpItem.sub_in (self, kind, cdr)
+
+    # Whoever changes the raw tree may add or remove pads. The board is told
+    # first, while the pads are still the ones it knows about.
+    def _get_sexp (self):
+        tree = SexpItem.sexp.fget (self)
+        self._pads = self._pads_by_number = self._pads_by_net = None
+        return tree
+    def _set_sexp (self, v):
+        SexpItem.sexp.fset (self, v)
+        self._pads = self._pads_by_number = self._pads_by_net = None
+    sexp = property (_get_sexp, _set_sexp)
+
+    @property
+    def pads (self):
+        """All the pads, as PadSexps"""
+        if self._pads is None:
+            self._pads = [PadSexp (self, i) for i in self._tree ()[1:]
+                          if type (i) is list and i and
+                          symbtostr (i[0]) == "pad"]
+        return self._pads
+
+    def pad (self, number):
+        """Return the (first) pad with the given number, or None"""
+        if self._pads_by_number is None:
+            by_number = {}
+            for pad in reversed (self.pads):
+                by_number[pad.number] = pad
+            self._pads_by_number = by_number
+        return self._pads_by_number.get (str (number))
+
+    def pads_on_net (self, net):
+        """Return the pads on the given net, by name"""
+        if self._pads_by_net is None:
+            by_net = {}
+            for pad in self.pads:
+                by_net.setdefault (pad.net, []).append (pad)
+            self._pads_by_net = by_net
+        return list (self._pads_by_net.get (net, ()))
+
+class FootprintSexp (ModuleSexp):
+    """KiCad 6 calls modules footprints"""
+    keyword = "footprint"
+
+def module_pads (module):
+    """Return PadSexps for all the pads in a module"""
+    if isinstance (module, ModuleSexp):
+        return module.pads
+    return [PadSexp (module, i) for i in module.out ()[1:]
+            if isinstance (i, list) and i and symbtostr (i[0]) == "pad"]
+
+NetTable.member_types = (ViaSexp, SegmentSexp, ZoneSexp)
+
+# Child keyword -> class; everything else is a GenericSexp
+_CHILD_TYPES = dict ((i.keyword, i) for i in
+                     (NetSexp, TextSexp, ViaSexp, SegmentSexp, ZoneSexp,
+                      ModuleSexp, FootprintSexp))
+
+###############################################################################
+# Streaming
+#
+# A KicadPCB holds the whole board at once, which for a panel full of filled
+# zones can run to gigabytes. A BoardStream reads the file a chunk at a time
+# and hands out the top-level children as it finds them, so it only ever
+# holds the child it's on plus a chunk of text.
+
+class BoardStream (object):
+    """Read a board one top-level child at a time.
+
+    Iterating over a BoardStream yields the children in order, as the same
+    item classes KicadPCB uses; write() runs them through a chain of
+    transforms on the way to a new file instead. Either way the stream can
+    only be gone through once.
+
+    The nets are collected into .nets as they go past, and KiCad puts them
+    before anything that uses them, so transforms can look nets up by name
+    as usual. Likewise copper_layers, once the layers have gone by.
+    Per-net membership isn't available, since that needs the whole board.
+
+    An item is only good until the stream moves on to the next one: its
+    text is thrown away after that. Take whatever's wanted out of it first.
+    """
+
+    def __init__ (self, filename, chunk_size=1 << 20):
+        self.chunk_size = chunk_size
+        self.nets = NetTable (self)
+        self._copper_layers = None
+        self._file = open (filename, encoding="utf-8")
+        self._buf = ""
+        self._base = 0
+        self._atoms = _AtomTable ()
+        self._trailer = None
+        self._started = False
+
+        # The header is everything up to the first child
+        while True:
+            if not self._fill ():
+                self._file.close ()
+                raise ValueError ("no s-expression found")
+            m = _SEXP_HEAD_RE.match (self._buf)
+            if m is not None and m.end () < len (self._buf):
                 break
+        self._header = self._buf[:m.end ()]
+        self._pos = m.end ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close ()
+
+    def close (self):
+        self._file.close ()
+
+    def _fill (self, min_size=0):
+        """Drop the text that's been dealt with and read some more. Returns
+        False at the end of the file."""
+        if self._started:
+            self._base += self._pos
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        more = self._file.read (max (self.chunk_size, min_size))
+        self._buf += more
+        return bool (more)
+
+    def _spans (self):
+        """Yield (prefix, start, end, keyword) for each child, with start and
+        end indexing into self._buf"""
+        match = _SEXP_CHILD_RE.match
+        while True:
+            buf = self._buf
+            pos = self._pos
+            m = match (buf, pos)
+            if m is not None:
+                self._pos = m.end ()
+                yield m.group (1), m.start (2), m.end (2), m.group (3)
+                continue
+
+            # Either it's nested too deep for the regex, or it isn't all
+            # here yet, or we're at the end
+            error = "unbalanced ( in s-expression"
+            m = _SEXP_KEYWORD_RE.match (buf, pos)
+            if m is not None:
+                try:
+                    end = _find_sexp_end (buf, m.end (1))
+                except ValueError as e:
+                    error = str (e)
+                else:
+                    self._pos = end
+                    yield m.group (1), m.end (1), end, m.group (2)
+                    continue
+            elif _SEXP_TAIL_RE.match (buf, pos):
+                self._trailer = buf[pos:] + self._file.read ()
+                return
+
+            # Read at least as much again as is buffered, so that a huge
+            # child doesn't get rescanned from the start over and over
+            if not self._fill (len (buf) - pos):
+                raise ValueError (error)
+
+    def __iter__ (self):
+        if self._started:
+            raise ValueError ("BoardStream can only be read once")
+        self._started = True
+        for prefix, start, end, keyword in self._spans ():
+            # Sharing atoms across the whole board would mean keeping every
+            # distinct coordinate forever; start afresh now and then
+            if len (self._atoms) > 65536:
+                self._atoms = _AtomTable ()
+            cls = _CHILD_TYPES.get (keyword)
+            span = (self._base + start, self._base + end)
+            if cls is None:
+                child = GenericSexp (self, None, span, name=keyword)
+            else:
+                child = cls (self, None, span)
+            child._prefix = prefix
+            if cls is NetSexp:
+                self.nets[child.net_id] = child.net_name
+            elif keyword == "layers":
+                self._copper_layers = _copper_layer_names (child.out ())
+            yield child
+
+    def _span_text (self, span):
+        start = span[0] - self._base
+        if start < 0:
+            raise ValueError ("streamed item used after the stream moved on")
+        return self._buf[start:span[1] - self._base]
+
+    def _parse_span (self, span, parse=parse_sexp):
+        start = span[0] - self._base
+        if start < 0:
+            raise ValueError ("streamed item used after the stream moved on")
+        return parse (self._buf, start, span[1] - self._base, self._atoms)
+
+    def _changed (self, item, kind, old):
+        pass
+
+    @property
+    def copper_layers (self):
+        if self._copper_layers is None:
+            raise ValueError ("layers haven't been read yet")
+        return self._copper_layers
+
+    def write (self, filename, transforms=(), indent=False, reformat=False):
+        """Stream the board into filename, passing each child through the
+        transforms in turn. A transform takes an item and returns it (changed
+        or not), a replacement, a list of items to put in its place, or None
+        to drop it. Everything else works like KicadPCB.write.
+
+        Returns (number of children read, number written).
+        """
+        atoms = _AtomFormats ()
+        fmt = atoms.__getitem__
+        n_read = n_written = 0
+        stats = kicad_stats.active
+        if stats is not None:
+            transforms = [_timed_transform (i, stats) for i in transforms]
+        with kicad_stats.phase ("stream.write"), \
+                open (filename, 'w', encoding="utf-8") as f:
+            f.write (self._header)
+            out = []
+            for item in self:
+                n_read += 1
+                items = [item]
+                for transform in transforms:
+                    done = []
+                    for i in items:
+                        i = transform (i)
+                        if i is None:
+                            continue
+                        elif isinstance (i, list):
+                            done.extend (i)
+                        else:
+                            done.append (i)
+                    items = done
+                for i in items:
+                    out.append (i._prefix)
+                    if (i._span is not None and i.pcb is self
+                            and not reformat):
+                        out.append (self._span_text (i._span))
+                    elif indent:
+                        out.append (_pretty (i._tree (), fmt, 1))
+                    else:
+                        out.append (_flat (i._tree (), fmt))
+                n_written += len (items)
+                if len (out) >= 4096:
+                    f.write ("".join (out))
+                    del out[:]
+                if len (atoms) > 65536:
+                    atoms.clear ()
+            out.append (self._trailer)
+            f.write ("".join (out))
+        self.close ()
+        if stats is not None:
+            stats.read (self._file.name, os.path.getsize (self._file.name))
+            stats.written (filename, os.path.getsize (filename))
+            stats.count ("stream.read", n_read)
+            stats.count ("stream.written", n_written)
+        return n_read, n_written
+
+def _timed_transform (transform, stats):
+    name = "stream.%s" % pass_name (transform)
+    def timed (item):
+        t0 = time.perf_counter ()
+        result = transform (item)
+        stats.add_time (name, time.perf_counter () - t0)
+        return result
+    return timed
+
+###############################################################################
+# Spatial index
+
+def _point_segment_distance (px, py, x0, y0, x1, y1):
+    dx = x1 - x0
+    dy = y1 - y0
+    length2 = dx * dx + dy * dy
+    if length2:
+        t = ((px - x0) * dx + (py - y0) * dy) / length2
+        t = min (max (t, 0.), 1.)
+        x0 += t * dx
+        y0 += t * dy
+    return math.hypot (px - x0, py - y0)
+
+def _point_rect_distance (px, py, x0, y0, x1, y1):
+    dx = max (x0 - px, 0., px - x1)
+    dy = max (y0 - py, 0., py - y1)
+    return math.hypot (dx, dy)
+
+def _segments_cross (ax0, ay0, ax1, ay1, bx0, by0, bx1, by1):
+    def orient (px, py, qx, qy, rx, ry):
+        v = (qx - px) * (ry - py) - (qy - py) * (rx - px)
+        return (v > 0) - (v < 0)
+    return (orient (ax0, ay0, ax1, ay1, bx0, by0)
+            * orient (ax0, ay0, ax1, ay1, bx1, by1) <= 0
+            and orient (bx0, by0, bx1, by1, ax0, ay0)
+            * orient (bx0, by0, bx1, by1, ax1, ay1) <= 0)
+
+def _segment_rect_distance (sx0, sy0, sx1, sy1, x0, y0, x1, y1):
+    if (x0 <= sx0 <= x1 and y0 <= sy0 <= y1) or \
+            (x0 <= sx1 <= x1 and y0 <= sy1 <= y1):
+        return 0.
+    corners = ((x0, y0), (x1, y0), (x1, y1), (x0, y1))
+    for (ax, ay), (bx, by) in zip (corners, corners[1:] + corners[:1]):
+        if _segments_cross (sx0, sy0, sx1, sy1, ax, ay, bx, by):
+            return 0.
+    return min (
+        _point_rect_distance (sx0, sy0, x0, y0, x1, y1),
+        _point_rect_distance (sx1, sy1, x0, y0, x1, y1),
+        *(_point_segment_distance (cx, cy, sx0, sy0, sx1, sy1)
+          for cx, cy in corners))
+
+def item_shape (item):
+    """Return an item's copper as a capsule: (x0, y0, x1, y1, radius), i.e.
+    everything within radius of the line from (x0, y0) to (x1, y1). Vias are
+    circles, pads are approximated by their bounding circle."""
+    if isinstance (item, SegmentSexp):
+        x0, y0 = item.start[:2]
+        x1, y1 = item.end[:2]
+        return (x0, y0, x1, y1, item.width / 2.)
+    elif isinstance (item, ViaSexp):
+        x, y = item.pos[:2]
+        return (x, y, x, y, item.size / 2.)
+    elif isinstance (item, PadSexp):
+        x, y = item.pos
+        w, h = item.size[:2]
+        return (x, y, x, y, math.hypot (w, h) / 2.)
+    else:
+        raise TypeError ("no shape for %r" % item)
+
+class SpatialIndex (object):
+    """Uniform grid over the vias, segments and module pads of a board.
+
+    Each item is filed under every grid cell its copper touches. Get one
+    from KicadPCB.spatial_index(), which keeps it in step as items are
+    added, deleted or moved (through their properties or sub_in).
+
+    Distances are between an item's copper and the query point or window, so
+    a distance of zero means touching.
+    """
+
+    # Fields whose change moves an item's copper
+    geometry_fields = frozenset (("at", "start", "end", "width", "size"))
+
+    def __init__ (self, pcb, cell=None):
+        self.pcb = pcb
+        self._grid = {}
+        self._entries = {}
+        self._pads = {}
+        self._bounds = None
+        # Items whose trees were handed out, to be filed again as they are
+        # by the next lookup
+        self._dirty = {}
+
+        with _gc_paused ():
+            self._build (cell)
+
+    def _build (self, cell):
+        items = []
+        for kind in (ViaSexp, SegmentSexp):
+            items.extend (self.pcb.view_types (kind))
+        for module in self._modules ():
+            pads = self._pads[module] = module_pads (module)
+            items.extend (pads)
+        shapes = [item_shape (i) for i in items]
+
+        if cell is None:
+            # Aim for a handful of items per cell
+            if shapes:
+                xs = [i[0] for i in shapes] + [i[2] for i in shapes]
+                ys = [i[1] for i in shapes] + [i[3] for i in shapes]
+                area = (max (xs) - min (xs)) * (max (ys) - min (ys))
+                cell = 2. * math.sqrt (area / len (shapes))
+            cell = max (cell or 1., 0.1)
+        self.cell = cell
+
+        for item, shape in zip (items, shapes):
+            self._insert (item, shape)
+
+    def _modules (self):
+        for keyword in ("module", "footprint"):
+            for module in self.pcb.view_keyword (keyword):
+                yield module
+
+    def _cell_range (self, lo, hi):
+        c = self.cell
+        return range (int (math.floor (lo / c)), int (math.floor (hi / c)) + 1)
+
+    def _insert (self, item, shape):
+        x0, y0, x1, y1, r = shape
+        c = self.cell
+        floor = math.floor
+        if x0 == x1 and y0 == y1:
+            stops = ((x0, y0),)
+            pad = r
         else:
-            raise ValueError ("Tried to set nonexisting net")
+            # Walk along the capsule in steps no longer than a cell, covering
+            # a square around each stop big enough to reach halfway to the
+            # next.
+            length = math.hypot (x1 - x0, y1 - y0)
+            steps = int (length / c) + 1
+            pad = r + length / steps / 2.
+            dx = (x1 - x0) / steps
+            dy = (y1 - y0) / steps
+            stops = [(x0 + k * dx, y0 + k * dy) for k in range (steps + 1)]
+
+        cells = set ()
+        for x, y in stops:
+            iy0 = floor ((y - pad) / c)
+            iy1 = floor ((y + pad) / c) + 1
+            for ix in range (floor ((x - pad) / c), floor ((x + pad) / c) + 1):
+                for iy in range (iy0, iy1):
+                    cells.add ((ix, iy))
+        cells = tuple (cells)
+
+        grid = self._grid
+        for i in cells:
+            bucket = grid.get (i)
+            if bucket is None:
+                grid[i] = [item]
+            else:
+                bucket.append (item)
+        self._entries[item] = (shape, cells)
+
+        ixs = [i[0] for i in cells]
+        iys = [i[1] for i in cells]
+        if self._bounds is None:
+            self._bounds = (min (ixs), min (iys), max (ixs), max (iys))
+        else:
+            bx0, by0, bx1, by1 = self._bounds
+            self._bounds = (min (bx0, min (ixs)), min (by0, min (iys)),
+                            max (bx1, max (ixs)), max (by1, max (iys)))
+
+    def _remove (self, item):
+        entry = self._entries.pop (item, None)
+        if entry is None:
+            return
+        for i in entry[1]:
+            bucket = self._grid[i]
+            bucket.remove (item)
+            if not bucket:
+                del self._grid[i]
+
+    def _item_added (self, item):
+        if isinstance (item, (ViaSexp, SegmentSexp)):
+            self._insert (item, item_shape (item))
+        elif item.keyword in ("module", "footprint"):
+            pads = self._pads[item] = module_pads (item)
+            for pad in pads:
+                self._insert (pad, item_shape (pad))
+
+    def _item_removed (self, item):
+        self._dirty.pop (item, None)
+        if item in self._entries:
+            self._remove (item)
+        elif item in self._pads:
+            for pad in self._pads.pop (item):
+                self._remove (pad)
+
+    def _item_changed (self, item, kind, old):
+        if kind is None:
+            if item in self._entries or item in self._pads:
+                self._item_removed (item)
+                self._dirty[item] = None
+            return
+        if kind not in self.geometry_fields:
+            return
+        if item in self._entries:
+            self._remove (item)
+            self._insert (item, item_shape (item))
+        elif item in self._pads:
+            self._item_removed (item)
+            self._item_added (item)
+
+    def _refresh (self):
+        if self._dirty:
+            dirty = self._dirty
+            self._dirty = {}
+            for item in dirty:
+                self._item_added (item)
+
+    def _matches (self, item, kind, layer):
+        if kind is not None and not isinstance (item, kind):
+            return False
+        return layer is None or item.on_layer (layer)
+
+    def distance (self, item, x, y):
+        """Distance from (x, y) to the item's copper"""
+        self._refresh ()
+        x0, y0, x1, y1, r = self._entries[item][0]
+        return max (_point_segment_distance (x, y, x0, y0, x1, y1) - r, 0.)
+
+    def in_rect (self, x0, y0, x1, y1, kind=None, layer=None):
+        """Return the items whose copper overlaps the window. kind (a type or
+        tuple of types) and layer narrow it down."""
+        self._refresh ()
+        x0, x1 = min (x0, x1), max (x0, x1)
+        y0, y1 = min (y0, y1), max (y0, y1)
+        seen = set ()
+        found = []
+        grid = self._grid
+        for ix in self._cell_range (x0, x1):
+            for iy in self._cell_range (y0, y1):
+                for item in grid.get ((ix, iy), ()):
+                    if item in seen:
+                        continue
+                    seen.add (item)
+                    sx0, sy0, sx1, sy1, r = self._entries[item][0]
+                    # Bounding boxes first; most candidates fail on those
+                    if min (sx0, sx1) - r > x1 or max (sx0, sx1) + r < x0 or \
+                            min (sy0, sy1) - r > y1 or max (sy0, sy1) + r < y0:
+                        continue
+                    if _segment_rect_distance (sx0, sy0, sx1, sy1,
+                                               x0, y0, x1, y1) > r:
+                        continue
+                    if self._matches (item, kind, layer):
+                        found.append (item)
+        return found
+
+    def in_radius (self, x, y, radius, kind=None, layer=None):
+        """Return the items whose copper comes within radius of (x, y);
+        radius=0 gives the items touching the point."""
+        self._refresh ()
+        seen = set ()
+        found = []
+        grid = self._grid
+        entries = self._entries
+        for ix in self._cell_range (x - radius, x + radius):
+            for iy in self._cell_range (y - radius, y + radius):
+                for item in grid.get ((ix, iy), ()):
+                    if item in seen:
+                        continue
+                    seen.add (item)
+                    x0, y0, x1, y1, r = entries[item][0]
+                    # Bounding boxes first; most candidates fail on those
+                    reach = r + radius
+                    if (x0 - x > reach and x1 - x > reach) or \
+                            (x - x0 > reach and x - x1 > reach) or \
+                            (y0 - y > reach and y1 - y > reach) or \
+                            (y - y0 > reach and y - y1 > reach):
+                        continue
+                    if _point_segment_distance (x, y, x0, y0, x1, y1) - r \
+                            <= radius and self._matches (item, kind, layer):
+                        found.append (item)
+        return found
+
+    def nearest (self, x, y, kind=None, layer=None, max_distance=None):
+        """Return (item, distance) for the item nearest (x, y), or
+        (None, None) if there's nothing (within max_distance)."""
+        self._refresh ()
+        if self._bounds is None:
+            return None, None
+        c = self.cell
+        cx = int (math.floor (x / c))
+        cy = int (math.floor (y / c))
+        bx0, by0, bx1, by1 = self._bounds
+        last_ring = max (cx - bx0, bx1 - cx, cy - by0, by1 - cy, 0)
+        if max_distance is not None:
+            last_ring = min (last_ring, int (max_distance / c) + 1)
+
+        best = None
+        best_d = None
+        seen = set ()
+        grid = self._grid
+        for ring in range (last_ring + 1):
+            if ring:
+                ring_cells = [(cx + i, cy + j)
+                              for i in range (-ring, ring + 1)
+                              for j in (-ring, ring)]
+                ring_cells.extend ((cx + i, cy + j)
+                                   for i in (-ring, ring)
+                                   for j in range (-ring + 1, ring))
+            else:
+                ring_cells = [(cx, cy)]
+            for i in ring_cells:
+                for item in grid.get (i, ()):
+                    if item in seen:
+                        continue
+                    seen.add (item)
+                    d = self.distance (item, x, y)
+                    if best_d is not None and d >= best_d:
+                        continue
+                    if self._matches (item, kind, layer):
+                        best, best_d = item, d
+            # Anything in a cell further out is at least this far away
+            if best_d is not None and best_d <= ring * c:
+                break
+
+        if best is None or (max_distance is not None and best_d > max_distance):
+            return None, None
+        return best, best_d
 
 ###############################################################################
+# Connectivity
+#
+# Copper is worked out one net at a time. Two items on a net are connected
+# if they share a copper layer and one of their anchors (segment ends, via
+# and pad centres) lies on the other's copper. Nearly all connections are
+# track ends meeting exactly, on each other or on a via or pad centre, so
+# anchors are hashed first and those come for free. Then each via, pad and
+# distinct track end gets one trip to the spatial index, for whatever it
+# lands on partway along. The islands fall out of a union-find.
+#
+# Edits only mark the nets they touch as stale, and a stale net is worked
+# out again the next time it's asked about.
+
+class _UnionFind (dict):
+    """item -> parent"""
+    def find (self, x):
+        root = x
+        while self[root] is not root:
+            root = self[root]
+        while self[x] is not root:
+            self[x], x = root, self[x]
+        return root
+
+    def union (self, a, b):
+        a = self.find (a)
+        b = self.find (b)
+        if a is not b:
+            self[a] = b
+
+def _anchor_key (layer, x, y):
+    # To the nanometre, which is what KiCad works in
+    return (layer, int (round (x * 1e6)), int (round (y * 1e6)))
+
+class Connectivity (object):
+    """Copper islands of each net, over segments, vias and module pads.
+    Zones aren't counted. Get one from KicadPCB.connectivity().
+
+    Nets are identified by name or id, as with find_on_net.
+    """
+
+    # Fields whose change can connect or disconnect an item
+    fields = frozenset (("at", "start", "end", "width", "size", "layer",
+                         "layers", "net"))
+
+    def __init__ (self, pcb):
+        self.pcb = pcb
+        # net id -> (list of islands, list of (segment, end) left dangling)
+        self._nets = {}
+        # Items whose trees were handed out; whatever nets they end up on
+        # are stale too
+        self._dirty = {}
+
+    def _net_id (self, net):
+        if isinstance (net, int):
+            return net
+        return self.pcb.nets.id_of (net)
+
+    def _stale (self, net_id):
+        self._nets.pop (net_id, None)
+
+    def _net (self, net_id):
+        if self._dirty:
+            dirty = self._dirty
+            self._dirty = {}
+            for item in dirty:
+                self._item_added (item)
+        result = self._nets.get (net_id)
+        if result is None:
+            stats = kicad_stats.active
+            t0 = time.perf_counter () if stats is not None else None
+            result = self._nets[net_id] = self._build (net_id)
+            if stats is not None:
+                stats.add_time ("pcb.connectivity", time.perf_counter () - t0)
+        return result
+
+    def _touches (self, item, x, y):
+        """Whether (x, y) is on item's copper"""
+        if isinstance (item, PadSexp):
+            return item.distance (x, y) <= 0
+        x0, y0, x1, y1, r = item_shape (item)
+        return _point_segment_distance (x, y, x0, y0, x1, y1) <= r
+
+    def _build (self, net_id):
+        pcb = self.pcb
+        segments = []
+        others = []
+        for item in pcb.nets.members (net_id):
+            if isinstance (item, SegmentSexp):
+                segments.append (item)
+            elif isinstance (item, ViaSexp):
+                others.append (item)
+        others.extend (pcb.nets.pads (net_id))
+
+        uf = _UnionFind ()
+        for item in segments:
+            uf[item] = item
+        copper = pcb.copper_layers
+        layers_of = {}
+        for item in others:
+            uf[item] = item
+            layers_of[item] = [i for i in copper if item.on_layer (i)]
+
+        # Hash every anchor
+        anchors = {}
+        ends = []
+        for seg in segments:
+            layer = symbtostr (seg.layer)
+            for end in ("start", "end"):
+                x, y = getattr (seg, end)[:2]
+                key = _anchor_key (layer, x, y)
+                anchors.setdefault (key, []).append (seg)
+                ends.append ((seg, end, layer, x, y, key))
+        for item in others:
+            x, y = item.pos[:2]
+            for layer in layers_of[item]:
+                anchors.setdefault (_anchor_key (layer, x, y), []).append (item)
+        for items in anchors.values ():
+            for i in items[1:]:
+                uf.union (items[0], i)
+
+        # Vias and pads against whatever's under them
+        index = pcb.spatial_index ()
+        members = uf.__contains__
+        attached = set ()
+        for item in others:
+            x, y = item.pos[:2]
+            x0, y0, x1, y1, r = item_shape (item)
+            layers = layers_of[item]
+            for other in index.in_radius (x, y, r):
+                if other is item or not members (other):
+                    continue
+                if isinstance (other, SegmentSexp):
+                    if symbtostr (other.layer) not in layers:
+                        continue
+                    hit = False
+                    for end in ("start", "end"):
+                        ex, ey = getattr (other, end)[:2]
+                        if self._touches (item, ex, ey):
+                            attached.add ((other, end))
+                            hit = True
+                    if hit or self._touches (other, x, y):
+                        uf.union (item, other)
+                elif any (i in layers for i in layers_of[other]) and \
+                        self._touches (other, x, y):
+                    uf.union (item, other)
+
+        # Track ends against tracks running past them (T junctions, and
+        # ends meeting on the middle of another track), once per anchor
+        # however many ends share it. Ends with nothing else at them are
+        # dangling.
+        dangling = []
+        occupied = {}
+        for seg, end, layer, x, y, key in ends:
+            hit = occupied.get (key)
+            if hit is None:
+                here = anchors[key]
+                hit = len (here) > 1
+                for other in index.in_radius (x, y, 0, kind=SegmentSexp,
+                                              layer=layer):
+                    if members (other) and other not in here:
+                        uf.union (here[0], other)
+                        hit = True
+                occupied[key] = hit
+            if not hit and (seg, end) not in attached:
+                dangling.append ((seg, end))
+
+        islands = {}
+        for item in uf:
+            islands.setdefault (uf.find (item), []).append (item)
+        islands = sorted (islands.values (), key=len, reverse=True)
+        return islands, dangling
 
-def remove_stacked_vias (pcb):
+    def islands (self, net):
+        """Return the net's copper islands, each a list of items, biggest
+        first"""
+        return [list (i) for i in self._net (self._net_id (net))[0]]
+
+    def island_of (self, item):
+        """Return the island an item (segment, via or pad) is part of"""
+        if isinstance (item, PadSexp):
+            net_id = item.net_id
+        else:
+            net_id = item.get_value ("net")
+        for island in self._net (net_id)[0]:
+            if item in island:
+                return list (island)
+        return None
+
+    def connected (self, a, b):
+        """Whether two items are connected through copper"""
+        island = self.island_of (a)
+        return island is not None and b in island
+
+    def dangling (self, net=None):
+        """Return (segment, "start" or "end") for every segment end that
+        isn't connected to anything, on one net or all of them"""
+        if net is not None:
+            return list (self._net (self._net_id (net))[1])
+        found = []
+        with _gc_paused ():
+            for net_id in sorted (self.pcb.nets):
+                found.extend (self._net (net_id)[1])
+        return found
+
+    def split_nets (self):
+        """Return {net name: number of islands} for every net that's in more
+        than one piece"""
+        split = {}
+        with _gc_paused ():
+            for net_id in sorted (self.pcb.nets):
+                n = len (self._net (net_id)[0])
+                if n > 1:
+                    split[self.pcb.nets[net_id]] = n
+        return split
+
+    # Keeping up with the board. Anything that could make or break a
+    # connection marks the nets involved as stale.
+    def _item_added (self, item):
+        if isinstance (item, (SegmentSexp, ViaSexp)):
+            self._stale (item.get_value ("net"))
+        elif isinstance (item, ModuleSexp):
+            for pad in item.pads:
+                self._stale (pad.net_id)
+
+    _item_removed = _item_added
+
+    def _item_changed (self, item, kind, old):
+        if kind is None:
+            self._item_added (item)
+            self._dirty[item] = None
+            return
+        if kind not in self.fields:
+            return
+        self._item_added (item)
+        if kind == "net" and old is not None:
+            self._stale (old[1])
+
+###############################################################################
+# Columnar access
+
+# The fields of an untouched segment or via are picked straight out of its
+# text. The regexes hard-code the order KiCad 5 writes them in; anything else
+# (another version's order, an extra field in between such as tstamp, or an
+# edited item) doesn't match and is read from its tree instead.
+_NUMBER_TEXT = r'\s+([-+]?[\d.]+)'
+_LAYER_TEXT = r'\s+"?([^\s()"]+)"?'
+_SEGMENT_TEXT_RE = re.compile (
+    r'\(segment\s+\(start%s%s\s*\)\s*\(end%s%s\s*\)\s*\(width%s\s*\)'
+    r'\s*\(layer%s\s*\)\s*\(net\s+(\d+)\s*\)'
+    % ((_NUMBER_TEXT,) * 5 + (_LAYER_TEXT,)))
+_VIA_TEXT_RE = re.compile (
+    r'\(via\s+\(at%s%s\s*\)\s*\(size%s\s*\)\s*\(drill%s\s*\)'
+    r'\s*\(layers%s%s\s*\)\s*\(net\s+(\d+)\s*\)'
+    % ((_NUMBER_TEXT,) * 4 + (_LAYER_TEXT,) * 2))
+
+class TrackArrays (object):
+    """The vias and segments of a board as NumPy arrays, for vectorized
+    edits. Get one from KicadPCB.export_tracks(), change the arrays in place
+    or replace them with arrays of the same shape, and hand it back to
+    KicadPCB.import_tracks().
+
+    Row i of the via_* arrays is vias[i]; likewise seg_* and segments.
+
+        via_pos         (n, 2) float
+        via_size        (n,) float
+        via_drill       (n,) float
+        via_layers      (n, 2) int, codes into layers
+        via_net         (n,) int, net ids
+        seg_start       (n, 2) float
+        seg_end         (n, 2) float
+        seg_width       (n,) float
+        seg_layer       (n,) int, codes into layers
+        seg_net         (n,) int, net ids
+
+    Missing fields come out as NaN (or -1 for codes and ids) and are left
+    alone on import. A layer code of -1 in a row that's been changed means
+    leave that layer as it is; an item with no layer there to keep raises
+    ValueError, as does any other code that isn't in layers.
+    """
+
+    _via_columns = ("via_pos", "via_size", "via_drill", "via_layers", "via_net")
+    _seg_columns = ("seg_start", "seg_end", "seg_width", "seg_layer", "seg_net")
+
+    def __init__ (self, pcb):
+        import numpy
+        self.pcb = pcb
+        self.vias = pcb.find_types (ViaSexp)
+        self.segments = pcb.find_types (SegmentSexp)
+
+        # Copper first, in stack order, so that codes compare like depths
+        self.layers = list (pcb.copper_layers)
+        self._layer_codes = dict ((name, i) for i, name in enumerate (self.layers))
+
+        nan = float ("nan")
+        def value (item, kind):
+            v = item.get_value (kind)
+            return nan if v is None else v
+        def point (item, kind):
+            v = item.get_from (kind)
+            return (nan, nan) if v is None else tuple (v[:2])
+        def net (item):
+            v = item.get_value ("net")
+            return -1 if v is None else v
+        def layer_name (v):
+            return None if v is None else symbtostr (v)
+
+        def via_row (item):
+            layers = item.get_from ("layers") or [None, None]
+            return (point (item, "at") + (value (item, "size"),
+                                          value (item, "drill"),
+                                          layer_name (layers[0]),
+                                          layer_name (layers[-1]),
+                                          net (item)))
+        def seg_row (item):
+            return (point (item, "start") + point (item, "end") +
+                    (value (item, "width"),
+                     layer_name (item.get_value ("layer")), net (item)))
+
+        with _gc_paused ():
+            # Columns of mixed numbers and number text straight from the
+            # file; numpy converts both
+            vias = self.vias
+            cols = self._read_rows (vias, _VIA_TEXT_RE, via_row, 7)
+            self.via_pos = numpy.array (cols[0:2], dtype=float).T.copy ()
+            self.via_size = numpy.array (cols[2], dtype=float)
+            self.via_drill = numpy.array (cols[3], dtype=float)
+            self.via_layers = numpy.array (
+                [self._layer_codes_of (cols[4]),
+                 self._layer_codes_of (cols[5])], dtype=int).T.copy ()
+            self.via_net = numpy.array (cols[6], dtype=int)
+
+            segs = self.segments
+            cols = self._read_rows (segs, _SEGMENT_TEXT_RE, seg_row, 7)
+            self.seg_start = numpy.array (cols[0:2], dtype=float).T.copy ()
+            self.seg_end = numpy.array (cols[2:4], dtype=float).T.copy ()
+            self.seg_width = numpy.array (cols[4], dtype=float)
+            self.seg_layer = numpy.array (self._layer_codes_of (cols[5]),
+                                          dtype=int)
+            self.seg_net = numpy.array (cols[6], dtype=int)
+
+        # What was read, to work out what changed
+        self._original = dict ((i, getattr (self, i).copy ())
+                               for i in self._via_columns + self._seg_columns)
+
+    def layer_code (self, name):
+        """Return the code for a layer name, adding it if it's new"""
+        if name is None:
+            return -1
+        name = symbtostr (name)
+        code = self._layer_codes.get (name)
+        if code is None:
+            code = self._layer_codes[name] = len (self.layers)
+            self.layers.append (name)
+        return code
+
+    def _layer_codes_of (self, names):
+        codes = self._layer_codes
+        return [codes[i] if i in codes else self.layer_code (i)
+                for i in names]
+
+    def _read_rows (self, items, regex, slow, width):
+        """Read the fields of each item into width columns. Items that are
+        just as they were read get theirs picked out of the file's text;
+        the rest go through slow (item), which returns a row."""
+        pcb = self.pcb
+        text = getattr (pcb, "_text", None)
+        rows = []
+        for item in items:
+            span = item._span
+            if span is not None and text is not None and item.pcb is pcb:
+                m = regex.match (text, span[0], span[1])
+                if m is not None:
+                    rows.append (m.groups ())
+                    continue
+            rows.append (slow (item))
+        if not rows:
+            return [[] for i in range (width)]
+        return [list (i) for i in zip (*rows)]
+
+    def net_ids (self, names):
+        """Return an array of the ids of the named nets, for use with
+        numpy.isin"""
+        import numpy
+        return numpy.array ([self.pcb.nets.id_of (i) for i in names], dtype=int)
+
+    def _changed_rows (self, column):
+        import numpy
+        new = numpy.asarray (getattr (self, column))
+        old = self._original[column]
+        if new.shape != old.shape:
+            raise ValueError ("%s changed shape from %r to %r" % (
+                column, old.shape, new.shape))
+        differs = new != old
+        if new.dtype.kind == "f":
+            differs &= ~(numpy.isnan (new) & numpy.isnan (old))
+        if differs.ndim > 1:
+            differs = differs.any (axis=1)
+        return numpy.nonzero (differs)[0], new
+
+    def _write_back (self, pcb):
+        if pcb is not self.pcb:
+            raise ValueError ("these arrays came from a different board")
+
+        nets = pcb.nets
+        layers = self.layers
+        def point (v, item):
+            return [float (v[0]), float (v[1])]
+        def number (v, item):
+            return [float (v)]
+        def layer (code, old):
+            code = int (code)
+            if code == -1 and old is not None:
+                # Unknown; leave whatever was there alone
+                return old
+            if not 0 <= code < len (layers):
+                raise ValueError ("no layer with code %d" % code)
+            return S(layers[code])
+        def via_layers (v, item):
+            old = item.get_from ("layers") or [None]
+            return [layer (v[0], old[0]), layer (v[1], old[-1])]
+        def seg_layer (v, item):
+            return [layer (v, item.get_value ("layer"))]
+        def net (v, item):
+            if int (v) not in nets:
+                raise ValueError ("Tried to set nonexisting net")
+            return [int (v)]
+
+        # column -> (keyword, (value, item) -> cdr). For points, keep
+        # anything past x y (e.g. a rotation) that was there already.
+        how = {
+            "via_pos": ("at", point),
+            "via_size": ("size", number),
+            "via_drill": ("drill", number),
+            "via_layers": ("layers", via_layers),
+            "via_net": ("net", net),
+            "seg_start": ("start", point),
+            "seg_end": ("end", point),
+            "seg_width": ("width", number),
+            "seg_layer": ("layer", seg_layer),
+            "seg_net": ("net", net),
+        }
+
+        # Work out every change before making any, so that a bad value
+        # doesn't leave the board half edited.
+        edits = []
+        snapshots = {}
+        with _gc_paused ():
+            for columns, items in ((self._via_columns, self.vias),
+                                   (self._seg_columns, self.segments)):
+                for column in columns:
+                    kind, to_cdr = how[column]
+                    rows, values = self._changed_rows (column)
+                    for row in rows.tolist ():
+                        item = items[row]
+                        cdr = to_cdr (values[row], item)
+                        if kind == "at":
+                            cdr += (item.get_from ("at") or [])[2:]
+                        edits.append ((item, kind, cdr))
+                    snapshots[column] = values.copy ()
+
+            for item, kind, cdr in edits:
+                item.sub_in (kind, cdr)
+        self._original.update (snapshots)
+        return len (set (i[0] for i in edits))
+
+###############################################################################
+# Board cache
+#
+# Scripts tend to run pass after pass over the same unchanged boards, and
+# each one pays for parsing them again. A BoardCache keeps what KicadPCB
+# works out from the text in a directory: the child spans, as packed arrays
+# with the keywords and leading whitespace numbered, and unless the board is
+# lazy, the parsed trees.
+#
+# Turning a million lists back into objects takes nearly as long whether
+# they come from a pickle or anywhere else, so the trees aren't all
+# unpickled up front. They're pickled in batches of children with the same
+# keyword, and a batch is only unpickled when something first looks inside
+# one of its children. A board comes back from the cache about as fast as a
+# lazy one, and a pass that only looks at the vias only pays for the vias.
+
+# Bump this whenever what gets cached changes shape
+_CACHE_VERSION = 2
+
+# Children per batch of trees
+_CACHE_BATCH = 4096
+
+def _array_from (typecode, data):
+    a = array.array (typecode)
+    a.frombytes (data)
+    return a
+
+class BoardCache (object):
+    """On-disk cache of parsed boards, for KicadPCB (filename, cache=...).
+
+    Entries are keyed either by a hash of the board's contents (key="hash",
+    the default) or by its path, size and modification time (key="mtime",
+    which doesn't have to hash the file but can be fooled by tools that
+    preserve mtimes). Either way an edited board gets a new key, so stale
+    entries are never used; they just age out. Once the directory holds
+    more than max_size bytes, the least recently used entries are deleted.
+
+    Entries are pickles, and loading one can run arbitrary code: only point
+    this at a directory nobody else can write to.
+    """
+
+    suffix = ".pcbcache"
+
+    def __init__ (self, directory, max_size=256 * 1024 * 1024, key="hash"):
+        if key not in ("hash", "mtime"):
+            raise ValueError ("cache key must be 'hash' or 'mtime'")
+        self.directory = directory
+        self.max_size = max_size
+        self.key = key
+        os.makedirs (directory, exist_ok=True)
+
+    def _path (self, filename, text, lazy, st=None):
+        h = hashlib.sha1 (("%d %s\n" % (_CACHE_VERSION,
+                                         "lazy" if lazy else "full"))
+                          .encode ("ascii"))
+        if self.key == "hash":
+            h.update (text.encode ("utf-8"))
+        else:
+            if st is None:
+                st = os.stat (filename)
+            h.update (("%s\n%d\n%d" % (os.path.abspath (filename),
+                                        st.st_size, st.st_mtime_ns))
+                      .encode ("utf-8", "surrogateescape"))
+        return os.path.join (self.directory, h.hexdigest () + self.suffix)
+
+    def load (self, filename, text, lazy, st=None):
+        """Return the cached (header, spans, trailer, batches) for a board,
+        or None. batches is a list of (child starts, pickled trees), or None
+        for lazy boards. With key="mtime", text isn't looked at and may be
+        None; st is the board's os.stat, if it's already been taken."""
+        path = self._path (filename, text, lazy, st)
+        try:
+            with open (path, "rb") as f:
+                data = f.read ()
+        except FileNotFoundError:
+            return None
+        try:
+            with _gc_paused ():
+                entry = pickle.loads (data)
+            if len (entry) != 10 or entry[0] != _CACHE_VERSION:
+                return None
+            (version, header, trailer, keywords, prefixes, starts, ends,
+             kinds, prefix_ids, batches) = entry
+            starts = _array_from ("q", starts).tolist ()
+            spans = list (zip (
+                map (prefixes.__getitem__, _array_from ("I", prefix_ids)),
+                starts, _array_from ("q", ends).tolist (),
+                map (keywords.__getitem__, _array_from ("I", kinds))))
+            if batches is not None:
+                batches = [(_array_from ("q", i).tolist (), trees)
+                           for i, trees in batches]
+        except Exception:
+            # Truncated or from some other version; parse it again and the
+            # entry will be replaced.
+            return None
+        try:
+            # Mark it recently used
+            os.utime (path)
+        except OSError:
+            pass
+        return header, spans, trailer, batches
+
+    def store (self, filename, text, lazy, header, spans, trailer, trees,
+               st=None):
+        path = self._path (filename, text, lazy, st)
+        keywords = {}
+        prefixes = {}
+        starts = array.array ("q")
+        ends = array.array ("q")
+        kinds = array.array ("I")
+        prefix_ids = array.array ("I")
+        for prefix, start, end, keyword in spans:
+            starts.append (start)
+            ends.append (end)
+            kinds.append (keywords.setdefault (keyword, len (keywords)))
+            prefix_ids.append (prefixes.setdefault (prefix, len (prefixes)))
+
+        batches = None
+        with _gc_paused ():
+            if trees is not None:
+                by_keyword = {}
+                for i, span in enumerate (spans):
+                    by_keyword.setdefault (span[3], []).append (i)
+                batches = []
+                for indices in by_keyword.values ():
+                    for j in range (0, len (indices), _CACHE_BATCH):
+                        batch = indices[j:j + _CACHE_BATCH]
+                        batches.append ((
+                            array.array ("q", [starts[i] for i in batch])
+                            .tobytes (),
+                            pickle.dumps ([trees[i] for i in batch],
+                                          pickle.HIGHEST_PROTOCOL)))
+            data = pickle.dumps ((
+                _CACHE_VERSION, header, trailer, list (keywords),
+                list (prefixes), starts.tobytes (), ends.tobytes (),
+                kinds.tobytes (), prefix_ids.tobytes (), batches),
+                pickle.HIGHEST_PROTOCOL)
+        if len (data) > self.max_size:
+            return
+        # Write it under a temporary name and rename it into place, so that
+        # another process never sees half an entry.
+        fd, tmp = tempfile.mkstemp (dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen (fd, "wb") as f:
+                f.write (data)
+            os.replace (tmp, path)
+        except BaseException:
+            os.unlink (tmp)
+            raise
+        self._evict ()
+
+    def _entries (self):
+        entries = []
+        for entry in os.scandir (self.directory):
+            if not entry.name.endswith (self.suffix):
+                continue
+            try:
+                st = entry.stat ()
+            except FileNotFoundError:
+                continue
+            entries.append ((st.st_mtime_ns, st.st_size, entry.path))
+        return entries
+
+    def size (self):
+        """Total size of the cache entries, in bytes"""
+        return sum (i[1] for i in self._entries ())
+
+    def _evict (self):
+        entries = self._entries ()
+        total = sum (i[1] for i in entries)
+        entries.sort ()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink (path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear (self):
+        """Delete every entry"""
+        for mtime, size, path in self._entries ():
+            try:
+                os.unlink (path)
+            except FileNotFoundError:
+                pass
+
+###############################################################################
+
+def remove_stacked_vias (pcb, tolerance=0):
     """KiCad's new renderer has a thing for making stacks of vias at the
     exact same position. This will remove all but one of them.
 
+    With a tolerance, vias whose centres are within that distance of a via
+    that's being kept count as stacked on it too.
+
     Returns (number of stacks cleaned up, number of vias cleaned up)
     """
 
+    if tolerance:
+        return _remove_near_vias (pcb, tolerance)
+
     vias = pcb.find_types (ViaSexp)
     vias_by_pos = {}
     
@@ -251,7 +2843,365 @@ def remove_stacked_vias (pcb):
             vias_to_delete.extend (stack[1:])
             n_stacks += 1
 
-    for via in vias_to_delete:
-        pcb.delete (via)
+    pcb.delete_many (vias_to_delete)
 
     return n_stacks, len (vias_to_delete)
+
+def _remove_near_vias (pcb, tolerance):
+    index = pcb.spatial_index ()
+    vias_to_delete = []
+    doomed = set ()
+    n_stacks = 0
+
+    for via in pcb.find_types (ViaSexp):
+        if via in doomed:
+            continue
+        x, y = via.pos[:2]
+        stack = []
+        for other in index.in_radius (x, y, tolerance, kind=ViaSexp):
+            if other is via or other in doomed:
+                continue
+            ox, oy = other.pos[:2]
+            if math.hypot (ox - x, oy - y) <= tolerance:
+                stack.append (other)
+        if stack:
+            # Keep the one that comes first on the board
+            vias_to_delete.extend (stack)
+            doomed.update (stack)
+            n_stacks += 1
+
+    pcb.delete_many (vias_to_delete)
+
+    return n_stacks, len (vias_to_delete)
+
+def merge_collinear_segments (pcb, tolerance=1e-4):
+    """Autorouters and importers leave chains of short segments end to end
+    in a straight line. This replaces each chain with one segment.
+
+    Segments are chained where exactly two ends meet, with nothing else (no
+    third segment, via or pad) at that point, both on the same layer and net
+    with the same width, and where the joint is within tolerance of the line
+    between the far ends. The finished segment keeps every joint within
+    tolerance. Requires NumPy.
+
+    Returns (number of chains merged, number of segments removed)
+    """
+    with _gc_paused ():
+        return _merge_collinear_segments (pcb, tolerance)
+
+def _merge_collinear_segments (pcb, tolerance):
+    import numpy
+
+    arrays = pcb.export_tracks ()
+    segments = arrays.segments
+    n = len (segments)
+    if n < 2:
+        return 0, 0
+
+    # Every end, hashed to the nanometre along with its layer, and sorted so
+    # that ends at the same place come out together
+    ends = numpy.concatenate ((arrays.seg_start, arrays.seg_end))
+    with numpy.errstate (invalid="ignore"):
+        q = numpy.rint (ends * 1e6)
+    ok = numpy.isfinite (q).all (axis=1)
+    q = numpy.where (ok[:, None], q, 0).astype (numpy.int64)
+    layer = numpy.concatenate ((arrays.seg_layer, arrays.seg_layer))
+    order = numpy.lexsort ((q[:, 1], q[:, 0], layer))
+    sq = q[order]
+    sl = layer[order]
+    same = (sq[1:] == sq[:-1]).all (axis=1) & (sl[1:] == sl[:-1])
+
+    # Points where exactly two ends meet
+    before = numpy.concatenate (([False], same[:-1]))
+    after = numpy.concatenate ((same[1:], [False]))
+    pair = same & ~before & ~after
+    a = order[:-1][pair]
+    b = order[1:][pair]
+    keep = ok[a] & ok[b] & (layer[a] >= 0)
+
+    # ... with no via or pad there
+    pads = [i.pos[:2] for module in pcb.find_types (ModuleSexp)
+            for i in module.pads]
+    blocked = numpy.concatenate ((arrays.via_pos, numpy.array (
+        pads, dtype=float).reshape (-1, 2)))
+    blocked = blocked[numpy.isfinite (blocked).all (axis=1)]
+    if len (blocked):
+        bq = numpy.rint (blocked * 1e6).astype (numpy.int64)
+        joint = q[a]
+        keep &= ~numpy.isin (joint[:, 0] * (1 << 32) + joint[:, 1],
+                             bq[:, 0] * (1 << 32) + bq[:, 1])
+
+    # ... joining segments of the same net and width
+    sa = a % n
+    sb = b % n
+    keep &= (sa != sb) & (arrays.seg_net[sa] == arrays.seg_net[sb]) & \
+        (arrays.seg_width[sa] == arrays.seg_width[sb])
+
+    # ... in a straight line, carrying on rather than doubling back
+    far_a = ends[(a + n) % (2 * n)]
+    far_b = ends[(b + n) % (2 * n)]
+    da = far_a - ends[a]
+    db = far_b - ends[a]
+    cross = da[:, 0] * db[:, 1] - da[:, 1] * db[:, 0]
+    dot = (da * db).sum (axis=1)
+    chord = numpy.hypot (*(far_a - far_b).T)
+    keep &= (dot < 0) & (numpy.abs (cross) <= tolerance * chord)
+
+    a = a[keep]
+    b = b[keep]
+    if not len (a):
+        return 0, 0
+
+    # Each segment has at most one neighbour at each end: next_[end] is the
+    # end it's joined to, or -1
+    next_ = numpy.full (2 * n, -1, dtype=numpy.int64)
+    next_[a] = b
+    next_[b] = a
+
+    # Follow every chain out to both its far ends at once, by pointer
+    # doubling. Going in to a segment through one end leads out through the
+    # other and in to the next segment through next_ of that; last[e] ends
+    # up as the way in to the last segment going that way, and the far end
+    # of the chain is the other end of that segment. Closed loops have no
+    # last segment and never settle.
+    way_in = numpy.arange (2 * n)
+    last = next_[(way_in + n) % (2 * n)]
+    last = numpy.where (last < 0, way_in, last)
+    for i in range ((2 * n).bit_length ()):
+        jumped = last[last]
+        if (jumped == last).all ():
+            break
+        last = jumped
+    far = (last + n) % (2 * n)
+    loop = next_[far] >= 0
+
+    # Every segment in a chain, with the chain's far ends on the side of
+    # its own end and of its own start. Those two ends are the same pair
+    # for every segment in the chain, so the lower of them names the chain,
+    # and the first segment on the board in each chain is the one kept.
+    seg = numpy.nonzero ((next_[:n] >= 0) | (next_[n:] >= 0))[0]
+    to_end = far[seg]
+    to_start = far[seg + n]
+    chains, first, chain_of = numpy.unique (
+        numpy.minimum (to_end, to_start), return_index=True,
+        return_inverse=True)
+    chain_of = chain_of.reshape (-1)
+    kept = seg[first]
+    p0 = ends[to_start[first]]
+    p1 = ends[to_end[first]]
+
+    # Joints can be off by up to the tolerance each, and that could add up
+    # along a chain that's really a gentle curve. Chains with every point
+    # near the line between their far ends (nearly all of them) are done
+    # here; the rest, and loops, are broken up one at a time below.
+    d = (p1 - p0)[chain_of]
+    length = numpy.hypot (d[:, 0], d[:, 1])
+    fits = (length > 0) & ~loop[seg] & ~loop[seg + n]
+    for e in (seg, seg + n):
+        rel = ends[e] - p0[chain_of]
+        fits &= numpy.abs (d[:, 0] * rel[:, 1] - d[:, 1] * rel[:, 0]) <= \
+            tolerance * length
+    straight = numpy.bincount (chain_of, weights=~fits,
+                               minlength=len (chains)) == 0
+
+    arrays.seg_start[kept[straight]] = p0[straight]
+    arrays.seg_end[kept[straight]] = p1[straight]
+    done = straight[chain_of]
+    doomed = [segments[i]
+              for i in seg[done & (seg != kept[chain_of])].tolist ()]
+    merged = int (straight.sum ())
+
+    left = seg[~done]
+    at = numpy.concatenate ((left, left + n))
+    next_ = dict (zip (at.tolist (), next_[at].tolist ()))
+    points = dict (zip (at.tolist (), ends[at].tolist ()))
+    seen = set ()
+    for start in left.tolist ():
+        if start in seen:
+            continue
+        # Back up to one end of the chain, then walk it to the other,
+        # collecting the points along it.
+        end = start
+        while True:
+            other = next_[end]
+            if other < 0 or other % n == start:
+                break
+            end = (other + n) % (2 * n)
+        chain = []
+        line = [points[end]]
+        while True:
+            s = end % n
+            seen.add (s)
+            chain.append (s)
+            far = (end + n) % (2 * n)
+            line.append (points[far])
+            other = next_[far]
+            if other < 0 or other % n in seen:
+                break
+            end = other
+        # Keep every point near the final line, breaking the chain where
+        # need be
+        i = 0
+        while i < len (chain) - 1:
+            if _chain_fits (line, i, len (chain), tolerance):
+                j = len (chain)
+            else:
+                j = i + 1
+                while j < len (chain) and \
+                        _chain_fits (line, i, j + 1, tolerance):
+                    j += 1
+            if j - i > 1:
+                arrays.seg_start[chain[i]] = line[i]
+                arrays.seg_end[chain[i]] = line[j]
+                doomed.extend (segments[k] for k in chain[i + 1:j])
+                merged += 1
+            i = j
+
+    pcb.import_tracks (arrays)
+    pcb.delete_many (doomed)
+    return merged, len (doomed)
+
+def _chain_fits (line, i, j, tolerance):
+    """Whether line[i+1:j] all lie within tolerance of line[i] - line[j]"""
+    x0, y0 = line[i]
+    x1, y1 = line[j]
+    length = math.hypot (x1 - x0, y1 - y0)
+    if not length:
+        return False
+    for x, y in line[i + 1:j]:
+        if abs ((x1 - x0) * (y - y0) - (y1 - y0) * (x - x0)) > \
+                tolerance * length:
+            return False
+    return True
+
+###############################################################################
+# Batch runs
+#
+# Running the same passes over a pile of boards one Python process at a time
+# spends most of its time waiting on one core. run_batch hands the boards out
+# to a process pool instead; each worker loads, processes and writes its own
+# board, so the only things crossing between processes are file names and
+# results.
+
+class BatchResult (object):
+    """What run_batch did to one board.
+
+    results holds each pass's return value, in order; timings holds
+    (phase, seconds) pairs for loading, each pass and writing. If anything
+    went wrong, error holds the traceback and the output was left alone.
+    If kicad_stats was collecting when run_batch was called, stats holds the
+    board's report, which has also been added into the caller's.
+    """
+    def __init__ (self, filename, output):
+        self.filename = filename
+        self.output = output
+        self.results = []
+        self.timings = []
+        self.error = None
+        self.stats = None
+
+    @property
+    def total_time (self):
+        return sum (i[1] for i in self.timings)
+
+    def __repr__ (self):
+        return "<BatchResult %s: %s>" % (
+            self.filename, "failed" if self.error else self.results)
+
+def pass_name (fn):
+    """Name to report a pass under; sees through functools.partial"""
+    fn = getattr (fn, "func", fn)
+    return getattr (fn, "__name__", repr (fn))
+
+def write_atomic (pcb, filename, **kwargs):
+    """Write the board to a temporary file next to filename, then rename it
+    into place so nobody ever sees a half-written board. kwargs go to
+    KicadPCB.write."""
+    directory = os.path.dirname (os.path.abspath (filename))
+    fd, tmp = tempfile.mkstemp (dir=directory, suffix=".tmp",
+                                prefix=os.path.basename (filename) + ".")
+    os.close (fd)
+    try:
+        pcb.write (tmp, **kwargs)
+        # mkstemp makes the file private; give it the permissions of
+        # whatever it's replacing, or the ones open() would have
+        if os.path.exists (filename):
+            shutil.copymode (filename, tmp)
+        else:
+            umask = os.umask (0)
+            os.umask (umask)
+            os.chmod (tmp, 0o666 & ~umask)
+        os.replace (tmp, filename)
+    except BaseException:
+        os.unlink (tmp)
+        raise
+
+def _run_board (job):
+    filename, output, passes, lazy, cache, write_kwargs, collect = job
+    if not collect:
+        return _run_passes (filename, output, passes, lazy, cache,
+                            write_kwargs)
+    with kicad_stats.collect () as stats:
+        result = _run_passes (filename, output, passes, lazy, cache,
+                              write_kwargs)
+    for name, t in result.timings:
+        stats.add_time ("batch.%s" % name, t)
+    result.stats = stats.report ()
+    return result
+
+def _run_passes (filename, output, passes, lazy, cache, write_kwargs):
+    result = BatchResult (filename, output)
+    try:
+        t0 = time.perf_counter ()
+        pcb = KicadPCB (filename, lazy=lazy, cache=cache)
+        t1 = time.perf_counter ()
+        result.timings.append (("load", t1 - t0))
+        for fn in passes:
+            result.results.append (fn (pcb))
+            t0, t1 = t1, time.perf_counter ()
+            result.timings.append ((pass_name (fn), t1 - t0))
+        if output is not None:
+            write_atomic (pcb, output, **write_kwargs)
+            result.timings.append (("write", time.perf_counter () - t1))
+    except Exception:
+        result.error = traceback.format_exc ()
+    return result
+
+def run_batch (boards, passes, processes=None, lazy=True, cache=None,
+               **write_kwargs):
+    """Run a pipeline of passes over many boards in parallel.
+
+    boards is a list of filenames, which are processed in place, or of
+    (input, output) pairs; an output of None means don't write anything.
+    passes is a list of functions taking a KicadPCB, like
+    remove_stacked_vias; use functools.partial to give them arguments. They
+    have to be picklable, so no lambdas. Each board gets a process of its
+    own out of a pool of `processes` (default: one per core); with
+    processes=1 everything runs here instead.
+
+    cache is an optional BoardCache and write_kwargs go to KicadPCB.write.
+    A board that fails doesn't stop the others. Returns a BatchResult per
+    board, in order.
+    """
+    stats = kicad_stats.active
+    jobs = []
+    for board in boards:
+        if isinstance (board, str):
+            filename, output = board, board
+        else:
+            filename, output = board
+        jobs.append ((filename, output, list (passes), lazy, cache,
+                      write_kwargs, stats is not None))
+
+    if processes is None:
+        processes = os.cpu_count () or 1
+    processes = min (processes, len (jobs))
+    if processes <= 1:
+        results = [_run_board (i) for i in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor (processes) as pool:
+            results = list (pool.map (_run_board, jobs))
+    if stats is not None:
+        for i in results:
+            stats.merge (i.stats)
+    return results
@@ -0,0 +1,63 @@
+import io
+import json
+
+import kicad_bench
+import kicad_schlib
+import kicad_tools
+
+def test_make_board (tmp_path):
+    text = kicad_bench.make_board (500, seed=3)
+    assert kicad_bench.make_board (500, seed=3) == text
+    assert kicad_bench.make_board (500, seed=4) != text
+
+    path = tmp_path / "board.kicad_pcb"
+    path.write_text (text, encoding="utf-8")
+    pcb = kicad_tools.KicadPCB (str (path))
+    assert len (pcb.find_types (kicad_tools.SegmentSexp)) == 500
+    assert len (pcb.find_types (kicad_tools.ViaSexp)) == 100
+    assert len (pcb.view_keyword ("module")) == 25
+    assert pcb.copper_layers == ["F.Cu", "In1.Cu", "In2.Cu", "B.Cu"]
+
+    out = str (tmp_path / "out.kicad_pcb")
+    pcb.write (out)
+    assert open (out, encoding="utf-8").read () == text
+
+def test_make_board_pieces (tmp_path):
+    path = tmp_path / "board.kicad_pcb"
+    path.write_text (kicad_bench.make_board (200, pieces=4, n_vias=0,
+                                             n_modules=0),
+                     encoding="utf-8")
+    pcb = kicad_tools.KicadPCB (str (path))
+    assert len (pcb.find_types (kicad_tools.SegmentSexp)) > 200
+
+def test_make_lib ():
+    text = kicad_bench.make_lib (50, seed=1)
+    symbols = kicad_schlib.readfile (io.StringIO (text))
+    assert len (symbols) == 50
+    assert len (set (i.name for i in symbols)) == 50
+    assert all (len (i.pins) == 3 for i in kicad_schlib.readfile (
+        io.StringIO (kicad_bench.make_lib (5, n_pins=3))))
+
+    f = io.StringIO ()
+    kicad_schlib.writefile (f, symbols)
+    assert f.getvalue () == text
+
+def test_compare (tmp_path, monkeypatch):
+    monkeypatch.setattr (kicad_bench, "RESULTS", {})
+    kicad_bench.record ("fast", 1.)
+    kicad_bench.record ("slow", 1.)
+    kicad_bench.record ("gone", 1.)
+    baseline = str (tmp_path / "base.json")
+    kicad_bench.save_results (baseline, n_segments=10)
+    with open (baseline) as f:
+        saved = json.load (f)
+    assert saved["meta"]["n_segments"] == 10
+    assert saved["results"]["slow"] == {"value": 1., "unit": "s"}
+
+    monkeypatch.setattr (kicad_bench, "RESULTS", {})
+    kicad_bench.record ("fast", 0.5)
+    kicad_bench.record ("slow", 1.3)
+    kicad_bench.record ("new", 2., "B")
+    assert kicad_bench.compare (baseline, tolerance=0.25) == \
+        [("slow", 1., 1.3, "s")]
+    assert kicad_bench.compare (baseline, tolerance=0.5) == []
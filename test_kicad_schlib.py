@@ -0,0 +1,482 @@
+import copy
+import gc
+import io
+import os
+import pickle
+import shlex
+
+import pytest
+
+import kicad_schlib
+
+def symbol_text (name, aliases=(), pins=2):
+    out = ["#\n# %s\n#\n" % name,
+           "DEF %s U 0 40 Y Y 1 F N\n" % name,
+           'F0 "U" -300 150 50 H V L CNN\n',
+           'F1 "%s" -300 -150 50 H V L CNN\n' % name,
+           'F2 "" 0 0 50 H I C CNN\n',
+           'F3 "" 0 0 50 H I C CNN\n']
+    if aliases:
+        out.append ("ALIAS %s\n" % " ".join (aliases))
+    out.append ("DRAW\n")
+    out.append ("S -300 100 300 -100 0 1 10 f\n")
+    out.append ("P 3 0 1 0 -100 0 0 50 100 0 N\n")
+    for i in range (pins):
+        out.append ("X PIN%d %d -500 %d 200 R 50 50 1 1 P\n" % (
+            i + 1, i + 1, 100 - 100 * i))
+    out.append ("ENDDRAW\nENDDEF\n")
+    return "".join (out)
+
+def lib_text (*symbols):
+    return "EESchema-LIBRARY Version 2.3\n#encoding utf-8\n" + \
+        "".join (symbols) + "#\n#End Library\n"
+
+def write_lib (tmp_path, name, *symbols):
+    path = tmp_path / name
+    path.write_text (lib_text (*symbols), encoding="utf-8")
+    return str (path)
+
+def read (text):
+    return kicad_schlib.readfile (io.StringIO (text))
+
+def write (symbols):
+    f = io.StringIO ()
+    kicad_schlib.writefile (f, symbols)
+    return f.getvalue ()
+
+# Spaced oddly, so anything re-serialized shows
+ODD = lib_text (symbol_text ("FOO").replace ("S -300", "S  -300"))
+
+def test_readfile ():
+    text = symbol_text ("FOO", ["BAR", "BAZ"], pins=3).replace (
+        "DRAW\n", '$FPLIST\n SOIC*  DIP*\n$ENDFPLIST\nDRAW\n'
+        'T 0 0 0 50 0 0 1 Text Normal 0 C C\n', 1).replace (
+        'F3 "" 0 0 50 H I C CNN\n',
+        'F3 "" 0 0 50 H I C CNN\nF4 "x y" 10 -20 50 H I C CNN "Part No"\n')
+    assert gc.isenabled ()
+    foo, bar = read (lib_text (text, symbol_text ("QUX", pins=0)))
+    assert gc.isenabled ()
+
+    assert foo.name == "FOO" and foo.reference == "U"
+    assert foo.definition.text_offset == 40
+    assert foo.aliases == ["BAR", "BAZ"]
+    assert foo.footprintFilters == ["SOIC*", "DIP*"]
+    assert [i.num for i in foo.otherFields] == [3, 4]
+    field = foo.otherFields[1]
+    assert (field.text, field.posx, field.posy) == ("x y", 10, -20)
+    assert [type (i).__name__ for i in foo.graphics] == \
+        ["Text", "Rectangle", "Polyline"]
+    assert [(i.name, i.num, i.posy) for i in foo.pins] == \
+        [("PIN1", "1", 100), ("PIN2", "2", 0), ("PIN3", "3", -100)]
+    assert bar.name == "QUX" and bar.pins == []
+
+@pytest.mark.parametrize ("line", [
+    'F0 "U" -300 150 50 H V L CNN',
+    'F1 "" 0 0 50 H I C CNN',
+    'F4 "a b" 1 2 50 H I C CNN "Field Name"',
+    'F4 "a \\"b\\"" 1 2 50 H I C CNN',
+    "F4 'a b' 1 2 50 H I C CNN",
+    'F5 "x"y 1 2 50 H I C CNN',
+    'F2  "spaced"   0 0 50 H I C CNN  ',
+])
+def test_split_field_matches_shlex (line):
+    assert kicad_schlib._split_field (line) == shlex.split (line)
+
+@pytest.mark.parametrize ("bad", ["DRAW\nQ 1 2\n", "DRAW\nENDDEF\n",
+                                  "NONSENSE\n", "F0\n"])
+def test_readfile_errors (bad):
+    text = symbol_text ("FOO").replace ("DRAW\n", bad, 1)
+    with pytest.raises (ValueError, match="cannot interpret line"):
+        read (lib_text (text))
+    assert gc.isenabled ()
+
+def test_point_array ():
+    points = kicad_schlib.PointArray ([(1, 2), (3, 4)])
+    assert points == [(1, 2), (3, 4)] and len (points) == 2
+    assert points[-1] == (3, 4) and points[:1] == [(1, 2)]
+    points.append ((5, 6))
+    points.insert (0, (7, 8))
+    points.insert (-1, (9, 10))
+    points[1] = (0, 0)
+    assert list (points) == [(7, 8), (0, 0), (3, 4), (9, 10), (5, 6)]
+    points[1:3] = [(1, 1)]
+    del points[0]
+    del points[-2:]
+    assert points == kicad_schlib.PointArray ([(1, 1)])
+    with pytest.raises (IndexError):
+        points[1]
+    assert copy.deepcopy (points) == points
+    assert pickle.loads (pickle.dumps (points)) == points
+
+def test_records_have_slots ():
+    text = symbol_text ("FOO").replace (
+        "DRAW\n", "DRAW\nA 0 0 100 0 900 0 1 10 N 100 0 0 100\n"
+        "C 0 0 50 0 1 10 F\nT 0 0 0 50 0 0 1 Text Normal 0 C C\n", 1)
+    sym, = read (lib_text (text))
+    records = [sym.definition, sym.referenceField] + sym.graphics + sym.pins
+    assert len (set (type (i) for i in records)) == 8
+    for i in records:
+        assert not hasattr (i, "__dict__")
+    poly = sym.graphics[-1]
+    assert poly.points == [(-100, 0), (0, 50), (100, 0)]
+    poly.points = [(1, 2), [3, 4]]
+    assert isinstance (poly.points, kicad_schlib.PointArray)
+    poly.points.append ((5, 6))
+    f = io.StringIO ()
+    poly.writeOut (f)
+    assert f.getvalue () == "P 3 0 1 0  1 2  3 4  5 6 N\n"
+
+    again = pickle.loads (pickle.dumps (sym))
+    assert again.graphics[-1].points == poly.points
+    assert copy.deepcopy (sym).pins[1].posy == 0
+
+def test_rectangle_fill_round_trip ():
+    sym, = read (lib_text (symbol_text ("FOO")))
+    rect = sym.graphics[0]
+    rect.thickness = 12
+    f = io.StringIO ()
+    kicad_schlib.writefile (f, [sym])
+    assert "S -300 100 300 -100 0 1 12 f\n" in f.getvalue ()
+    assert read (f.getvalue ())[0].graphics[0].fill == rect.fill
+
+def index_library (tmp_path):
+    return write_lib (tmp_path, "index.lib", symbol_text ("FOO"),
+                      symbol_text ("BAR", ["BAZ", "QUX"], pins=3),
+                      symbol_text ("FOO", pins=5), symbol_text ("QUX"))
+
+def check_index (lib):
+    assert sorted (lib.names ()) == ["BAR", "FOO", "QUX"]
+    assert len (lib) == 3 and sorted (lib) == ["BAR", "FOO", "QUX"]
+    assert lib.aliases == {"BAZ": "BAR"}
+    # The first definition of a name wins, over aliases too
+    assert len (lib["FOO"].pins) == 2
+    assert lib["QUX"].name == "QUX"
+    assert lib["BAZ"] is lib["BAR"]
+    assert "BAZ" in lib and "NOPE" not in lib
+    assert lib.get ("NOPE") is None
+    with pytest.raises (KeyError):
+        lib["NOPE"]
+    assert lib.text ("BAZ") == symbol_text ("BAR", ["BAZ", "QUX"],
+                                            pins=3).split ("#\n", 2)[2]
+    assert write ([lib["FOO"]]) == lib_text ("#\n# FOO\n#\n" +
+                                             lib.text ("FOO"))
+
+def test_library_index (tmp_path):
+    path = index_library (tmp_path)
+    with kicad_schlib.LibraryIndex (path) as lib:
+        assert lib._index is None
+        check_index (lib)
+    with kicad_schlib.LibraryIndex (path) as lib:
+        assert lib._index is not None
+        check_index (lib)
+
+    # A changed library has its index rebuilt
+    with open (path, "a") as f:
+        f.write (symbol_text ("NEW"))
+    with kicad_schlib.LibraryIndex (path) as lib:
+        assert lib._index is None and "NEW" in lib
+    with kicad_schlib.LibraryIndex (path) as lib:
+        assert lib._index is not None and lib["NEW"].name == "NEW"
+
+def test_library_index_not_persisted (tmp_path):
+    path = index_library (tmp_path)
+    with kicad_schlib.LibraryIndex (path, persist=False) as lib:
+        check_index (lib)
+    assert not os.path.exists (path + ".idx")
+
+    other = str (tmp_path / "elsewhere.idx")
+    kicad_schlib.LibraryIndex (path, index_file=other).close ()
+    assert os.path.exists (other) and not os.path.exists (path + ".idx")
+
+def test_library_index_empty (tmp_path):
+    path = write_lib (tmp_path, "empty.lib")
+    for i in range (2):
+        with kicad_schlib.LibraryIndex (path) as lib:
+            assert lib.names () == [] and lib.aliases == {}
+            assert "FOO" not in lib
+
+def test_unmodified_symbol_passes_through ():
+    assert write (read (ODD)) == ODD
+
+def test_reading_parts_keeps_passthrough ():
+    symbol = read (ODD)[0]
+    assert [i.name for i in symbol.pins] == ["PIN1", "PIN2"]
+    assert symbol.valueField.text == "FOO"
+    assert not symbol.modified
+    assert write ([symbol]) == ODD
+
+def test_changing_held_part_is_written ():
+    symbol = read (ODD)[0]
+    pins = symbol.pins
+    assert write ([symbol]) == ODD
+    pins[0].name = "CHANGED"
+    assert symbol.modified
+    out = write ([symbol])
+    assert "X CHANGED 1" in out and "S  -300" not in out
+    assert read (out)[0].pins[0].name == "CHANGED"
+
+def test_writefile_takes_writeout_objects ():
+    class Raw (object):
+        def writeOut (self, f):
+            f.write (symbol_text ("RAW"))
+    out = write ([Raw ()] + read (lib_text (symbol_text ("FOO"))))
+    assert [i.name for i in read (out)] == ["RAW", "FOO"]
+
+def test_setting_part_or_touch_modifies ():
+    a, b = read (lib_text (symbol_text ("A"), symbol_text ("B")))
+    a.aliases = ["A2"]
+    b.touch ()
+    assert a.modified and b.modified
+    assert read (write ([a, b]))[0].aliases == ["A2"]
+
+def test_library_index_passes_through (tmp_path):
+    path = write_lib (tmp_path, "odd.lib", symbol_text ("BAR"),
+                      symbol_text ("FOO").replace ("S -300", "S  -300"))
+    with kicad_schlib.LibraryIndex (path) as lib:
+        assert write ([lib["FOO"]]) == ODD
+
+@pytest.mark.parametrize ("processes", [1, 2])
+def test_load_libraries (tmp_path, processes):
+    (tmp_path / "sub").mkdir ()
+    a = write_lib (tmp_path, "a.lib", symbol_text ("FOO", ["FOO2"]))
+    b = write_lib (tmp_path, "sub/b.lib", symbol_text ("FOO", pins=5),
+                   symbol_text ("BAR"))
+    bad = write_lib (tmp_path, "bad.lib", "DEF\n")
+    write_lib (tmp_path, "skipped.txt", symbol_text ("NOPE"))
+    catalog = kicad_schlib.load_libraries (str (tmp_path), processes)
+    assert catalog.libraries == [a, b]
+    assert list (catalog.errors) == [bad]
+    assert "ValueError: cannot interpret line: DEF" in catalog.errors[bad]
+
+    assert sorted (catalog) == ["BAR", "FOO"] and len (catalog) == 2
+    assert catalog.aliases == {"FOO2": "FOO"}
+    assert catalog.duplicates == {"FOO": [a, b]}
+    assert catalog.library ("FOO2") == a and catalog.library ("BAR") == b
+    assert "FOO2" in catalog and "NOPE" not in catalog
+    with pytest.raises (KeyError):
+        catalog["NOPE"]
+
+    library, symbol = catalog["FOO2"]
+    assert library == a and len (symbol.pins) == 2
+    assert catalog["FOO"][1] is symbol
+    assert write ([catalog["BAR"][1]]) == lib_text (symbol_text ("BAR"))
+
+    assert kicad_schlib.load_libraries ([b, a], processes).libraries == [b, a]
+
+def with_filters (text, *filters):
+    return text.replace ("DRAW\n", "$FPLIST\n %s\n$ENDFPLIST\nDRAW\n" %
+                         "\n ".join (filters), 1)
+
+def test_symbol_database (tmp_path):
+    (tmp_path / "libs" / "sub").mkdir (parents=True)
+    a = os.path.abspath (write_lib (
+        tmp_path / "libs", "a.lib",
+        with_filters (symbol_text ("FOO", ["FOO2"]), "SOIC*", "DIP*"),
+        symbol_text ("BIG", pins=8)))
+    b = os.path.abspath (write_lib (
+        tmp_path / "libs" / "sub", "b.lib",
+        with_filters (symbol_text ("FOO2"), "SOIC*")))
+    db_file = str (tmp_path / "symbols.db")
+
+    with kicad_schlib.SymbolDatabase (db_file) as db:
+        assert db.refresh ([str (tmp_path / "libs")], processes=1) == (2, 0)
+        assert db.find ("FOO2") == [(a, "FOO"), (b, "FOO2")]
+        assert db.find ("NOPE") == []
+        assert db.with_fp_filter ("SOIC*") == [(a, "FOO"), (b, "FOO2")]
+        assert db.with_fp_filter ("DIP*") == [(a, "FOO")]
+        assert db.with_pins (2) == [(a, "BIG")]
+        assert db.with_empty_field (2) == [(a, "BIG"), (a, "FOO"), (b, "FOO2")]
+        assert db.query ("SELECT p.name, p.posy FROM pins p JOIN symbols s "
+                         "ON p.symbol = s.id WHERE s.name = ? "
+                         "ORDER BY 1", "FOO") == [("PIN1", 100), ("PIN2", 0)]
+        # Nothing changed, nothing to do
+        assert db.refresh ([str (tmp_path / "libs")], processes=1) == (0, 0)
+
+    # Kept between runs, and only what changed is re-read
+    os.utime (a)
+    with open (b, "w") as f:
+        f.write (lib_text (symbol_text ("NEW", pins=4)))
+    with kicad_schlib.SymbolDatabase (db_file) as db:
+        assert db.refresh ([a, b], processes=1) == (1, 0)
+        assert db.find ("FOO2") == [(a, "FOO")]
+        assert db.with_pins (3) == [(a, "BIG"), (b, "NEW")]
+        assert db.refresh ([b], processes=1) == (0, 1)
+        assert db.find ("FOO") == []
+        assert db.query ("SELECT COUNT(*) FROM pins") == [(4,)]
+
+def test_symbol_database_errors (tmp_path):
+    good = write_lib (tmp_path, "good.lib", symbol_text ("FOO"))
+    bad = write_lib (tmp_path, "bad.lib", symbol_text ("BAD").replace (
+        "X PIN1 1 -500", "X PIN1 1 minus"))
+    with kicad_schlib.SymbolDatabase (str (tmp_path / "symbols.db")) as db:
+        with pytest.raises (ValueError, match="could not read 1 libraries"):
+            db.refresh ([good, bad], processes=1)
+        # The good one is stored regardless
+        assert db.find ("FOO") == [(os.path.abspath (good), "FOO")]
+        assert db.find ("BAD") == []
+
+    import sqlite3
+    other = str (tmp_path / "other.db")
+    with sqlite3.connect (other) as conn:
+        conn.execute ("PRAGMA user_version = 99")
+    with pytest.raises (ValueError, match="unknown version 99"):
+        kicad_schlib.SymbolDatabase (other)
+
+def test_derive_isolation ():
+    text = with_filters (symbol_text ("FOO", ["FOO2"]), "SOIC*")
+    base = read (lib_text (text))[0]
+    variant = base.derive ("BAR")
+    assert variant.name == "BAR" and base.name == "FOO"
+
+    variant.footprintField.text = "Variant:FP"
+    variant.otherFields[0].text = "extra"
+    variant.aliases.append ("BAR2")
+    variant.footprintFilters[0] = "DIP*"
+    assert base.footprintField.text == ""
+    assert base.otherFields[0].text == ""
+    assert base.aliases == ["FOO2"]
+    assert base.footprintFilters == ["SOIC*"]
+
+    base.valueField.text = "BASE"
+    base.aliases.remove ("FOO2")
+    base.footprintFilters.append ("QFN*")
+    base.pins.pop ()
+    assert variant.valueField.text == "BAR"
+    assert variant.aliases == ["FOO2", "BAR2"]
+    assert variant.footprintFilters == ["DIP*"]
+    assert len (variant.pins) == 2
+
+    # The same as copying it whole and making the same changes
+    copied = copy.deepcopy (read (lib_text (text))[0])
+    copied.name = "BAR"
+    copied.footprintField.text = "Variant:FP"
+    copied.otherFields[0].text = "extra"
+    copied.aliases.append ("BAR2")
+    copied.footprintFilters[0] = "DIP*"
+    assert write ([variant]) == write ([copied])
+
+def test_derive_variants_of_variants ():
+    base = read (lib_text (symbol_text ("FOO")))[0]
+    one = base.derive ("ONE")
+    two = one.derive ("TWO")
+    two.pins[0].name = "TWO"
+    one.graphics.clear ()
+    assert [i.pins[0].name for i in (base, one, two)] == \
+        ["PIN1", "PIN1", "TWO"]
+    assert [len (i.graphics) for i in (base, one, two)] == [2, 0, 2]
+
+def test_catalog_first_library_owns_alias (tmp_path):
+    a = write_lib (tmp_path, "a.lib", symbol_text ("FOO", ["BAR"]))
+    b = write_lib (tmp_path, "b.lib", symbol_text ("BAR"),
+                   symbol_text ("BAZ", ["FOO"]))
+    catalog = kicad_schlib.load_libraries ([a, b], processes=1)
+    assert catalog.library ("BAR") == a
+    assert catalog.resolve ("BAR") == "FOO"
+    assert catalog.duplicates == {"BAR": [a, b], "FOO": [a, b]}
+    assert catalog["BAR"][1].name == "FOO"
+    assert catalog.library ("BAZ") == b
+    assert sorted (catalog) == ["BAZ", "FOO"]
+
+def test_catalog_shadowed_symbol_keeps_aliases (tmp_path):
+    a = write_lib (tmp_path, "a.lib", symbol_text ("FOO", ["BAR"]))
+    # FOO is taken, but its alias QUX isn't; BAR turns up twice in b.lib
+    b = write_lib (tmp_path, "b.lib", symbol_text ("FOO", ["QUX", "BAR"]),
+                   symbol_text ("BAR"), symbol_text ("BAZ", ["BAR"]))
+    catalog = kicad_schlib.load_libraries ([a, b], processes=1)
+    assert catalog.aliases == {"BAR": "FOO", "QUX": "FOO"}
+    assert catalog.library ("QUX") == a
+    assert catalog["QUX"][1] is catalog["FOO"][1]
+    assert catalog.duplicates == {"FOO": [a, b], "BAR": [a, b]}
+    assert sorted (catalog) == ["BAZ", "FOO"]
+
+def test_point_array_coordinates ():
+    points = kicad_schlib.PointArray ([(1, 2), (3.4, -5.6)])
+    assert points == [(1, 2), (3, -6)]
+    points[0] = (0.5, 1.5)
+    points.insert (0, (7.0, 8))
+    points.append ((True, 9))
+    assert list (points) == [(7, 8), (0, 2), (3, -6), (1, 9)]
+    with pytest.raises (TypeError, match="must be numbers, not str"):
+        points.append (("1", 2))
+    with pytest.raises (TypeError):
+        kicad_schlib.PointArray ([(None, 2)])
+    assert len (points) == 4
+
+def test_polyline_float_points_write ():
+    symbol = read (lib_text (symbol_text ("FOO")))[0]
+    line = [i for i in symbol.graphics if isinstance (i, kicad_schlib.Polyline)]
+    line[0].points = [(0.4, 10.6), (-20, 30)]
+    f = io.StringIO ()
+    kicad_schlib.writefile (f, [symbol])
+    assert "P 2 0 1 0  0 11  -20 30 N\n" in f.getvalue ()
+
+def test_derive_rename_keeps_passthrough ():
+    base = read (ODD)[0]
+    variant = base.derive ("FOO-SHROUD")
+    variant.reference = "J"
+    assert not variant.modified and not base.modified
+    out = write ([base, variant])
+    assert out.count ("S  -300") == 2
+    assert "DEF FOO-SHROUD J " in out and '"FOO-SHROUD"' in out
+    assert [(i.name, i.reference) for i in read (out)] == \
+        [("FOO", "U"), ("FOO-SHROUD", "J")]
+
+def test_derive_edits_stay_apart ():
+    base = read (ODD)[0]
+    variant = base.derive ("BAR")
+    variant.pins[0].name = "VARIANT"
+    base.footprintField.text = "Base:FP"
+    assert base.pins[0].name == "PIN1"
+    assert variant.footprintField.text == ""
+    assert variant.name == "BAR" and base.name == "FOO"
+
+def test_derive_with_held_reference ():
+    base = read (ODD)[0]
+    pins = base.pins
+    variant = base.derive ("BAR")
+    pins[0].name = "HELD"
+    assert base.pins[0].name == "HELD"
+    assert variant.pins[0].name == "PIN1"
+    assert "X PIN1 1" in write ([variant])
+
+MIXED = lib_text (symbol_text ("FOO"), symbol_text ("BAR", ["BAZ"], pins=5),
+                  symbol_text ("QUX", pins=0))
+
+def test_lazy_read_matches_eager ():
+    eager = read (MIXED)
+    lazy = kicad_schlib.readfile (io.StringIO (MIXED), lazy=True)
+    assert [i.name for i in lazy] == [i.name for i in eager]
+    assert [i._aliases for i in lazy] == [i._aliases for i in eager]
+    assert write (lazy) == MIXED
+    assert all (i._draw is not None for i in lazy)
+    for a, b in zip (eager, lazy):
+        assert [i._line () for i in a.pins] == [i._line () for i in b.pins]
+        assert [i._line () for i in a.graphics] == \
+            [i._line () for i in b.graphics]
+    for i in eager + lazy:
+        i.touch ()
+    assert write (lazy) == write (eager)
+
+def test_lazy_touch_and_derive ():
+    a, b, c = kicad_schlib.readfile (io.StringIO (MIXED), lazy=True)
+    a.touch ()
+    assert len (a.pins) == 2
+    variant = b.derive ("BAR2")
+    variant.pins[0].name = "V"
+    assert b.pins[0].name == "PIN1"
+    assert [i.name for i in read (write ([variant]))[0].pins] == \
+        ["V", "PIN2", "PIN3", "PIN4", "PIN5"]
+
+def test_lazy_errors ():
+    bad = lib_text (symbol_text ("FOO").replace ("X PIN2 2 -500 0",
+                                                 "X PIN2 2 -500 zero"))
+    with pytest.raises (ValueError):
+        read (bad)
+    symbol = kicad_schlib.readfile (io.StringIO (bad), lazy=True)[0]
+    with pytest.raises (ValueError):
+        symbol.pins
+
+    unended = lib_text (symbol_text ("FOO").replace ("ENDDRAW\n", ""))
+    for lazy in (False, True):
+        with pytest.raises (ValueError, match="cannot interpret line: ENDDEF"):
+            kicad_schlib.readfile (io.StringIO (unended), lazy=lazy)
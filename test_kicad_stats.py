@@ -0,0 +1,127 @@
+import io
+import os
+
+import kicad_schlib
+import kicad_stats
+import kicad_tools
+from test_kicad_tools import BOARD, write_board
+
+def test_nothing_collecting ():
+    assert kicad_stats.active is None
+    with kicad_stats.phase ("anything"):
+        pass
+    assert kicad_stats.active is None
+
+def test_collect_nests ():
+    with kicad_stats.collect () as outer:
+        assert kicad_stats.active is outer
+        with kicad_stats.collect () as inner:
+            with kicad_stats.phase ("a"):
+                pass
+        assert kicad_stats.active is outer
+        with kicad_stats.phase ("b"):
+            pass
+    assert kicad_stats.active is None
+    assert list (inner.times) == ["a"]
+    assert list (outer.times) == ["b"]
+
+def test_hook_report_and_merge ():
+    events = []
+    with kicad_stats.collect (lambda *args: events.append (args)) as stats:
+        with kicad_stats.phase ("p"):
+            pass
+        stats.count ("c", 3)
+        stats.add_time ("quiet", 2., calls=4)
+        stats.read ("in", 10)
+        stats.written ("out", 5)
+    assert [i[:2] for i in events] == [("phase", "p"), ("count", "c"),
+                                       ("read", "in"), ("written", "out")]
+    assert events[1:] == [("count", "c", 3), ("read", "in", 10),
+                          ("written", "out", 5)]
+
+    report = stats.report ()
+    assert report["calls"] == {"p": 1, "quiet": 4}
+    assert report["counts"] == {"c": 3}
+    assert (report["bytes_read"], report["bytes_written"]) == (10, 5)
+
+    total = kicad_stats.Stats ()
+    total.merge (report)
+    total.merge (report)
+    assert total.times["quiet"] == 4.
+    assert total.calls == {"p": 2, "quiet": 8}
+    assert total.counts == {"c": 6}
+    assert total.bytes_read == 20
+    assert "quiet" in str (total) and "bytes read 20, written 10" in str (total)
+
+def test_board_stats (tmp_path):
+    filename = write_board (tmp_path, BOARD)
+    out = str (tmp_path / "out.kicad_pcb")
+    with kicad_stats.collect () as stats:
+        pcb = kicad_tools.KicadPCB (filename)
+        pcb.find_types (kicad_tools.SegmentSexp)[0].width = 1
+        pcb.write (out)
+    for name in ("pcb.read", "pcb.scan", "pcb.parse", "pcb.decode",
+                 "pcb.write"):
+        assert stats.calls[name] == 1
+    assert stats.counts["pcb.segment"] == 2
+    assert stats.counts["pcb.net"] == 3
+    assert stats.counts["pcb.write.serialized"] == 1
+    assert stats.bytes_read == os.path.getsize (filename)
+    assert stats.bytes_written == os.path.getsize (out)
+
+def test_batch_stats (tmp_path):
+    boards = [write_board (tmp_path, BOARD, "%d.kicad_pcb" % i)
+              for i in range (2)]
+    with kicad_stats.collect () as stats:
+        results = kicad_tools.run_batch (
+            boards, [kicad_tools.remove_stacked_vias], processes=1)
+    assert all (i.stats["counts"]["pcb.segment"] == 2 for i in results)
+    assert stats.counts["pcb.segment"] == 4
+    assert stats.calls["batch.remove_stacked_vias"] == 2
+    assert stats.bytes_written == 2 * len (BOARD)
+
+    # Not collecting, nothing's gathered
+    assert kicad_tools.run_batch (boards, [], processes=1)[0].stats is None
+
+LIB = """EESchema-LIBRARY Version 2.3
+#encoding utf-8
+#
+# FOO
+#
+DEF FOO U 0 40 Y Y 1 F N
+F0 "U" -300 150 50 H V L CNN
+F1 "FOO" -300 -150 50 H V L CNN
+F2 "" 0 0 50 H I C CNN
+F3 "" 0 0 50 H I C CNN
+DRAW
+X PIN1 1 -500 100 200 R 50 50 1 1 P
+X PIN2 2 -500 0 200 R 50 50 1 1 P
+ENDDRAW
+ENDDEF
+#
+# BAR
+#
+DEF BAR U 0 40 Y Y 1 F N
+F0 "U" -300 150 50 H V L CNN
+F1 "BAR" -300 -150 50 H V L CNN
+F2 "" 0 0 50 H I C CNN
+F3 "" 0 0 50 H I C CNN
+DRAW
+X PIN1 1 -500 100 200 R 50 50 1 1 P
+X PIN2 2 -500 0 200 R 50 50 1 1 P
+X PIN3 3 -500 -100 200 R 50 50 1 1 P
+ENDDRAW
+ENDDEF
+#
+#End Library
+"""
+
+def test_library_stats ():
+    with kicad_stats.collect () as stats:
+        symbols = kicad_schlib.readfile (io.StringIO (LIB))
+        kicad_schlib.writefile (io.StringIO (), symbols)
+    assert stats.counts["schlib.symbols"] == 2
+    assert stats.counts["schlib.symbols_written"] == 2
+    assert stats.calls["schlib.Pin"] == 5
+    assert stats.bytes_read == stats.bytes_written == len (LIB)
+    assert kicad_stats.active is None
@@ -0,0 +1,1148 @@
+import os
+
+import pytest
+
+import kicad_stats
+import kicad_tools
+from kicad_tools import KicadPCB, SegmentSexp, ViaSexp
+
+BOARD = """(kicad_pcb (version 20171130) (host pcbnew 5.1.5)
+
+  (general
+    (thickness 1.6)
+  )
+
+  (page A4)
+  (layers
+    (0 F.Cu signal)
+    (31 B.Cu signal)
+    (44 Edge.Cuts user)
+  )
+
+  (net 0 "")
+  (net 1 GND)
+  (net 2 VCC)
+
+  (via (at 10 10) (size 0.8) (drill 0.4) (layers F.Cu B.Cu) (net 1))
+  (segment (start 0 0) (end 2 0) (width 0.25) (layer F.Cu) (net 1))
+  (segment (start 5 5) (end 6 5) (width 0.25) (layer B.Cu) (net 2))
+)
+"""
+
+def write_board (tmp_path, text, name="board.kicad_pcb"):
+    path = tmp_path / name
+    path.write_text (text, encoding="utf-8")
+    return str (path)
+
+def load (tmp_path, text=BOARD, name="board.kicad_pcb", **kwargs):
+    return KicadPCB (write_board (tmp_path, text, name), **kwargs)
+
+@pytest.fixture (params=[False, True], ids=["eager", "lazy"])
+def lazy (request):
+    return request.param
+
+@pytest.mark.parametrize ("text", [
+    '(a b "c d" 1 -2.5 +3 .5 (e) ((f)) "" "q\\"uote" "back\\\\slash")',
+    '(kicad_pcb (version 20171130) (net 1 "/a b") (gr_text "x\\ny" (at 1 2)))',
+    '(a(b)(c d))',
+])
+def test_parse_sexp_matches_sexpdata (text):
+    import sexpdata
+    assert kicad_tools.parse_sexp (text) == \
+        sexpdata.loads (text, nil=None, true=None, false=None)
+
+def test_parse_sexp_errors ():
+    for text in ("(a (b)", "(a))", '(a "b)', ""):
+        with pytest.raises (ValueError):
+            kicad_tools.parse_sexp (text)
+
+def test_parse_sexp_round_trip ():
+    tree = kicad_tools.parse_sexp (BOARD)
+    assert kicad_tools.parse_sexp (kicad_tools.sexp_to_str (tree)) == tree
+
+def test_load_and_write (tmp_path):
+    pcb = load (tmp_path)
+    assert pcb.nets[1] == "GND"
+    assert [i.pos for i in pcb.find_types (ViaSexp)] == [[10, 10]]
+    assert [i.width for i in pcb.find_types (SegmentSexp)] == [0.25, 0.25]
+    out = str (tmp_path / "out.kicad_pcb")
+    pcb.write (out)
+    assert kicad_tools.parse_sexp (open (out).read ()) == \
+        kicad_tools.parse_sexp (BOARD)
+
+def test_parse_sexp_span ():
+    text = "junk (a 1) (b 2) junk"
+    assert kicad_tools.parse_sexp (text, 11, 16) == [kicad_tools.S ("b"), 2]
+
+def test_write_unmodified_is_identical (tmp_path, lazy):
+    pcb = load (tmp_path, lazy=lazy)
+    pcb.write (str (tmp_path / "out.kicad_pcb"))
+    assert (tmp_path / "out.kicad_pcb").read_text () == BOARD
+
+def test_lazy_children_parsed_on_use (tmp_path):
+    pcb = load (tmp_path, lazy=True)
+    # Only the nets are needed straight away
+    parsed = [i for i in pcb.children if i._sexp is not None]
+    assert [i.net_id for i in parsed] == [0, 1, 2]
+    via = pcb.find_types (ViaSexp)[0]
+    assert via.pos == [10, 10]
+    # Reading doesn't count as modifying
+    assert via._sexp is not None and via._span is not None
+
+def test_modified_items_are_serialized (tmp_path, lazy):
+    pcb = load (tmp_path, BOARD.replace ("(width 0.25)", "(width  0.25)"),
+                lazy=lazy)
+    a, b = pcb.find_types (SegmentSexp)
+    a.width = 0.5
+    b.sexp
+    assert a._span is None and b._span is None
+    out = str (tmp_path / "out.kicad_pcb")
+    pcb.write (out)
+    written = open (out).read ()
+    # Untouched items keep their text, modified ones are written afresh
+    assert "(width  0.25)" not in written
+    assert "(width 0.5)" in written and written.count ("(width 0.25)") == 1
+    assert written.startswith (BOARD[:BOARD.index ("  (via")])
+    assert [i.out () for i in KicadPCB (out).children] == \
+        [i.out () for i in pcb.children]
+
+def segment_text (x0, y0, x1, y1, layer="F.Cu", net=1, width=0.25):
+    return "(segment (start %g %g) (end %g %g) (width %g) (layer %s) " \
+        "(net %d))" % (x0, y0, x1, y1, width, layer, net)
+
+def board_with (items, text=BOARD):
+    """BOARD without its tracks, plus the given children"""
+    lines = [i for i in text.split ("\n")
+             if not i.startswith (("  (via ", "  (segment "))]
+    return "\n".join (lines[:-2] + ["  " + i for i in items] + lines[-2:])
+
+def test_item_keyword_index (tmp_path, lazy):
+    pcb = load (tmp_path, board_with ([
+        "(segment (start 0 0) (end 1 0) (width 0.25) (layer F.Cu) (net 1) "
+        "(net 2))"]), lazy=lazy)
+    seg = pcb.find_types (SegmentSexp)[0]
+    # The first of a repeated keyword wins, like get_from
+    assert seg.get_value ("net") == 1
+    assert seg.get_from ("end") == [1, 0]
+    assert seg.get_from ("tstamp") is None
+    assert seg._span is not None
+
+    seg.sub_in ("tstamp", [kicad_tools.S ("5C0B1A2F")])
+    seg.width = 0.5
+    assert seg.get_value ("width") == 0.5
+    assert seg.get_value ("tstamp") == kicad_tools.S ("5C0B1A2F")
+    assert seg._span is None
+
+    # Anyone with the raw tree may shuffle it; the index is rebuilt
+    tree = seg.sexp
+    tree.insert (1, [kicad_tools.S ("locked")])
+    assert seg.get_from ("start") == [0, 0]
+    assert seg.get_from ("locked") == []
+
+def via_text (x, y, net=1):
+    return "(via (at %g %g) (size 0.8) (drill 0.4) (layers F.Cu B.Cu) " \
+        "(net %d))" % (x, y, net)
+
+def new_via (pcb, x, y, net=1):
+    return ViaSexp (pcb, kicad_tools.parse_sexp (via_text (x, y, net)))
+
+def test_net_table (tmp_path, lazy):
+    pcb = load (tmp_path, lazy=lazy)
+    nets = pcb.nets
+    assert nets[1] == "GND" and nets.id_of ("VCC") == 2
+    with pytest.raises (ValueError):
+        nets.id_of ("nope")
+    via = pcb.find_types (ViaSexp)[0]
+    seg_gnd, seg_vcc = pcb.find_types (SegmentSexp)
+    assert set (pcb.find_on_net ("GND")) == {via, seg_gnd}
+    assert pcb.find_on_net (2, SegmentSexp) == [seg_vcc]
+
+    # Membership follows re-netting, adds and deletes
+    via.net = "VCC"
+    assert pcb.find_on_net ("GND") == [seg_gnd]
+    assert via in pcb.find_on_net ("VCC")
+    new = new_via (pcb, 3, 3, net=1)
+    pcb.add (new)
+    pcb.delete (seg_gnd)
+    assert pcb.find_on_net ("GND") == [new]
+
+    # Renumbering a name keeps the reverse lookup right
+    nets[5] = "GND"
+    assert nets.id_of ("GND") == 5
+    del nets[1]
+    assert nets.id_of ("GND") == 5
+
+def test_delete_tombstones (tmp_path, lazy):
+    pcb = load (tmp_path, lazy=lazy)
+    before = list (pcb.children)
+    segs = pcb.find_types (SegmentSexp)
+    pcb.delete_many (segs + segs)
+    pcb.delete (segs[0])
+    assert pcb.find_types (SegmentSexp) == []
+    assert pcb.children == [i for i in before if i not in segs]
+
+    # Deleted and added back goes on the end, once
+    pcb.add (segs[0])
+    assert pcb.children[-1] is segs[0]
+    assert pcb.children.count (segs[0]) == 1
+
+    out = str (tmp_path / "out.kicad_pcb")
+    pcb.write (out)
+    assert len (KicadPCB (out).find_types (SegmentSexp)) == 1
+
+def test_type_and_keyword_index (tmp_path, lazy):
+    pcb = load (tmp_path, board_with ([
+        segment_text (0, 0, 1, 0), via_text (1, 0),
+        "(gr_line (start 0 0) (end 9 0) (layer Edge.Cuts) (width 0.1))",
+        segment_text (1, 0, 2, 0)]), lazy=lazy)
+    segs = pcb.find_types (SegmentSexp)
+    assert [i.start for i in segs] == [[0, 0], [1, 0]]
+    lines = pcb.find_keyword ("gr_line")
+    assert len (lines) == 1 and lines[0].name == "gr_line"
+    assert len (pcb.find_keyword ("net")) == 3
+    # A base class gets every subclass's items, in board order
+    items = pcb.find_types ((SegmentSexp, ViaSexp))
+    assert [type (i) for i in items] == [SegmentSexp, ViaSexp, SegmentSexp]
+
+    view = pcb.view_types (SegmentSexp)
+    pcb.delete (segs[0])
+    pcb.add (new_via (pcb, 5, 5))
+    pcb.extend ([segs[0]])
+    assert list (view) == [segs[1], segs[0]]
+    assert len (pcb.view_keyword ("via")) == 2
+    pcb.children = [i for i in pcb.children if not isinstance (i, ViaSexp)]
+    assert pcb.find_keyword ("via") == []
+
+MODULE = """  (module Resistor_SMD:R_0603_1608Metric (layer F.Cu) (tedit 5B301BBD)
+    (at 20 20 90)
+    (fp_text reference R1 (at 0 -1.43 90) (layer F.SilkS))
+    (fp_text value 10k (at 0 1.43 90) (layer F.Fab))
+    (pad 1 smd roundrect (at -0.7875 0 90) (size 0.875 0.95) (layers F.Cu F.Paste F.Mask) (net 1 GND))
+    (pad 2 smd roundrect (at 0.7875 0 90) (size 0.875 0.95) (layers F.Cu F.Paste F.Mask) (net 2 VCC))
+  )
+"""
+
+def with_module (text=BOARD):
+    return text.replace ("\n  (via ", "\n" + MODULE + "  (via ", 1)
+
+def check_spatial_index (pcb, rnd):
+    """Compare the index's queries with checking every item"""
+    index = pcb.spatial_index ()
+    items = pcb.find_types ((ViaSexp, SegmentSexp))
+    for module in pcb.view_keyword ("module"):
+        items += kicad_tools.module_pads (module)
+    # Pads are told apart by module and number
+    def key (item):
+        if isinstance (item, kicad_tools.PadSexp):
+            return item.module, item.number
+        return item
+    def found (items):
+        return set (key (i) for i in items)
+    shapes = dict ((key (i), kicad_tools.item_shape (i)) for i in items)
+    def distance (item, x, y):
+        x0, y0, x1, y1, r = shapes[key (item)]
+        d = kicad_tools._point_segment_distance (x, y, x0, y0, x1, y1) - r
+        return max (d, 0.)
+
+    for i in range (20):
+        x, y = rnd.uniform (-2, 12), rnd.uniform (-2, 12)
+        radius = rnd.choice ((0, 0.5, 3))
+        assert found (index.in_radius (x, y, radius)) == \
+            found (i for i in items if distance (i, x, y) <= radius)
+        assert found (index.in_radius (x, y, radius, kind=ViaSexp,
+                                       layer="B.Cu")) == \
+            found (i for i in items if distance (i, x, y) <= radius and
+                   isinstance (i, ViaSexp))
+
+        x1, y1 = x + rnd.uniform (-4, 4), y + rnd.uniform (-4, 4)
+        expect = set ()
+        for item in items:
+            sx0, sy0, sx1, sy1, r = shapes[key (item)]
+            if kicad_tools._segment_rect_distance (
+                    sx0, sy0, sx1, sy1, min (x, x1), min (y, y1),
+                    max (x, x1), max (y, y1)) <= r:
+                expect.add (key (item))
+        assert found (index.in_rect (x, y, x1, y1)) == expect
+
+        item, d = index.nearest (x, y)
+        assert d == pytest.approx (min (distance (i, x, y) for i in items))
+        assert distance (item, x, y) == pytest.approx (d)
+        if d > 0:
+            assert index.nearest (x, y, max_distance=d / 2) == (None, None)
+
+@pytest.mark.parametrize ("seed", range (5))
+def test_spatial_index_against_brute_force (tmp_path, seed):
+    import random
+    rnd = random.Random (seed)
+    items = [via_text (5, 5)]
+    for i in range (30):
+        x, y = rnd.uniform (0, 10), rnd.uniform (0, 10)
+        if rnd.random () < 0.3:
+            items.append (via_text (x, y))
+        else:
+            items.append (segment_text (x, y, x + rnd.uniform (-5, 5),
+                                        y + rnd.uniform (-5, 5),
+                                        rnd.choice (("F.Cu", "B.Cu"))))
+    text = with_module (board_with (items)).replace ("(at 20 20 90)",
+                                                     "(at 4 6 90)")
+    pcb = load (tmp_path, text)
+    check_spatial_index (pcb, rnd)
+
+    # Moves, adds and deletes after it's built are picked up
+    segs = pcb.find_types (SegmentSexp)
+    segs[0].start = [rnd.uniform (0, 10), rnd.uniform (0, 10)]
+    segs[1].width = 2
+    pcb.find_types (ViaSexp)[0].pos = [11, 11]
+    pcb.delete (segs[2])
+    pcb.add (new_via (pcb, 1, 9))
+    check_spatial_index (pcb, rnd)
+
+def test_spatial_index_empty (tmp_path):
+    index = load (tmp_path, board_with ([])).spatial_index ()
+    assert index.nearest (0, 0) == (None, None)
+    assert index.in_radius (0, 0, 10) == []
+    assert index.in_rect (-10, -10, 10, 10) == []
+
+def test_track_arrays_round_trip (tmp_path):
+    pytest.importorskip ("numpy")
+    pcb = load (tmp_path)
+    arrays = pcb.export_tracks ()
+    assert arrays.layers[:2] == ["F.Cu", "B.Cu"]
+    assert arrays.via_layers.tolist () == [[0, 1]]
+    assert arrays.seg_layer.tolist () == [0, 1]
+    arrays.seg_width[:] = 0.5
+    arrays.via_layers[0] = [1, 0]
+    assert pcb.import_tracks (arrays) == 3
+    assert [i.width for i in pcb.find_types (SegmentSexp)] == [0.5, 0.5]
+    assert [str (i) for i in pcb.find_types (ViaSexp)[0].layers] == \
+        ["B.Cu", "F.Cu"]
+
+def track_columns (arrays):
+    return dict ((i, getattr (arrays, i).tolist ()) for i in (
+        "via_pos", "via_size", "via_drill", "via_layers", "via_net",
+        "seg_start", "seg_end", "seg_width", "seg_layer", "seg_net"))
+
+def test_track_arrays_from_text (tmp_path):
+    pytest.importorskip ("numpy")
+    # Fields the way KiCad 5 writes them are read from the text; reordered
+    # or extra ones aren't, and have to come out the same from the tree
+    plain = board_with ([
+        via_text (1, 2), segment_text (0, 0, 1.5, -0.5, "B.Cu", 2),
+        segment_text (3, 3, 4, 4), via_text (-7, 8, 2)])
+    odd = board_with ([
+        "(via (at 1 2) (size 0.8) (layers F.Cu B.Cu) (drill 0.4) (net 1))",
+        "(segment (start 0 0) (end 1.5 -0.5) (width 0.25) (layer \"B.Cu\") "
+        "(tstamp 5C0B1A2F) (net 2))",
+        "(segment (end 4 4) (start 3 3) (width 0.25) (layer F.Cu) (net 1))",
+        "(via blind (at -7 8) (size 0.8) (drill 0.4) (layers F.Cu B.Cu) "
+        "(net 2) (tstamp 0))"])
+    fast = load (tmp_path, plain, "plain.kicad_pcb")
+    slow = load (tmp_path, odd, "odd.kicad_pcb")
+    rows = []
+    for pcb in (fast, slow):
+        for regex in (kicad_tools._VIA_TEXT_RE, kicad_tools._SEGMENT_TEXT_RE):
+            rows.append (sum (1 for i in pcb.find_types ((ViaSexp, SegmentSexp))
+                              if regex.match (pcb._text, *i._span)))
+    assert rows == [2, 2, 0, 0]
+    assert track_columns (slow.export_tracks ()) == \
+        track_columns (fast.export_tracks ())
+
+    # Once modified, an item is read from its tree
+    fast.find_types (SegmentSexp)[1].width = 1
+    assert fast.export_tracks ().seg_width.tolist () == [0.25, 1]
+
+@pytest.mark.parametrize ("value, text", [
+    (0., "0"), (-0., "0"), (1., "1"), (0.25, "0.25"), (-1.5, "-1.5"),
+    (1e-05, "0.00001"), (-3e-07, "-0.0000003"), (1e-12, "0"),
+    (123456.789, "123456.789"), (1 / 3., "0.3333333333"), (7, "7"),
+])
+def test_format_number (value, text):
+    assert kicad_tools.format_number (value) == text
+
+def test_sexp_to_str ():
+    sexp = kicad_tools.parse_sexp (
+        '(a b "c d" "e\\"f\\\\g\\nh" 1.5 -2 (x (y 1)) () "")')
+    text = kicad_tools.sexp_to_str (sexp)
+    assert text == '(a b "c d" "e\\"f\\\\g\\nh" 1.5 -2 (x (y 1)) () "")'
+    assert kicad_tools.parse_sexp (text) == sexp
+    assert kicad_tools.sexp_to_str (sexp, indent=True) == text
+
+    # Long lists with lists in them go over several lines
+    long = [kicad_tools.S ("module"), "x" * 60] + \
+        [[kicad_tools.S ("pad"), i, [kicad_tools.S ("at"), i, 0]]
+         for i in range (4)]
+    pretty = kicad_tools.sexp_to_str (long, indent=True)
+    assert pretty.split ("\n") == ['(module "%s"' % ("x" * 60),
+                                   "  (pad 0 (at 0 0))",
+                                   "  (pad 1 (at 1 0))",
+                                   "  (pad 2 (at 2 0))",
+                                   "  (pad 3 (at 3 0))",
+                                   ")"]
+    assert kicad_tools.parse_sexp (pretty) == long
+
+def test_write_indent_and_reformat (tmp_path):
+    text = with_module ().replace ("(width 0.25)", "(width   0.25)")
+    pcb = load (tmp_path, text)
+    out = str (tmp_path / "out.kicad_pcb")
+
+    # Only touched items are serialized
+    seg = pcb.find_types (SegmentSexp)[0]
+    seg.width = 0.5
+    pcb.write (out)
+    written = open (out).read ()
+    assert written.count ("(width   0.25)") == 1
+    assert "(width 0.5)" in written
+
+    for kwargs in ({"reformat": True}, {"reformat": True, "indent": True}):
+        pcb.write (out, **kwargs)
+        written = open (out).read ()
+        assert "(width   0.25)" not in written
+        again = KicadPCB (out)
+        assert [i.out () for i in again.children] == \
+            [i.out () for i in pcb.children]
+    # Indenting puts the module's pads on lines of their own
+    assert "\n    (pad 1 smd" in written
+
+def test_parse_sexp_indented_round_trip ():
+    tree = kicad_tools.parse_sexp (BOARD)
+    assert kicad_tools.parse_sexp (
+        kicad_tools.sexp_to_str (tree, indent=True)) == tree
+
+def test_board_cache (tmp_path, lazy):
+    path = write_board (tmp_path, BOARD)
+    cache = kicad_tools.BoardCache (str (tmp_path / "cache"))
+    cold = KicadPCB (path, lazy=lazy, cache=cache)
+    assert cache.size () > 0
+    warm = KicadPCB (path, lazy=lazy, cache=cache)
+    assert [i.out () for i in warm.children] == \
+        [i.out () for i in cold.children]
+    assert [i._prefix for i in warm.children] == \
+        [i._prefix for i in cold.children]
+    assert warm.nets == cold.nets
+
+    warm.find_types (ViaSexp)[0].size = 1.0
+    out = str (tmp_path / "out.kicad_pcb")
+    warm.write (out)
+    assert KicadPCB (out).find_types (ViaSexp)[0].size == 1.0
+    assert len (KicadPCB (out).children) == len (cold.children)
+
+def test_board_cache_invalidation (tmp_path):
+    path = write_board (tmp_path, BOARD)
+    cache = kicad_tools.BoardCache (str (tmp_path / "cache"))
+    KicadPCB (path, cache=cache)
+    write_board (tmp_path, BOARD.replace ("(at 10 10)", "(at 11 10)"))
+    assert KicadPCB (path, cache=cache).find_types (ViaSexp)[0].pos == [11, 10]
+
+    # A damaged entry is just parsed again
+    for entry in (tmp_path / "cache").iterdir ():
+        entry.write_bytes (entry.read_bytes ()[:20])
+    assert KicadPCB (path, cache=cache).find_types (ViaSexp)[0].pos == [11, 10]
+
+def test_board_cache_eviction (tmp_path):
+    cache = kicad_tools.BoardCache (str (tmp_path / "cache"), max_size=1)
+    KicadPCB (write_board (tmp_path, BOARD), cache=cache)
+    assert cache.size () == 0
+
+def test_board_cache_mtime_key (tmp_path):
+    path = write_board (tmp_path, BOARD)
+    cache = kicad_tools.BoardCache (str (tmp_path / "cache"), key="mtime")
+    KicadPCB (path, cache=cache)
+    assert KicadPCB (path, cache=cache).find_types (ViaSexp)[0].pos == \
+        [10, 10]
+    write_board (tmp_path, BOARD.replace ("(at 10 10)", "(at 120 10)"))
+    assert KicadPCB (path, cache=cache).find_types (ViaSexp)[0].pos == \
+        [120, 10]
+    with pytest.raises (ValueError):
+        kicad_tools.BoardCache (str (tmp_path / "cache"), key="size")
+
+def test_board_cache_mtime_hit_reads_nothing (tmp_path):
+    path = write_board (tmp_path, BOARD)
+    cache = kicad_tools.BoardCache (str (tmp_path / "cache"), key="mtime")
+    KicadPCB (path, cache=cache)
+    with kicad_stats.collect () as stats:
+        warm = KicadPCB (path, cache=cache)
+        assert warm.find_types (ViaSexp)[0].pos == [10, 10]
+    assert stats.bytes_read == 0
+
+    # The text is read when it's needed, as long as the file's the same
+    out = str (tmp_path / "out.kicad_pcb")
+    warm.write (out)
+    assert open (out, encoding="utf-8").read () == BOARD
+
+    warm = KicadPCB (path, cache=cache)
+    stat = os.stat (path)
+    write_board (tmp_path, BOARD.replace ("(at 10 10)", "(at 120 10)"))
+    os.utime (path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    with pytest.raises (ValueError):
+        warm.write (out)
+
+def test_run_batch (tmp_path):
+    import functools
+    stacked = board_with ([via_text (1, 1), via_text (1, 1), via_text (1, 1.05),
+                           via_text (4, 4)])
+    a = write_board (tmp_path, stacked, "a.kicad_pcb")
+    b = write_board (tmp_path, stacked, "b.kicad_pcb")
+    c = str (tmp_path / "c.kicad_pcb")
+    bad = write_board (tmp_path, "(kicad_pcb (via", "bad.kicad_pcb")
+    results = kicad_tools.run_batch (
+        [a, (b, c), (b, None), bad],
+        [kicad_tools.remove_stacked_vias,
+         functools.partial (kicad_tools.remove_stacked_vias, tolerance=0.1)],
+        processes=1)
+
+    assert [i.filename for i in results] == [a, b, b, bad]
+    assert [i.output for i in results] == [a, c, None, bad]
+    for i in results[:3]:
+        assert i.error is None
+        assert i.results == [(1, 1), (1, 1)]
+        assert i.total_time >= 0
+    assert len (KicadPCB (a).find_types (ViaSexp)) == 2
+    assert len (KicadPCB (c).find_types (ViaSexp)) == 2
+    # Written elsewhere or not at all leaves the input be
+    assert open (b).read () == stacked
+
+    assert "Traceback" in results[3].error
+    assert open (bad).read () == "(kicad_pcb (via"
+    assert "failed" in repr (results[3])
+
+def test_run_batch_processes (tmp_path):
+    boards = [write_board (tmp_path, board_with ([via_text (1, 1)] * (i + 1)),
+                           "%d.kicad_pcb" % i) for i in range (3)]
+    results = kicad_tools.run_batch (boards, [kicad_tools.remove_stacked_vias],
+                                     processes=2)
+    assert [i.results for i in results] == [[(0, 0)], [(1, 1)], [(1, 2)]]
+    assert [len (KicadPCB (i).find_types (ViaSexp)) for i in boards] == \
+        [1, 1, 1]
+
+@pytest.mark.parametrize ("chunk_size", [7, 1 << 20])
+def test_board_stream (tmp_path, chunk_size):
+    text = with_module ()
+    filename = write_board (tmp_path, text)
+    pcb = KicadPCB (filename)
+    with kicad_tools.BoardStream (filename, chunk_size) as stream:
+        got = []
+        for i in stream:
+            assert type (i) is type (pcb.children[len (got)])
+            got.append ((i._prefix, i.out ()))
+        assert got == [(i._prefix, i.out ()) for i in pcb.children]
+        assert stream.nets.id_of ("VCC") == 2
+        assert stream.copper_layers == ["F.Cu", "B.Cu"]
+        with pytest.raises (ValueError, match="only be read once"):
+            iter (stream).__next__ ()
+
+    out = str (tmp_path / "out.kicad_pcb")
+    stream = kicad_tools.BoardStream (filename, chunk_size)
+    assert stream.write (out) == (len (pcb.children), len (pcb.children))
+    assert open (out).read () == text
+
+def test_board_stream_transforms (tmp_path):
+    filename = write_board (tmp_path, BOARD)
+    out = str (tmp_path / "out.kicad_pcb")
+
+    def no_vias (item):
+        return None if isinstance (item, ViaSexp) else item
+    def widen (item):
+        if isinstance (item, SegmentSexp):
+            item.width = 1
+        return item
+    def doubled (item):
+        if not isinstance (item, SegmentSexp):
+            return item
+        copy = SegmentSexp (item.pcb, kicad_tools.parse_sexp (
+            kicad_tools.sexp_to_str (item.out ())))
+        copy._prefix = item._prefix
+        return [item, copy]
+
+    stream = kicad_tools.BoardStream (filename, 16)
+    n_read, n_written = stream.write (out, [no_vias, widen, doubled])
+    assert n_written == n_read - 1 + 2
+    pcb = KicadPCB (out)
+    assert pcb.find_types (ViaSexp) == []
+    assert [(i.width, i.get_value ("net")) for i in
+            pcb.find_types (SegmentSexp)] == [(1, 1), (1, 1), (1, 2), (1, 2)]
+    assert open (out).read ().count ("(width 1)") == 4
+
+def test_board_stream_errors (tmp_path):
+    stream = kicad_tools.BoardStream (write_board (tmp_path, BOARD), 16)
+    items = list (stream)
+    with pytest.raises (ValueError, match="after the stream moved on"):
+        items[0].out ()
+    with pytest.raises (ValueError):
+        list (kicad_tools.BoardStream (write_board (
+            tmp_path, BOARD.replace (")\n)\n", ")\n"), "bad.kicad_pcb"), 16))
+    with pytest.raises (ValueError, match="no s-expression"):
+        kicad_tools.BoardStream (write_board (tmp_path, "", "empty.kicad_pcb"))
+
+ZONE = """(zone (net 1) (net_name GND) (layer F.Cu) (hatch edge 0.508)
+    (polygon (pts (xy 0 0) (xy 10 0) (xy 10 10) (xy 0 10)))
+    (filled_polygon (pts (xy 1 1) (xy 9 1) (xy 9 9) (xy 1 9))))"""
+
+def with_zone (text=BOARD, zone=ZONE):
+    return text.replace ("\n)\n", "\n  " + zone + "\n)\n")
+
+def test_zone_point_lists (tmp_path, lazy):
+    pcb = load (tmp_path, with_zone (), lazy=lazy)
+    zone = pcb.find_keyword ("zone")[0]
+    assert isinstance (zone, kicad_tools.ZoneSexp)
+    fill, = zone.fills ()
+    outline, = zone.outlines ()
+    assert isinstance (fill, kicad_tools.PointList)
+    assert list (fill) == [(1, 1), (9, 1), (9, 9), (1, 9)]
+    assert zone.area () == 64 and zone.area (filled=False) == 100
+    assert zone.fills ("B.Cu") == []
+    assert zone.bbox () == (0, 0, 10, 10)
+    assert zone.contains (5, 5) and not zone.contains (0.5, 0.5)
+    assert zone.contains (0.5, 0.5, filled=False)
+    assert zone.net == "GND" and zone in pcb.find_on_net ("GND")
+    # out () gives the lists the text parses to
+    assert zone.out () == kicad_tools.parse_sexp (ZONE)
+
+    # So does sexp, and changes to it are written out
+    tree = zone.sexp
+    assert tree == kicad_tools.parse_sexp (ZONE)
+    tree[-1][1][1][1] = 2
+    out = str (tmp_path / "out.kicad_pcb")
+    pcb.write (out)
+    again = KicadPCB (out).find_keyword ("zone")[0]
+    assert list (again.fills ()[0])[0] == (2, 1)
+    assert again.out () == tree
+
+def test_point_list_text ():
+    points = kicad_tools.PointList ([0, -0., 1.5, 1e-05, -2, 123456.5])
+    assert len (points) == 3
+    assert list (points) == [(0, 0), (1.5, 1e-05), (-2, 123456.5)]
+    fmt = kicad_tools._AtomFormats ().__getitem__
+    assert points._text (fmt) == \
+        kicad_tools.sexp_to_str (points.out ()) == \
+        "(pts (xy 0 0) (xy 1.5 0.00001) (xy -2 123456.5))"
+    assert kicad_tools.PointList.from_text (" (xy 1 2) (xy 3 -4)") == \
+        kicad_tools.PointList ([1, 2, 3, -4])
+    assert kicad_tools.PointList ().area () == 0
+    assert kicad_tools.PointList ().bbox () is None
+
+def test_module_pads (tmp_path, lazy):
+    text = with_module (board_with ([via_text (20, 20.7875), via_text (0, 0)]))
+    pcb = load (tmp_path, text, lazy=lazy)
+    module, = pcb.find_keyword ("module")
+    assert isinstance (module, kicad_tools.ModuleSexp)
+    assert (module.reference, module.value) == ("R1", "10k")
+    assert module.pos == [20, 20] and module.rotation == 90
+    assert module.layer == kicad_tools.S ("F.Cu")
+
+    pad1, pad2 = module.pads
+    assert module.pads is module.pads and module.pad (2) is pad2
+    assert module.pad ("3") is None
+    assert pad1.pos == pytest.approx ([20, 20.7875])
+    assert (pad1.shape, pad1.rotation, pad1.net, pad1.net_id) == \
+        ("roundrect", 90, "GND", 1)
+    assert module.pads_on_net ("VCC") == [pad2]
+    assert pcb.find_pads_on_net ("GND") == [pad1]
+    # Rotated 90, the pad is 0.95 across in x and 0.875 in y
+    assert pad1.distance (20.475 + 0.1, 20.7875) == pytest.approx (0.1)
+    assert pad1.distance (20, 20.7875 + 0.4375 + 0.1) == pytest.approx (0.1)
+
+    via, far = pcb.find_types (ViaSexp)
+    assert pcb.find_pads_under (via) == [pad1]
+    assert pcb.find_pads_under (far) == []
+
+    # Moving the module keeps its rotation and takes the pads along
+    module.pos = [30, 20]
+    assert module.rotation == 90
+    assert pad1.pos == pytest.approx ([30, 20.7875])
+    assert pcb.find_pads_under (via) == []
+    module.reference = "R2"
+    out = str (tmp_path / "out.kicad_pcb")
+    pcb.write (out)
+    module, = KicadPCB (out).find_keyword ("module")
+    assert module.reference == "R2" and module.pos == [30, 20]
+
+def test_footprint_keyword (tmp_path):
+    text = with_module ().replace ("(module ", "(footprint ")
+    footprint, = load (tmp_path, text).find_keyword ("footprint")
+    assert isinstance (footprint, kicad_tools.FootprintSexp)
+    assert [i.number for i in footprint.pads] == ["1", "2"]
+
+def test_connectivity_t_junction (tmp_path):
+    pcb = load (tmp_path, board_with ([
+        segment_text (0, 0, 2, 0),
+        segment_text (1, 0, 1, 1),
+        segment_text (5, 0, 6, 0),
+        segment_text (5, 0, 5, 1, layer="B.Cu")]))
+    conn = pcb.connectivity ()
+    assert conn.split_nets () == {"GND": 3}
+    a, b, c, d = pcb.find_types (SegmentSexp)
+    assert conn.connected (a, b)
+    assert not conn.connected (c, d)
+
+def test_connectivity_follows_edits (tmp_path):
+    # Two tracks on different layers joined by a via, and a pad at the end
+    text = with_module (board_with ([
+        segment_text (0, 0, 5, 0, layer="B.Cu"),
+        via_text (5, 0),
+        segment_text (5, 0, 20, 20.7875),
+        segment_text (30, 30, 31, 30)]))
+    pcb = load (tmp_path, text)
+    conn = pcb.connectivity ()
+    a, b, far = pcb.find_types (SegmentSexp)
+    via, = pcb.find_types (ViaSexp)
+    pad = pcb.find_pads_on_net ("GND")[0]
+    assert conn.split_nets () == {"GND": 2}
+    assert conn.connected (a, pad) and conn.island_of (via) == \
+        conn.island_of (b)
+    assert sorted (tuple (getattr (s, e)) for s, e in conn.dangling ("GND")) \
+        == [(0, 0), (30, 30), (31, 30)]
+
+    pcb.delete (via)
+    assert not conn.connected (a, b)
+    assert conn.split_nets ()["GND"] == 3
+    far.start = [20, 20.7875]
+    far.layer = "F.Cu"
+    assert conn.split_nets ()["GND"] == 2
+    assert conn.connected (far, b)
+    far.net = "VCC"
+    assert conn.split_nets () == {"GND": 2, "VCC": 2}
+
+def merged_tracks (pcb):
+    return sorted ((tuple (sorted ((tuple (i.start[:2]), tuple (i.end[:2])))),
+                    i.layer, i.get_value ("net")) for i in pcb.find_types (SegmentSexp))
+
+def test_merge_collinear_chain (tmp_path):
+    pytest.importorskip ("numpy")
+    pcb = load (tmp_path, board_with ([
+        segment_text (0, 0, 1, 0),
+        segment_text (2, 0, 1, 0),
+        segment_text (2, 0, 3, 0),
+        # Not merged: different layer, net, or a via at the joint
+        segment_text (3, 0, 4, 0, layer="B.Cu"),
+        segment_text (0, 5, 1, 5),
+        segment_text (1, 5, 2, 5, net=2),
+        via_text (0, 9),
+        segment_text (-1, 9, 0, 9),
+        segment_text (0, 9, 1, 9)]))
+    assert kicad_tools.merge_collinear_segments (pcb) == (1, 2)
+    assert len (pcb.find_types (SegmentSexp)) == 6
+    assert ((0, 0), (3, 0)) in [i[0] for i in merged_tracks (pcb)]
+
+def test_merge_collinear_corners_and_curve (tmp_path):
+    pytest.importorskip ("numpy")
+    # A closed square only merges along its straight side; a gentle curve
+    # is split where it drifts off the line between its ends
+    items = [segment_text (0, 0, 2, 0), segment_text (2, 0, 4, 0),
+             segment_text (4, 0, 4, 4), segment_text (4, 4, 0, 4),
+             segment_text (0, 4, 0, 0)]
+    items += [segment_text (i * 10, 20 + (i * i) * 1e-3,
+                            (i + 1) * 10, 20 + ((i + 1) ** 2) * 1e-3)
+              for i in range (6)]
+    pcb = load (tmp_path, board_with (items))
+    n_chains, n_removed = kicad_tools.merge_collinear_segments (pcb)
+    tracks = [i[0] for i in merged_tracks (pcb)]
+    assert ((0, 0), (4, 0)) in tracks
+    assert len ([i for i in tracks if i[0][1] >= 20]) > 1
+    assert n_removed == 11 - len (tracks)
+
+def test_merge_collinear_blockers (tmp_path):
+    pytest.importorskip ("numpy")
+    # Joints that stop a merge: a width change, a via, a pad (R1's pad 1 is
+    # at (20, 20.7875)), a third track end, a bend beyond the tolerance. The
+    # last chain bends within it.
+    text = board_with ([
+        segment_text (0, 0, 1, 0), segment_text (1, 0, 2, 0, width=0.5),
+        segment_text (0, 3, 1, 3), segment_text (1, 3, 2, 3), via_text (1, 3),
+        segment_text (20, 19, 20, 20.7875), segment_text (20, 20.7875, 20, 22),
+        segment_text (0, 5, 1, 5), segment_text (1, 5, 2, 5),
+        segment_text (1, 5, 1, 6),
+        segment_text (0, 8, 1, 8), segment_text (1, 8, 2, 8.01),
+        segment_text (0, 10, 1, 10.00001), segment_text (1, 10.00001, 2, 10)],
+        with_module ())
+    pcb = load (tmp_path, text)
+    assert kicad_tools.merge_collinear_segments (pcb, tolerance=1e-4) == \
+        (1, 1)
+    tracks = [i[0] for i in merged_tracks (pcb)]
+    assert ((0, 10), (2, 10)) in tracks and len (tracks) == 12
+    assert kicad_tools.merge_collinear_segments (pcb, tolerance=0.1) == \
+        (1, 1)
+    assert ((0, 8), (2, 8.01)) in [i[0] for i in merged_tracks (pcb)]
+
+OTHER = """(kicad_pcb (version 20171130) (host pcbnew 5.1.5)
+  (net 0 "")
+  (net 1 GND)
+  (gr_text "a long string of text to push the other spans well out of line"
+    (at 0 0) (layer F.SilkS))
+  (via (at 33 44) (size 0.6) (drill 0.3) (layers F.Cu B.Cu) (net 1))
+)
+"""
+
+def test_move_item_between_boards (tmp_path, lazy):
+    p1 = load (tmp_path, OTHER, "other.kicad_pcb", lazy=lazy)
+    p2 = load (tmp_path, lazy=lazy)
+    via = p1.find_types (ViaSexp)[0]
+    p1.delete (via)
+    p2.add (via)
+
+    out = str (tmp_path / "out.kicad_pcb")
+    p2.write (out)
+    p3 = KicadPCB (out)
+    assert sorted (tuple (i.pos) for i in p3.find_types (ViaSexp)) == \
+        [(10, 10), (33, 44)]
+
+    p1.write (out)
+    assert [i.pos for i in KicadPCB (out).find_types (ViaSexp)] == []
+
+def test_moved_item_in_track_arrays (tmp_path):
+    pytest.importorskip ("numpy")
+    p1 = load (tmp_path, OTHER, "other.kicad_pcb")
+    p2 = load (tmp_path)
+    p2.add (p1.find_types (ViaSexp)[0])
+    arrays = p2.export_tracks ()
+    assert arrays.via_pos.tolist () == [[10, 10], [33, 44]]
+
+def test_foreign_spans_are_not_copied (tmp_path):
+    # The via's span points into OTHER's text; copying that range of BOARD
+    # would write a piece of some other item instead
+    via = load (tmp_path, OTHER, "other.kicad_pcb").find_types (ViaSexp)[0]
+    assert via._span is not None
+    pcb = load (tmp_path)
+    pcb.add (via)
+    out = str (tmp_path / "out.kicad_pcb")
+    with kicad_stats.collect () as stats:
+        pcb.write (out)
+    assert stats.counts["pcb.write.serialized"] == 1
+    via_line = "  (via (at 33 44) (size 0.6) (drill 0.3) (layers F.Cu B.Cu) " \
+        "(net 1))\n"
+    assert open (out, encoding="utf-8").read () == \
+        BOARD[:-2] + via_line + BOARD[-2:]
+
+def test_children_append_and_delete_keep_index (tmp_path, lazy):
+    pcb = load (tmp_path, lazy=lazy)
+    via = new_via (pcb, 1, 2)
+    pcb.children.append (via)
+    assert via in pcb.find_types (ViaSexp)
+    assert via in pcb.find_keyword ("via")
+    assert via in pcb.find_on_net ("GND")
+
+    old = pcb.find_types (ViaSexp)[0]
+    del pcb.children[pcb.children.index (old)]
+    assert pcb.find_types (ViaSexp) == [via]
+    assert old not in pcb.find_on_net ("GND")
+
+    seg = pcb.find_types (SegmentSexp)[0]
+    pcb.children.remove (seg)
+    assert seg not in pcb.find_types (SegmentSexp)
+
+def test_children_edits_in_place (tmp_path):
+    pcb = load (tmp_path)
+    children = pcb.children
+    a, b = new_via (pcb, 1, 1), new_via (pcb, 2, 2)
+    children.insert (0, a)
+    children += [b]
+    assert pcb.find_types (ViaSexp)[0] is a
+    assert pcb.find_types (ViaSexp)[-1] is b
+
+    children[0] = new_via (pcb, 3, 3)
+    assert a not in pcb.find_types (ViaSexp)
+    vias = [i for i in children if isinstance (i, ViaSexp)]
+    children.reverse ()
+    assert pcb.find_types (ViaSexp) == vias[::-1]
+
+    children[:] = [i for i in children if not isinstance (i, ViaSexp)]
+    assert pcb.find_types (ViaSexp) == []
+    assert pcb.find_on_net ("GND", ViaSexp) == []
+
+def test_children_copy_is_plain_list (tmp_path):
+    import copy
+    pcb = load (tmp_path)
+    dup = copy.copy (pcb.children)
+    assert type (dup) is list
+    dup.append (new_via (pcb, 1, 1))
+    assert len (pcb.find_types (ViaSexp)) == 1
+
+def test_children_after_tombstone (tmp_path):
+    pcb = load (tmp_path)
+    children = pcb.children
+    via = pcb.find_types (ViaSexp)[0]
+    pcb.delete (via)
+    children.insert (0, new_via (pcb, 5, 5))
+    assert via not in pcb.children
+    assert [i.pos for i in pcb.find_types (ViaSexp)] == [[5, 5]]
+
+def test_children_setter (tmp_path):
+    pcb = load (tmp_path)
+    children = pcb.children
+    pcb.children = [i for i in children if not isinstance (i, SegmentSexp)]
+    assert pcb.children is children
+    assert pcb.find_types (SegmentSexp) == []
+    assert len (pcb.find_types (ViaSexp)) == 1
+
+def test_track_arrays_unknown_layer_code (tmp_path):
+    pytest.importorskip ("numpy")
+    pcb = load (tmp_path)
+    arrays = pcb.export_tracks ()
+    arrays.via_layers[0] = [-1, 0]
+    arrays.seg_layer[1] = -1
+    arrays.seg_width[1] = 0.3
+    pcb.import_tracks (arrays)
+    via = pcb.find_types (ViaSexp)[0]
+    seg = pcb.find_types (SegmentSexp)[1]
+    assert [str (i) for i in via.layers] == ["F.Cu", "F.Cu"]
+    assert str (seg.layer) == "B.Cu" and seg.width == 0.3
+
+    arrays.seg_layer[0] = len (arrays.layers)
+    with pytest.raises (ValueError):
+        pcb.import_tracks (arrays)
+
+def test_track_arrays_no_layer_to_keep (tmp_path):
+    pytest.importorskip ("numpy")
+    pcb = load (tmp_path)
+    pcb.add (SegmentSexp (pcb, kicad_tools.parse_sexp (
+        "(segment (start 0 0) (end 1 1) (width 0.2) (net 1))")))
+    arrays = pcb.export_tracks ()
+    assert arrays.seg_layer.tolist ()[-1] == -1
+    arrays.seg_width[-1] = 0.3
+    pcb.import_tracks (arrays)
+    assert pcb.find_types (SegmentSexp)[-1].layer is None
+
+    pcb.add (ViaSexp (pcb, kicad_tools.parse_sexp (
+        "(via (at 1 1) (size 0.8) (drill 0.4) (net 1))")))
+    arrays = pcb.export_tracks ()
+    assert arrays.via_layers.tolist ()[-1] == [-1, -1]
+    arrays.via_layers[-1] = [0, -1]
+    with pytest.raises (ValueError):
+        pcb.import_tracks (arrays)
+    assert pcb.find_types (ViaSexp)[-1].layers is None
+
+def test_board_cache_batches (tmp_path, monkeypatch):
+    monkeypatch.setattr (kicad_tools, "_CACHE_BATCH", 2)
+    text = BOARD.replace ("\n)\n", "".join (
+        "\n  " + via_text (i, i) for i in range (5)) + "\n)\n")
+    path = write_board (tmp_path, text)
+    cache = kicad_tools.BoardCache (str (tmp_path / "cache"))
+    KicadPCB (path, cache=cache)
+    warm = KicadPCB (path, cache=cache)
+    vias = warm.find_types (ViaSexp)
+    assert [i.pos for i in vias[::-1]] == \
+        [[4, 4], [3, 3], [2, 2], [1, 1], [0, 0], [10, 10]]
+    starts = [i._span[0] for i in vias]
+    assert not any (i in warm._cached or i in warm._unpickled for i in starts)
+    assert warm._cached
+    out = str (tmp_path / "out.kicad_pcb")
+    warm.write (out, reformat=True)
+    assert [i.out () for i in KicadPCB (out).children] == \
+        [i.out () for i in KicadPCB (path).children]
+
+def test_zone_points_round_trip ():
+    zone = kicad_tools._parse_zone (ZONE)
+    assert isinstance (zone[-1][1], kicad_tools.PointList)
+    plain = kicad_tools.parse_sexp (ZONE)
+    for indent in (False, True):
+        assert kicad_tools.sexp_to_str (zone, indent) == \
+            kicad_tools.sexp_to_str (plain, indent)
+    assert kicad_tools.ZoneSexp (None, zone).area () == 64
+
+def test_modules_and_zones_are_generic (tmp_path, lazy):
+    text = with_zone (with_module ())
+    pcb = load (tmp_path, text, lazy=lazy)
+    modules = [i for i in pcb.find_types (kicad_tools.GenericSexp)
+               if i.name == "module"]
+    assert len (modules) == 1
+    module = modules[0]
+    assert isinstance (module, kicad_tools.ModuleSexp)
+    assert module.keyword == "module"
+    assert module.footprint == "Resistor_SMD:R_0603_1608Metric"
+    assert module.reference == "R1"
+    assert [i.number for i in module.pads] == ["1", "2"]
+
+    zones = [i for i in pcb.find_types (kicad_tools.GenericSexp)
+             if i.name == "zone"]
+    assert len (zones) == 1 and isinstance (zones[0], kicad_tools.ZoneSexp)
+    assert pcb.find_keyword ("layers")[0].name == "layers"
+
+def test_connectivity_cross_junction (tmp_path):
+    pcb = load (tmp_path, board_with ([
+        segment_text (0, 0, 2, 0),
+        segment_text (1, 0, 1, 1),
+        segment_text (1, 0, 1, -1)]))
+    conn = pcb.connectivity ()
+    assert conn.split_nets () == {}
+    assert len (conn.islands ("GND")) == 1
+    ends = sorted ((tuple (getattr (s, e)), e) for s, e in conn.dangling ("GND"))
+    assert ends == [((0, 0), "start"), ((1, -1), "end"), ((1, 1), "end"),
+                    ((2, 0), "end")]
+
+def test_connectivity_pass_through_anchor (tmp_path):
+    # Two ends meeting on the middle of a track join it; on another layer
+    # they only join each other
+    pcb = load (tmp_path, board_with ([
+        segment_text (0, 0, 4, 0),
+        segment_text (1, 0, 1, 1), segment_text (1, 0, 0.5, 1),
+        segment_text (3, 0, 3, 1, "B.Cu"), segment_text (3, 0, 3, -1, "B.Cu")]))
+    conn = pcb.connectivity ()
+    assert conn.split_nets () == {"GND": 2}
+    assert sorted (len (i) for i in conn.islands ("GND")) == [2, 3]
+    assert len (conn.dangling ("GND")) == 6
+
+def brute_force_islands (pcb, net):
+    """Islands by checking every pair of items against each other"""
+    items = [i for i in pcb.find_on_net (net)
+             if isinstance (i, (SegmentSexp, ViaSexp))]
+    items += pcb.find_pads_on_net (net)
+    copper = pcb.copper_layers
+
+    def layers (item):
+        return set (i for i in copper if item.on_layer (i))
+    def anchors (item):
+        if isinstance (item, SegmentSexp):
+            return [item.start[:2], item.end[:2]]
+        return [item.pos[:2]]
+    def touches (item, x, y):
+        if isinstance (item, kicad_tools.PadSexp):
+            return item.distance (x, y) <= 0
+        x0, y0, x1, y1, r = kicad_tools.item_shape (item)
+        return kicad_tools._point_segment_distance (x, y, x0, y0, x1, y1) <= r
+
+    group = dict ((i, {i}) for i in items)
+    for i, a in enumerate (items):
+        for b in items[i + 1:]:
+            if not layers (a) & layers (b):
+                continue
+            if any (touches (b, x, y) for x, y in anchors (a)) or \
+                    any (touches (a, x, y) for x, y in anchors (b)):
+                merged = group[a] | group[b]
+                for j in merged:
+                    group[j] = merged
+    islands = set (frozenset (i) for i in group.values ())
+
+    dangling = set ()
+    for seg in items:
+        if not isinstance (seg, SegmentSexp):
+            continue
+        for end in ("start", "end"):
+            x, y = getattr (seg, end)[:2]
+            if not any (j is not seg and layers (j) & layers (seg) and
+                        touches (j, x, y) for j in items):
+                dangling.add ((seg, end))
+    return islands, dangling
+
+@pytest.mark.parametrize ("seed", range (20))
+def test_connectivity_against_brute_force (tmp_path, seed):
+    import random
+    rnd = random.Random (seed)
+    items = []
+    for i in range (40):
+        x, y = rnd.randrange (8), rnd.randrange (8)
+        if rnd.random () < 0.15:
+            items.append (via_text (x, y, rnd.choice ((1, 2))))
+            continue
+        # Mostly straight runs, so ends often land on other tracks' middles
+        dx, dy = rnd.choice (((1, 0), (0, 1), (1, 1), (2, 0), (0, 2), (3, 0)))
+        items.append (segment_text (x, y, x + dx, y + dy,
+                                    rnd.choice (("F.Cu", "B.Cu")),
+                                    rnd.choice ((1, 2))))
+    text = with_module (board_with (items)).replace ("(at 20 20 90)",
+                                                     "(at 3 3 90)")
+    pcb = load (tmp_path, text)
+    conn = pcb.connectivity ()
+    for net in ("GND", "VCC"):
+        islands, dangling = brute_force_islands (pcb, net)
+        assert set (frozenset (i) for i in conn.islands (net)) == islands
+        assert set (conn.dangling (net)) == dangling
+
+@pytest.mark.parametrize ("seed", range (5))
+def test_merge_collinear_against_walk (tmp_path, seed):
+    pytest.importorskip ("numpy")
+    import random
+    rnd = random.Random (seed)
+    items = []
+    for i in range (60):
+        # Runs cut into pieces, some meeting head to head, on a coarse grid
+        # so that runs cross and touch
+        x, y = rnd.randrange (10), rnd.randrange (10)
+        dx, dy = rnd.choice (((1, 0), (0, 1), (1, 1), (1, -1)))
+        net = rnd.choice ((1, 2))
+        for j in range (rnd.randrange (1, 4)):
+            a, b = (x, y), (x + dx, y + dy)
+            if rnd.random () < 0.5:
+                a, b = b, a
+            items.append (segment_text (a[0], a[1], b[0], b[1], net=net))
+            x, y = x + dx, y + dy
+    pcb = load (tmp_path, board_with (items))
+    before = merged_tracks (pcb)
+    kicad_tools.merge_collinear_segments (pcb)
+    after = merged_tracks (pcb)
+
+    # Every merged track covers a straight run of the originals, and every
+    # original lies on exactly one merged track of its net and layer
+    def on (p, track):
+        (x0, y0), (x1, y1) = track
+        return abs ((x1 - x0) * (p[1] - y0) - (y1 - y0) * (p[0] - x0)) < 1e-9 \
+            and min (x0, x1) <= p[0] <= max (x0, x1) \
+            and min (y0, y1) <= p[1] <= max (y0, y1)
+    for ends, layer, net in before:
+        hits = [t for t, l, n in after if l == layer and n == net and
+                on (ends[0], t) and on (ends[1], t)]
+        assert hits
+    assert len (after) <= len (before)
+
+def test_sexp_edits_reach_the_board (tmp_path, lazy):
+    pcb = load (tmp_path, lazy=lazy)
+    seg = pcb.find_types (SegmentSexp)[0]
+    index = pcb.spatial_index ()
+    conn = pcb.connectivity ()
+    assert seg in pcb.nets.members ("GND")
+    assert conn.split_nets () == {"GND": 2}
+
+    # Re-netted and moved through the raw tree
+    nodes = dict ((kicad_tools.symbtostr (i[0]), i) for i in seg.sexp[1:])
+    nodes["net"][1] = 2
+    nodes["end"][1:] = [40, 40]
+    assert seg in pcb.nets.members ("VCC")
+    assert seg not in pcb.nets.members ("GND")
+    assert index.in_radius (40, 40, 0) == [seg]
+    assert index.in_radius (2, 0, 0) == []
+    assert conn.split_nets () == {"VCC": 2}
+
+    # ... and put back by replacing it
+    seg.sexp = kicad_tools.parse_sexp (segment_text (0, 0, 2, 0))
+    assert seg in pcb.nets.members ("GND")
+    assert index.in_radius (40, 40, 0) == []
+    assert index.in_radius (2, 0, 0) == [seg]
+    assert conn.split_nets () == {"GND": 2}
+    assert seg.end == [2, 0]
+
+    # Taken off the board after its tree was handed out, it stays off
+    seg.sexp
+    pcb.delete (seg)
+    assert index.in_radius (2, 0, 0) == []
+    assert seg not in pcb.nets.members ("GND")
+
+def test_module_sexp_edits_reach_the_board (tmp_path, lazy):
+    text = with_module (board_with ([via_text (20, 20.7875),
+                                     via_text (20, 19.2125, net=2)]))
+    pcb = load (tmp_path, text, lazy=lazy)
+    module, = pcb.find_keyword ("module")
+    via1, via2 = pcb.find_types (ViaSexp)
+    pad1, pad2 = module.pads
+    assert pcb.find_pads_on_net ("GND") == [pad1]
+    assert pcb.find_pads_under (via2) == [pad2]
+    assert pcb.connectivity ().split_nets () == {}
+
+    # Pad 1 over to VCC and pad 2 gone, through the raw tree
+    tree = module.sexp
+    pads = [i for i in tree if type (i) is list and
+            kicad_tools.symbtostr (i[0]) == "pad"]
+    pads[0][-1][1:] = [2, "VCC"]
+    tree.remove (pads[1])
+    new, = module.pads
+    assert new is not pad1 and new.net == "VCC"
+    assert pcb.find_pads_on_net ("GND") == []
+    assert pcb.find_pads_on_net ("VCC") == [new]
+    assert pcb.find_pads_under (via1) == [new]
+    assert pcb.find_pads_under (via2) == []
+    assert pcb.connectivity ().split_nets () == {"VCC": 2}
+
+    # Replaced whole, it's back as it was
+    module.sexp = kicad_tools.parse_sexp (MODULE)
+    pad1, pad2 = module.pads
+    assert pcb.find_pads_on_net ("GND") == [pad1]
+    assert pcb.find_pads_on_net ("VCC") == [pad2]
+    assert pcb.find_pads_under (via2) == [pad2]
+    assert pcb.connectivity ().split_nets () == {}